@@ -0,0 +1,51 @@
+'''Benchmark of the throughput of UniquenessMixin.bulk_update as the number of concurrent partitions grows.
+
+It requires a local mongod:
+
+    $ python -m benchmarks.bench_bulk_update_parallel --documents 500000 --parallelism 1 2 4 8
+'''
+import argparse
+import time
+import bson
+import mongoengine
+
+from datetime import datetime
+from distpickymodel import models
+
+DATABASE = 'distpickymodel_benchmarks'
+HOST = 'localhost'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=500000)
+    parser.add_argument('--parallelism', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    db = mongoengine.connect(DATABASE, host=HOST, maxPoolSize=max(args.parallelism))
+    try:
+        site = models.Sites(url='https://www.benchmark.com')
+        site.save(force_insert=True)
+        scan_id = bson.ObjectId()
+        collection = models.WebDocuments._get_collection()
+        for start in range(0, args.documents, 10000):
+            collection.insert_many([{'_cls': 'WebDocuments', 'site': site.id, 'scan': scan_id, 'site_url': site.url,
+                                     'url': f"{site.url}/{num_node}.html", 'level': 1, 'num_node': num_node}
+                                    for num_node in range(start, min(start + 10000, args.documents))])
+        documents = list(models.WebDocuments.objects.no_dereference())
+
+        for parallelism in args.parallelism:
+            now = datetime.utcnow()
+            for document in documents:
+                document.updated = now
+            start = time.perf_counter()
+            ret = models.WebDocuments.bulk_update(documents, parallelism=parallelism, full_result=True)
+            elapsed = time.perf_counter() - start
+            print(f"parallelism={parallelism:<3} documents={ret['nModified']} seconds={elapsed:.2f} "
+                  f"documents/sec={ret['nModified'] / elapsed:,.0f}")
+    finally:
+        db.drop_database(DATABASE)
+
+
+if __name__ == '__main__':
+    main()
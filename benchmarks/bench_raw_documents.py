@@ -0,0 +1,73 @@
+'''Benchmark of the client CPU time and memory taken to forward the latest content of WebDocuments received as BSON,
+decoding them into Documents, into dictionaries or reading them through raw views.
+
+It does not require a database:
+
+    $ python -m benchmarks.bench_raw_documents --documents 2000 --versions 5 --content-size 50000
+'''
+import argparse
+import datetime
+import time
+import tracemalloc
+import bson
+
+from distpickymodel import models, raw
+
+
+def make_pages(num_documents, num_versions, content_size):
+    site_id, scan_id = bson.ObjectId(), bson.ObjectId()
+    pages = []
+    for num in range(num_documents):
+        url = f"https://www.site.com/{num}.html"
+        page = models.WebDocuments(id=bson.ObjectId(), site=site_id, scan=scan_id, url=url,
+                                   site_url='https://www.site.com', level=1, num_node=num,
+                                   children=[bson.ObjectId() for _ in range(50)], ancestors=[bson.ObjectId()],
+                                   created=datetime.datetime.utcnow())
+        page.content = [models.WebContent(url=url, version=f"1.{version}", content=f"{version}" * content_size)
+                        for version in range(num_versions)]
+        pages.append(bson.BSON.encode(page.to_mongo()))
+    return pages
+
+
+def forward_documents(pages):
+    return sum(len(models.WebDocuments._from_son(bson.BSON(page).decode()).content[-1].content.encode('utf-8'))
+               for page in pages)
+
+
+def forward_dictionaries(pages):
+    return sum(len(bson.BSON(page).decode()['content'][-1]['content'].encode('utf-8')) for page in pages)
+
+
+def forward_raw(pages):
+    return sum(len(raw.RawWebDocument(page).latest_content.content) for page in pages)
+
+
+def measure(name, forward, pages):
+    tracemalloc.start()
+    start = time.process_time()
+    forwarded = forward(pages)
+    elapsed = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<13} documents={len(pages)} bytes={forwarded} cpu_seconds={elapsed:.3f} "
+          f"documents/sec={len(pages) / elapsed:,.0f} peak_memory_kb={peak / 1024:,.0f}")
+    return forwarded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=2000)
+    parser.add_argument('--versions', type=int, default=5, help='content versions per document')
+    parser.add_argument('--content-size', type=int, default=50000, help='characters of each content version')
+    args = parser.parse_args()
+
+    pages = make_pages(args.documents, args.versions, args.content_size)
+    results = {measure('Documents', forward_documents, pages),
+               measure('dictionaries', forward_dictionaries, pages),
+               measure('raw views', forward_raw, pages)}
+    if len(results) != 1:
+        raise AssertionError('Not all methods forwarded the same content')
+
+
+if __name__ == '__main__':
+    main()
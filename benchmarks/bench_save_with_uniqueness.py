@@ -0,0 +1,59 @@
+'''Microbenchmark of the per-call client CPU cost of UniquenessMixin.save_with_uniqueness with and without the raw path.
+
+CPU time is measured with time.process_time so that the time spent waiting for the database is not accounted for.
+It requires a local mongod:
+
+    $ python -m benchmarks.bench_save_with_uniqueness --calls 5000
+'''
+import argparse
+import time
+import mongoengine
+
+from distpickymodel import models
+
+DATABASE = 'distpickymodel_benchmarks'
+HOST = 'localhost'
+
+
+def run(calls, raw):
+    peer = models.Peers.objects.first()
+    site = models.Sites.objects.first()
+    documents = [doc.id for doc in models.WebDocuments.objects.only('id')]
+    scan = models.Scans(peer=peer, site=site, is_active=True)
+    scan.documents.append(documents[0])
+    scan.save_with_uniqueness('documents', raw=raw)
+
+    start = time.process_time()
+    for num_call in range(calls):
+        scan.documents = [documents[num_call % len(documents)]]
+        scan.process_name = f"Process-{num_call}"
+        scan.save_with_uniqueness('documents', raw=raw)
+    return (time.process_time() - start) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=5000)
+    args = parser.parse_args()
+
+    db = mongoengine.connect(DATABASE, host=HOST)
+    try:
+        peer = models.Peers(ip_address='192.168.1.1', name='benchmark-peer')
+        peer.save()
+        site = models.Sites(url='https://www.benchmark.com')
+        site.save(force_insert=True)
+        scan = models.Scans(peer=peer, site=site)
+        scan.save()
+        for num_node in range(32):
+            models.WebDocuments(site=site, scan=scan, url=f"https://www.benchmark.com/{num_node}",
+                                site_url=site.url, level=1, num_node=num_node).save()
+
+        for raw in (False, True):
+            cpu_per_call = run(args.calls, raw)
+            print(f"raw={raw!s:<5} calls={args.calls} cpu/call={cpu_per_call * 1e6:.1f}us")
+    finally:
+        db.drop_database(DATABASE)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''Benchmark of a simulated fleet of workers scanning sites, against either a MongoDB server or the in-memory backend.
+
+Each worker registers its peer, starts a scan, stores its pages, checks whether urls were already seen, sends heartbeats
+and finishes its scan. Run it once per backend to compare them:
+
+    $ python -m benchmarks.bench_simulation --workers 1000 --pages 20
+    $ python -m benchmarks.bench_simulation --workers 1000 --pages 20 --host memory://
+'''
+import argparse
+import time
+
+from datetime import datetime
+from distpickymodel import connection, models
+
+DATABASE = 'distpickymodel_benchmarks'
+
+
+def simulate(workers, pages, num_sites):
+    sites = [models.Sites(url=f"https://www.site{num}.com") for num in range(num_sites)]
+    models.Sites.insert_many_ignore_duplicates(sites)
+    peers = [models.Peers(name=f"Peer-{num}", ip_address=f"10.0.{num // 256}.{num % 256}", is_allowed=True)
+             for num in range(workers)]
+    models.Peers.insert_many_ignore_duplicates(peers)
+
+    operations = 2
+    for num, peer in enumerate(peers):
+        site = sites[num % num_sites]
+        scan = models.Scans(peer=peer, site=site, process_name=f"Process-{num}", is_active=True)
+        scan.save()
+        for num_node in range(pages):
+            url = f"{site.url}/{num}/{num_node}.html"
+            if not models.WebDocuments.url_exists(site, url):
+                models.WebDocuments(site=site, scan=scan, url=url, site_url=site.url, level=1,
+                                    num_node=num_node).save()
+        models.Peers.heartbeat(peer.name)
+        peer.is_assigned = True
+        scan.finish()
+        operations += 4 + 2 * pages
+
+    for peer in peers:
+        peer.updated = datetime.utcnow()
+    models.Peers.bulk_update(peers)
+    return operations + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost', help="MongoDB host or 'memory://'")
+    parser.add_argument('--workers', type=int, default=1000)
+    parser.add_argument('--pages', type=int, default=20, help='pages stored by each worker')
+    parser.add_argument('--sites', type=int, default=10)
+    args = parser.parse_args()
+
+    connection.connect(DATABASE, host=args.host)
+    client = connection.get_client()
+    client.drop_database(DATABASE)
+    try:
+        start = time.perf_counter()
+        operations = simulate(args.workers, args.pages, args.sites)
+        elapsed = time.perf_counter() - start
+        print(f"host={args.host} workers={args.workers} operations={operations} seconds={elapsed:.2f} "
+              f"operations/sec={operations / elapsed:,.0f}")
+    finally:
+        client.drop_database(DATABASE)
+        connection.disconnect()
+
+
+if __name__ == '__main__':
+    main()
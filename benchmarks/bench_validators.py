@@ -0,0 +1,58 @@
+'''Benchmark of the url validation performed by StringField before and after using the dedicated validators.
+
+It does not require a database:
+
+    $ python -m benchmarks.bench_validators --urls 1000000 --adversarial 0.01
+'''
+import argparse
+import random
+import re
+import time
+
+from distpickymodel import validators
+
+
+def adversarial_url(size):
+    '''Return a url that ends up failing only after the regex has backtracked over all the dots or colons of its host
+    '''
+    return random.choice(['http://' + 'aa.' * (size // 3) + ' ',
+                          'http://' + '1.1' * (size // 3),
+                          'http://' + '0:' * (size // 2) + 'x',
+                          'https://' + 'a' * size + '.com/x y'])
+
+
+def well_formed_url(num):
+    return random.choice([f"https://www.site{num % 1000}.com/section/{num}/article-{num}.html",
+                          f"http://news.site{num % 1000}.co.uk/{num}?page={num % 10}&sort=desc",
+                          f"https://192.168.{num % 256}.{num % 200}:8080/",
+                          f"http://localhost:{num % 65536}/status"])
+
+
+def measure(name, validate, urls):
+    start = time.perf_counter()
+    accepted = sum(1 for url in urls if validate(url))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<22} urls={len(urls)} accepted={accepted} seconds={elapsed:.2f} urls/sec={len(urls) / elapsed:,.0f}")
+    return accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--urls', type=int, default=1000000)
+    parser.add_argument('--adversarial', type=float, default=0.01, help='fraction of adversarial urls')
+    parser.add_argument('--adversarial-size', type=int, default=2000, help='length of the adversarial urls')
+    args = parser.parse_args()
+
+    random.seed(0)
+    urls = [adversarial_url(args.adversarial_size) if random.random() < args.adversarial else well_formed_url(num)
+            for num in range(args.urls)]
+    compiled = re.compile(validators.URL_PATTERN)
+    results = {measure('re.match(pattern)', lambda url: re.match(validators.URL_PATTERN, url), urls),
+               measure('compiled regex', compiled.match, urls),
+               measure('validators.is_url', validators.is_url, urls)}
+    if len(results) != 1:
+        raise AssertionError('Validators disagree on the urls accepted')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''Benchmark of the messages sent to workers through Mongoengine's to_json/from_json and through the wire codec.
+
+It does not require a database:
+
+    $ python -m benchmarks.bench_wire --messages 20000
+'''
+import argparse
+import datetime
+import random
+import time
+import bson
+
+from distpickymodel import extended_model, models, wire
+
+
+def make_assignment(num):
+    site = models.Sites(id=bson.ObjectId(), url=f"https://www.site{num}.com")
+    site.instructions = [models.SiteInstructions(cover_instructions={'title': {'css': 'h1.title'}, 'links': 'a.more'},
+                                                 article_instructions={'body': ['div.main', 'p'], 'author': '.by'})]
+    now = datetime.datetime.utcnow()
+    instructions = extended_model.ServerInstructions(id=bson.ObjectId(), site=site.id,
+                                                     operation=random.choice(extended_model.OPERATIONS),
+                                                     stop_at=now + datetime.timedelta(days=7),
+                                                     exclude_dates=[now + datetime.timedelta(days=day)
+                                                                    for day in range(0, 30, 10)],
+                                                     weekdays=sorted(random.sample(extended_model.WEEK_DAYS, 5)),
+                                                     times=sorted(random.sample(range(1, 24 * 3600), 6)))
+    settings = models.ScanSettings(id=bson.ObjectId(), site=site.id, scans=[bson.ObjectId() for _ in range(20)])
+    return [instructions, settings, site.instructions[0]]
+
+
+def measure(name, encode, decode, assignments):
+    start = time.perf_counter()
+    messages = [encode(assignment) for assignment in assignments]
+    encoded = time.perf_counter()
+    for message in messages:
+        decode(message)
+    decoded = time.perf_counter()
+    size = sum(len(part) for message in messages for part in message) / len(messages)
+    print(f"{name:<10} messages={len(messages)} bytes/message={size:,.0f} "
+          f"encode/sec={len(messages) / (encoded - start):,.0f} decode/sec={len(messages) / (decoded - encoded):,.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    assignments = [make_assignment(num) for num in range(args.messages)]
+    model_classes = [type(document) for document in assignments[0]]
+    measure('to_json', lambda assignment: [document.to_json() for document in assignment],
+            lambda message: [cls.from_json(part) for cls, part in zip(model_classes, message)], assignments)
+    measure('wire', lambda assignment: [wire.encode_many(assignment)], lambda message: wire.decode_many(message[0]),
+            assignments)
+    measure('wire+model', lambda assignment: [wire.encode_many(assignment)],
+            lambda message: [wire.to_model(view) for view in wire.decode_many(message[0])], assignments)
+
+
+if __name__ == '__main__':
+    main()
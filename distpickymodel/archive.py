@@ -0,0 +1,217 @@
+import datetime
+import gzip
+import itertools
+import os
+import time
+import bson
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+from distpickymodel import errors, models
+
+MANIFEST_FILE = 'manifest.jsonl'
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _archive_path(directory, scan_id):
+    return os.path.join(directory, f"{scan_id}.bson.gz")
+
+
+def read_manifest(directory):
+    '''Return a dictionary of scan id -> manifest entry of all scans archived in the given directory and not restored
+    since
+    '''
+    manifest = {}
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE), 'r') as fh:
+            for line in fh:
+                entry = json_util.loads(line)
+                if entry.get('restored_at'):
+                    manifest.pop(entry['scan'], None)
+                else:
+                    manifest[entry['scan']] = entry
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def _write_archive(directory, scan, collections, batch_size):
+    '''Write the scan followed by all its pages into a gzip-compressed BSON file, grouped by the collection they are
+    read from. The file is written under a temporary name and renamed once complete so that a partial archive is never
+    mistaken for a complete one
+
+    :return: the path of the archive, the number of pages and the list of [collection name, number of pages] in the
+    order they were written
+    '''
+    path = _archive_path(directory, scan['_id'])
+    tmp_path = path + '.tmp'
+    num_documents, written = 0, []
+    with gzip.open(tmp_path, 'wb') as fh:
+        fh.write(bson.BSON.encode(scan))
+        for collection in collections:
+            cursor = collection.find({'scan': scan['_id']}).sort('_id', 1).batch_size(batch_size)
+            num_written = 0
+            for document in cursor:
+                fh.write(bson.BSON.encode(document))
+                num_written += 1
+            if num_written:
+                written.append([collection.name, num_written])
+                num_documents += num_written
+    os.replace(tmp_path, path)
+    return path, num_documents, written
+
+
+def _delete_scan(scan, collections, batch_size, pause):
+    '''Delete the pages of a scan from the given collections in batches of 'batch_size', pausing 'pause' seconds between
+    batches and subtracting each batch from the statistics rollups, then pull the scan out of ScanSettings.scans and
+    delete the scan itself along with its rollup
+
+    :return: set of the ids of the sites whose pages were deleted
+    '''
+    scan_id, sites = scan['_id'], set()
+    for collection in collections:
+        while True:
+            cursor = collection.find({'scan': scan_id}, {'_id': True}).limit(batch_size)
+            doc_ids = [doc['_id'] for doc in cursor]
+            if not doc_ids:
+                break
+            sites.update(models.Statistics.record_removed_pages(collection, {'_id': {'$in': doc_ids}}))
+            collection.delete_many({'_id': {'$in': doc_ids}})
+            time.sleep(pause)
+    models.ScanSettings._get_collection().update_many({'scans': scan_id}, {'$pull': {'scans': scan_id}})
+    if models.Scans._get_collection().delete_one({'_id': scan_id}).deleted_count:
+        models.Statistics.record_removed_scans([(scan_id, scan.get('site'), scan.get('started_at'),
+                                                 scan.get('finished_at'))])
+    return sites
+
+
+def archive_scans(directory, older_than, now=None, batch_size=500, max_scans=None, pause=0.1, partitions=None):
+    '''Move finished Scans/ExtendedScans whose 'finished_at' is older than 'older_than', along with their WebDocuments,
+    out of the hot collections and into gzip-compressed BSON files, one per scan, stored in 'directory'.
+
+    Every archived scan is recorded in a JSON Lines manifest holding the archive file, the number of pages per
+    collection and the ScanSettings that referenced the scan. Only once the archive and its manifest entry are on disk,
+    the pages are deleted in batches of 'batch_size' with a pause of 'pause' seconds between them, so that the job can
+    run alongside live ingest. If interrupted, a later run completes the deletion of scans already present in the
+    manifest without archiving them again.
+
+    Deleted pages and scans are subtracted from the statistics rollups as they are deleted, and the seen-url filters of
+    their sites are rebuilt once all scans of the run are deleted, as Bloom filters cannot forget urls.
+
+    :param directory: existing directory where archives and manifest are stored
+    :param older_than: datetime.timedelta or number of seconds since a scan finished for it to be archived
+    :param now: datetime used as reference. It defaults to datetime.utcnow()
+    :param batch_size: number of pages read or deleted per round trip
+    :param max_scans: maximum number of scans archived in this run. All of them by default
+    :param pause: number of seconds to sleep between delete batches
+    :param partitions: partitions.Partitions router of WebDocuments, whose partitions are archived along with the
+    collection of WebDocuments
+    :return: dictionary with the number of 'scans' and 'documents' archived and the 'bytes' written
+    '''
+    if not os.path.isdir(directory):
+        raise errors.DbModelOperationError(f"Archive directory '{directory}' does not exist")
+    if not isinstance(older_than, datetime.timedelta):
+        older_than = datetime.timedelta(seconds=older_than)
+    now = now or datetime.datetime.utcnow()
+
+    manifest = read_manifest(directory)
+    counts = {'scans': 0, 'documents': 0, 'bytes': 0}
+    query = {'is_active': False, 'finished_at': {'$lt': now - older_than}}
+    scans_collection = models.Scans._get_collection()
+    collections = models.WebDocuments._collections(partitions)
+    remaining = max_scans
+    sites = set()
+
+    with open(os.path.join(directory, MANIFEST_FILE), 'a') as manifest_fh:
+        # Scans are fetched one page at a time, as every scan processed is deleted, so that no cursor is kept open
+        # while pages are being deleted
+        while remaining is None or remaining > 0:
+            limit = batch_size if remaining is None else min(batch_size, remaining)
+            scans = list(scans_collection.find(query).sort('finished_at', 1).limit(limit))
+            if not scans:
+                break
+            for scan in scans:
+                scan_id = scan['_id']
+                if scan_id not in manifest:
+                    path, num_documents, written = _write_archive(directory, scan, collections, batch_size)
+                    settings = [doc['_id'] for doc in
+                                models.ScanSettings._get_collection().find({'scans': scan_id}, {'_id': True})]
+                    entry = {'scan': scan_id, 'file': os.path.basename(path), 'cls': scan.get('_cls'),
+                             'site': scan.get('site'), 'peer': scan.get('peer'), 'finished_at': scan['finished_at'],
+                             'scan_settings': settings, 'documents': num_documents, 'collections': written,
+                             'bytes': os.path.getsize(path), 'archived_at': now}
+                    manifest_fh.write(json_util.dumps(entry) + '\n')
+                    manifest_fh.flush()
+                    os.fsync(manifest_fh.fileno())
+                    manifest[scan_id] = entry
+                    counts['scans'] += 1
+                    counts['documents'] += num_documents
+                    counts['bytes'] += entry['bytes']
+                sites.update(_delete_scan(scan, collections, batch_size, pause))
+            if remaining is not None:
+                remaining -= len(scans)
+
+    models.SeenUrlFilters.rebuild(sites, collections=collections)
+    return counts
+
+
+def restore_scan(directory, scan_id, batch_size=500, partitions=None):
+    '''Bring an archived scan and its pages back into the hot collections, each page into the collection it was
+    archived from, and re-attach the scan to the ScanSettings that referenced it. Pages that already exist are left
+    untouched. The scan and the pages restored are accounted for in the statistics rollups and the seen-url filters as
+    if they were inserted. The scan is then flagged as restored in the manifest so that a later archival run archives it
+    again rather than deleting it.
+
+    :param directory: directory where archives and manifest are stored
+    :param scan_id: id of the scan to be restored
+    :param batch_size: number of pages inserted per round trip
+    :param partitions: partitions.Partitions router of WebDocuments, through which partitions dropped since the scan
+    was archived are created again along with their indexes
+    :return: number of pages restored
+    '''
+    scan_id = bson.ObjectId(scan_id)
+    entry = read_manifest(directory).get(scan_id)
+    if not entry:
+        raise errors.DbModelOperationError(f"Scan '{scan_id}' is not present in the archive '{directory}'")
+
+    documents_collection = models.WebDocuments._get_collection()
+    restored = 0
+
+    def collection_of(name):
+        if name == documents_collection.name:
+            return documents_collection
+        return partitions.collection(name) if partitions is not None else documents_collection.database[name]
+
+    def insert(collection, batch):
+        failed = set()
+        try:
+            collection.insert_many(batch, ordered=False)
+        except BulkWriteError as ex:
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in ex.details['writeErrors']):
+                raise
+            failed = {error['index'] for error in ex.details['writeErrors']}
+        inserted = [models.WebDocuments._from_son(son) for index, son in enumerate(batch) if index not in failed]
+        models.WebDocuments.record_inserted(inserted, events=False)
+        return len(inserted)
+
+    # Entries written before pages were archived per collection hold them all in the collection of WebDocuments
+    written = entry.get('collections') or [[documents_collection.name, entry['documents']]]
+    with gzip.open(os.path.join(directory, entry['file']), 'rb') as fh:
+        iterator = bson.decode_file_iter(fh)
+        scan = next(iterator)
+        result = models.Scans._get_collection().replace_one({'_id': scan_id}, scan, upsert=True)
+        if result.upserted_id is not None and not scan.get('is_active') and scan.get('finished_at'):
+            models.Statistics.record_finished_scans([(scan_id, scan.get('site'), scan.get('started_at'),
+                                                      scan['finished_at'])])
+        for name, num_documents in written:
+            collection = collection_of(name)
+            for start in range(0, num_documents, batch_size):
+                batch = list(itertools.islice(iterator, min(batch_size, num_documents - start)))
+                restored += insert(collection, batch)
+
+    if entry['scan_settings']:
+        models.ScanSettings._get_collection().update_many({'_id': {'$in': entry['scan_settings']}},
+                                                          {'$addToSet': {'scans': scan_id}})
+    with open(os.path.join(directory, MANIFEST_FILE), 'a') as manifest_fh:
+        manifest_fh.write(json_util.dumps({'scan': scan_id, 'restored_at': datetime.datetime.utcnow()}) + '\n')
+    return restored
@@ -0,0 +1,85 @@
+import hashlib
+import math
+
+from distpickymodel import errors
+
+
+class BloomFilter:
+    '''Array-backed Bloom filter of strings. Membership tests may give false positives, at a rate bounded by the
+    'error_rate' the filter was sized for as long as no more than 'capacity' items are added, but never false negatives.
+
+    The k bit positions of an item are derived by double hashing the two halves of its 128-bit blake2b digest, so that
+    a single hash is computed per item regardless of k.
+    '''
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0):
+        '''
+        :param num_bits: size of the bit array
+        :param num_hashes: number of bit positions set per item
+        :param bits: bytes-like object holding a bit array previously obtained from 'to_bytes'
+        :param count: number of items already added to 'bits'
+        '''
+        if num_bits < 1 or num_hashes < 1:
+            raise errors.DbModelOperationError(f"A Bloom filter requires at least one bit and one hash. "
+                                               f"Instead '{num_bits}' bits and '{num_hashes}' hashes")
+        num_bytes = (num_bits + 7) // 8
+        if bits is not None and len(bits) != num_bytes:
+            raise errors.DbModelOperationError(f"A bit array of '{num_bytes}' bytes was expected. "
+                                               f"Instead '{len(bits)}'")
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self._bits = bytearray(bits) if bits is not None else bytearray(num_bytes)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        '''Create an empty filter with the optimal number of bits and hashes to hold 'capacity' items with a false
+        positive rate of 'error_rate'
+        '''
+        if not 0 < error_rate < 1:
+            raise errors.DbModelOperationError(f"'error_rate' must be within (0, 1). Instead '{error_rate}'")
+        capacity = max(capacity, 1)
+        num_bits = max(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        num_hashes = max(round(num_bits / capacity * math.log(2)), 1)
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        '''Add an item to the filter
+
+        :return: True if the item was possibly already present
+        '''
+        present = True
+        bits = self._bits
+        for position in self._positions(item):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                present = False
+                bits[byte] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+    def estimated_error_rate(self):
+        '''Return the false positive rate expected for the number of items added so far
+        '''
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    def to_bytes(self):
+        return bytes(self._bits)
@@ -0,0 +1,122 @@
+import atexit
+import os
+import mongoengine
+
+from mongoengine import connection as me_connection
+from mongoengine.base import common as me_common
+from distpickymodel import memory_backend
+
+DEFAULT_ALIAS = me_connection.DEFAULT_CONNECTION_NAME
+DEFAULT_MAX_POOL_SIZE = 100
+DEFAULT_MIN_POOL_SIZE = 0
+
+_owner_pid = os.getpid()
+_memory_hosts = {}  # Alias -> host of the connections served by the in-memory backend
+_memory_clients = {}  # Host -> MemoryClient, shared by all aliases of the same host
+_cache_resets = []  # Functions dropping the collections cached outside of Mongoengine
+
+
+def connect(db, host='localhost', alias=DEFAULT_ALIAS, max_pool_size=DEFAULT_MAX_POOL_SIZE,
+            min_pool_size=DEFAULT_MIN_POOL_SIZE, **kwargs):
+    '''Register the settings of a connection without creating any client. The MongoClient is only created, by each
+    process, the first time a model needs it. Clients inherited through 'os.fork' are discarded in the child, which
+    creates its own on first use, as MongoClient is not fork-safe.
+
+    Hosts starting with memory_backend.MEMORY_HOST, such as 'memory://simulation', are served by an in-memory backend
+    local to the process rather than by a MongoDB server. Aliases using the same memory host share the same data.
+
+    :param db: name of the database
+    :param host: host name, MongoDB URI or memory host
+    :param alias: name given to the connection so that models can refer to it through meta['db_alias']
+    :param max_pool_size: maximum number of connections kept by the client of each process
+    :param min_pool_size: minimum number of connections kept by the client of each process
+    :param kwargs: any other keyword argument accepted by pymongo's MongoClient
+    '''
+    if alias in me_connection._connection_settings:
+        disconnect(alias)
+    if host.startswith(memory_backend.MEMORY_HOST):
+        # Mongoengine would parse the memory host as a MongoDB URI, it is hence only known to this module
+        mongoengine.register_connection(alias, db=db, connect=False)
+        _memory_hosts[alias] = host
+        _seed_memory_clients()
+        return
+    mongoengine.register_connection(alias, db=db, host=host, maxPoolSize=max_pool_size, minPoolSize=min_pool_size,
+                                    connect=False, **kwargs)
+
+
+def _seed_memory_clients():
+    '''Hand Mongoengine the in-memory clients of the aliases served by the memory backend, as it would otherwise try to
+    create a MongoClient for them
+    '''
+    for alias, host in _memory_hosts.items():
+        if host not in _memory_clients:
+            _memory_clients[host] = memory_backend.MemoryClient(host)
+        me_connection._connections[alias] = _memory_clients[host]
+
+
+def get_client(alias=DEFAULT_ALIAS):
+    '''Return the MongoClient of the given alias that belongs to the current process, creating it if necessary
+    '''
+    reset_if_forked()
+    return me_connection.get_connection(alias)
+
+
+def reset_if_forked():
+    '''Discard the clients inherited from the parent process if the current process is a fork of it. Run whenever a
+    model reaches its collection or database through 'models.Document', as fallback where 'os.register_at_fork' is not
+    available
+    '''
+    global _owner_pid
+    if os.getpid() != _owner_pid:
+        _forget_clients()
+        _owner_pid = os.getpid()
+
+
+def register_cache_reset(reset):
+    '''Register a function to be called without arguments whenever the clients are forgotten, such as in a forked
+    child, so that collections cached outside of Mongoengine, as by 'partitions.Partitions', are dropped along with them
+    '''
+    _cache_resets.append(reset)
+
+
+def _forget_clients():
+    '''Drop every reference to the clients, databases and collections cached by Mongoengine or by the functions given to
+    'register_cache_reset' without closing them, as closing a client in the child process would act upon sockets still
+    in use by the parent
+    '''
+    me_connection._connections.clear()
+    me_connection._dbs.clear()
+    for document_cls in me_common._document_registry.values():
+        if getattr(document_cls, '_collection', None) is not None:
+            document_cls._collection = None
+    for reset in _cache_resets:
+        reset()
+    _seed_memory_clients()
+
+
+def _after_fork_in_child():
+    global _owner_pid
+    _forget_clients()
+    _owner_pid = os.getpid()
+
+
+def disconnect(alias=DEFAULT_ALIAS):
+    '''Close the client of the given alias if it was created by the current process and forget its settings
+    '''
+    reset_if_forked()
+    _memory_hosts.pop(alias, None)
+    me_connection.disconnect(alias)
+
+
+def shutdown():
+    '''Gracefully close all clients created by the current process. Registered to run at interpreter exit
+    '''
+    reset_if_forked()
+    for alias in list(me_connection._connections):
+        me_connection._connections.pop(alias).close()
+    _forget_clients()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+atexit.register(shutdown)
@@ -0,0 +1,136 @@
+import gzip
+import heapq
+import json
+import os
+import time
+import bson
+
+from bson import json_util
+from distpickymodel import errors, models
+
+FORMATS = ('jsonl', 'bson')
+CHECKPOINT_SUFFIX = '.checkpoint'
+MAX_CHUNK_BYTES = 16 * 1024 * 1024  # A checkpoint is also taken whenever the pending chunk grows beyond this size
+
+
+def _load_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path, 'r') as fh:
+            checkpoint = json.load(fh)
+    except FileNotFoundError:
+        return None
+    checkpoint['last_id'] = bson.ObjectId(checkpoint['last_id'])
+    return checkpoint
+
+
+def _save_checkpoint(checkpoint_path, checkpoint):
+    '''Atomically replace the checkpoint file so that an interruption never leaves a half-written checkpoint behind
+    '''
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump({**checkpoint, 'last_id': str(checkpoint['last_id'])}, fh)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _encode(document, fmt):
+    if fmt == 'jsonl':
+        return json_util.dumps(document).encode('utf-8') + b'\n'
+    return bson.BSON.encode(document)
+
+
+def export_documents(path, scan=None, site=None, fmt='jsonl', compress=False, fields=None, batch_size=500,
+                     checkpoint_every=5000, progress=None, partitions=None):
+    '''Stream the WebDocuments of a scan or site into a JSON Lines or raw BSON file, optionally gzip-compressed, with
+    bounded memory.
+
+    Documents are read in '_id' order through a 'no_cache' cursor that returns raw dictionaries. Every
+    'checkpoint_every' documents or MAX_CHUNK_BYTES, whatever comes first, the pending chunk is appended to the file,
+    compressed as a gzip member of its own if required, and a checkpoint holding the last '_id', the file offset and
+    the arguments of the export is stored next to it. If the export is interrupted, calling this function again with
+    the same arguments truncates whatever was written after the last checkpoint and resumes from there. Resuming with
+    different arguments raises DbModelOperationError. The checkpoint is removed once the export completes.
+
+    :param path: path of the output file
+    :param scan: Scans object or id whose documents are exported
+    :param site: Sites object or id whose documents are exported
+    :param fmt: either 'jsonl' or 'bson'
+    :param compress: whether the output should be gzip-compressed
+    :param fields: list of fields to export. All fields are exported by default
+    :param batch_size: number of documents fetched per round trip
+    :param checkpoint_every: number of documents written between checkpoints
+    :param progress: optional callable invoked with the statistics dictionary after each checkpoint
+    :param partitions: partitions.Partitions router whose partitions are exported as well, merged with the collection
+    of WebDocuments in '_id' order so that checkpoints hold across all of them
+    :return: dictionary with the total number of 'documents' and 'bytes' written to the file, plus the 'seconds' and
+    'documents_per_sec' of this run
+    '''
+    if fmt not in FORMATS:
+        raise errors.DbModelOperationError(f"Only the following formats are available '{FORMATS}'. Instead: '{fmt}'")
+    query = {}
+    if scan is not None:
+        query['scan'] = getattr(scan, 'id', scan)
+    if site is not None:
+        query['site'] = getattr(site, 'id', site)
+    if not query:
+        raise errors.DbModelOperationError("Either 'scan' or 'site' is required to export documents")
+
+    checkpoint_path = path + CHECKPOINT_SUFFIX
+    checkpoint = _load_checkpoint(checkpoint_path)
+    arguments = {'query': {key: str(value) for key, value in query.items()}, 'fmt': fmt, 'compress': compress,
+                 'fields': list(fields) if fields else None, 'checkpoint_every': checkpoint_every}
+    if partitions is not None:
+        arguments['partitions'] = partitions.prefix
+    if checkpoint and checkpoint.get('arguments') != arguments:
+        raise errors.DbModelOperationError(f"The checkpoint '{checkpoint_path}' was taken by an export with the "
+                                           f"arguments '{checkpoint.get('arguments')}'. Instead: '{arguments}'")
+    stats = {'documents': 0, 'bytes': 0, 'seconds': 0.0, 'documents_per_sec': 0.0}
+    querysets = [models.WebDocuments.objects(**query)]
+    if partitions is not None:
+        querysets.extend(queryset for _, queryset in partitions.querysets(**query))
+    if checkpoint:
+        stats.update(documents=checkpoint['documents'], bytes=checkpoint['offset'])
+        querysets = [queryset.filter(id__gt=checkpoint['last_id']) for queryset in querysets]
+    if fields:
+        querysets = [queryset.only(*fields) for queryset in querysets]
+    # Generators rather than QuerySets are merged, as iterating a 'no_cache' QuerySet again starts it over
+    cursors = [(document for document in queryset.order_by('id').no_cache().as_pymongo().batch_size(batch_size))
+               for queryset in querysets]
+    cursor = cursors[0] if len(cursors) == 1 else heapq.merge(*cursors, key=lambda document: document['_id'])
+
+    start = time.monotonic()
+    exported = 0
+    with open(path, 'r+b' if checkpoint else 'wb') as fh:
+        fh.truncate(stats['bytes'])
+        fh.seek(stats['bytes'])
+
+        def write_chunk(chunk, last_id):
+            data = b''.join(chunk)
+            fh.write(gzip.compress(data) if compress else data)
+            fh.flush()
+            os.fsync(fh.fileno())
+            stats['bytes'] = fh.tell()
+            stats['documents'] += len(chunk)
+            stats['seconds'] = time.monotonic() - start
+            stats['documents_per_sec'] = exported / stats['seconds'] if stats['seconds'] else 0.0
+            _save_checkpoint(checkpoint_path, {'last_id': last_id, 'offset': stats['bytes'],
+                                               'documents': stats['documents'], 'arguments': arguments})
+            if progress:
+                progress(dict(stats))
+
+        chunk, chunk_bytes, last_id = [], 0, None
+        for document in cursor:
+            chunk.append(_encode(document, fmt))
+            chunk_bytes += len(chunk[-1])
+            last_id = document['_id']
+            exported += 1
+            if len(chunk) >= checkpoint_every or chunk_bytes >= MAX_CHUNK_BYTES:
+                write_chunk(chunk, last_id)
+                chunk, chunk_bytes = [], 0
+        if chunk:
+            write_chunk(chunk, last_id)
+
+    stats['seconds'] = time.monotonic() - start
+    stats['documents_per_sec'] = exported / stats['seconds'] if stats['seconds'] else 0.0
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return stats
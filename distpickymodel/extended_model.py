@@ -1,3 +1,4 @@
+import datetime
 import mongoengine
 
 from distpickymodel import models
@@ -7,6 +8,7 @@ STOP_OP = 'STOP'
 STOP_AND_RUN_OP = 'STOP AND RUN'
 OPERATIONS = [RUN_OP, STOP_OP, STOP_AND_RUN_OP]
 WEEK_DAYS = [x for x in range(7)]
+SCAN_FIELDS = {'peer': True, 'site': True, 'started_at': True, 'run_instruction': True, 'stop_instruction': True}
 
 
 class ServerInstructions(models.UniquenessMixin):
@@ -27,3 +29,63 @@ class ExtendedScans(models.Scans):
     '''
     run_instruction = mongoengine.ReferenceField(ServerInstructions, required=True)
     stop_instruction = mongoengine.ReferenceField(ServerInstructions)
+
+
+def release_stale_peers(threshold, now=None, batch_size=5000):
+    '''Release those peers whose last heartbeat is older than 'threshold' and clean up after them as follows:
+
+    1) Peers are flagged as not assigned
+    2) Their active Scans/ExtendedScans are closed by setting 'finished_at' and 'is_active' to False, their
+    durations are accounted for in the statistics rollups and a ScanEvents.RELEASED event is recorded for each
+    3) The ServerInstructions linked to those scans have their 'running' flag reset
+
+    Peers and instructions are updated through 'update_many' operations over batches of peer ids. Each scan is closed
+    by a conditional 'find_one_and_update' instead, so that only the scans this call actually closed are accounted
+    for, even if some of them are finished concurrently.
+
+    :param threshold: datetime.timedelta or number of seconds after which a peer without heartbeat is considered stale
+    :param now: datetime used as reference to compute the staleness and as 'finished_at' of the closed scans
+    :param batch_size: maximum number of peer ids sent within a single operation
+    :return: dictionary with the number of peers released, scans closed and instructions stopped
+    '''
+    if not isinstance(threshold, datetime.timedelta):
+        threshold = datetime.timedelta(seconds=threshold)
+    now = now or datetime.datetime.utcnow()
+    cut_off = now - threshold
+    stale_query = {'is_assigned': True,
+                   '$or': [{'updated': {'$lt': cut_off}}, {'updated': None, 'created': {'$lt': cut_off}}]}
+
+    peers_collection = models.Peers._get_collection()
+    scans_collection = models.Scans._get_collection()
+    instructions_collection = ServerInstructions._get_collection()
+    counts = {'peers': 0, 'scans': 0, 'instructions': 0}
+
+    stale_ids = [doc['_id'] for doc in peers_collection.find(stale_query, {'_id': True})]
+    for start in range(0, len(stale_ids), batch_size):
+        peer_ids = stale_ids[start:start + batch_size]
+        result = peers_collection.update_many({'_id': {'$in': peer_ids}, **stale_query},
+                                              {'$set': {'is_assigned': False}})
+        counts['peers'] += result.modified_count
+
+        scans = []
+        for scan in scans_collection.find({'peer': {'$in': peer_ids}, 'is_active': True}, {'_id': True}):
+            # Scans closed by someone else since the 'find' are skipped so that they are not accounted for twice
+            closed = scans_collection.find_one_and_update({'_id': scan['_id'], 'is_active': True},
+                                                          {'$set': {'is_active': False, 'finished_at': now}},
+                                                          projection=SCAN_FIELDS)
+            if closed:
+                scans.append(closed)
+        counts['scans'] += len(scans)
+        instruction_ids = {scan[field] for scan in scans for field in ('run_instruction', 'stop_instruction')
+                           if scan.get(field)}
+        models.Statistics.record_finished_scans([(scan['_id'], scan['site'], scan.get('started_at'), now)
+                                                 for scan in scans])
+        models.ScanEvents.record_finished([(scan['_id'], scan['peer'], scan['site'], scan.get('started_at'), now)
+                                           for scan in scans], event=models.ScanEvents.RELEASED)
+
+        if instruction_ids:
+            result = instructions_collection.update_many({'_id': {'$in': list(instruction_ids)}, 'running': True},
+                                                         {'$set': {'running': False}})
+            counts['instructions'] += result.modified_count
+
+    return counts
@@ -0,0 +1,1580 @@
+'''In-process storage backend that stands in for a MongoDB server in local simulations and tests.
+
+MemoryClient mimics the subset of pymongo's MongoClient, Database, Collection and Cursor APIs used by Mongoengine and by
+this library. Each collection keeps its documents in a dictionary keyed by '_id', in insertion order, along with hash
+indexes on the first field of every index created on it, so that queries by '_id', url, site or any other indexed field
+only look at the matching documents. Unique indexes are enforced in the same terms as the server does, raising the same
+pymongo errors and codes.
+
+Only the query, update, projection and aggregation operators issued by this library and Mongoengine are supported.
+Anything else raises NotImplementedError rather than silently diverging from the server. Use it by connecting with
+connection.connect(db, host=MEMORY_HOST).
+'''
+import collections
+import copy
+import datetime
+import itertools
+import re
+import threading
+import bson
+
+from bson.regex import Regex
+from pymongo import (ASCENDING, CursorType, DeleteMany, DeleteOne, InsertOne, ReadPreference, ReplaceOne, UpdateMany,
+                     UpdateOne, WriteConcern)
+from pymongo.collection import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, WriteError
+from pymongo.read_concern import ReadConcern
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+MEMORY_HOST = 'memory://'
+DUPLICATE_KEY_ERROR = 11000
+BAD_VALUE = 2
+FAILED_TO_PARSE = 9
+TYPE_MISMATCH = 14
+CONFLICTING_UPDATE_OPERATORS = 40
+IMMUTABLE_FIELD = 66
+CAPPED_POSITION_LOST = 136
+
+_MISSING = object()
+_PATTERN_TYPE = type(re.compile(''))
+
+
+# -------------------------------------------------------------------------------------------------------------------
+# Values
+# -------------------------------------------------------------------------------------------------------------------
+
+def _type_rank(value):
+    '''Rank of the BSON type of a value in MongoDB's comparison order
+    '''
+    if value is None or value is _MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float, bson.Int64, bson.Decimal128)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, (bytes, bson.Binary)):
+        return 6
+    if isinstance(value, bson.ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+
+def _sort_key(value):
+    rank = _type_rank(value)
+    if rank == 1:
+        return (rank, 0)
+    if rank == 2 and isinstance(value, bson.Decimal128):
+        return (rank, value.to_decimal())
+    if rank == 4:
+        return (rank, tuple((key, _sort_key(item)) for key, item in value.items()))
+    if rank == 5:
+        return (rank, tuple(_sort_key(item) for item in value))
+    if rank == 10:
+        return (rank, repr(value))
+    return (rank, value)
+
+
+def _hash_key(value):
+    '''Hashable key of a value such that two values have the same key if, and only if, MongoDB considers them equal
+    '''
+    if isinstance(value, bool):
+        return ('bool', value)
+    if isinstance(value, dict):
+        return ('dict', tuple((key, _hash_key(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return ('list', tuple(_hash_key(item) for item in value))
+    if isinstance(value, bson.Binary) and value.subtype == 0:
+        return bytes(value)
+    return value
+
+
+def _equal(a, b):
+    return _type_rank(a) == _type_rank(b) and _hash_key(a) == _hash_key(b)
+
+
+def _compare(a, b):
+    '''Return -1, 0 or 1 if both values belong to the same type bracket, otherwise None
+    '''
+    if _type_rank(a) != _type_rank(b):
+        return None
+    key_a, key_b = _sort_key(a), _sort_key(b)
+    return (key_a > key_b) - (key_a < key_b)
+
+
+def _copy_in(value):
+    '''Copy a value as the server would store it: tuples become arrays, datetimes lose their sub-millisecond precision
+    and become naive UTC and generic binaries become bytes
+    '''
+    if isinstance(value, dict):
+        return {key: _copy_in(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_copy_in(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    if isinstance(value, bson.Binary) and value.subtype == 0:
+        return bytes(value)
+    if isinstance(value, (set, frozenset)):
+        raise bson.errors.InvalidDocument(f"cannot encode object: {value!r}, of type: {type(value)}")
+    return value
+
+
+def _copy_out(value):
+    if isinstance(value, dict):
+        return {key: _copy_out(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_out(item) for item in value]
+    return value
+
+
+def _split(path):
+    return path.split('.')
+
+
+def _lookup(document, parts):
+    '''Return the list of values reached by following the given path parts, traversing arrays as MongoDB does. Missing
+    values are returned as _MISSING
+    '''
+    if not parts:
+        return [document]
+    if isinstance(document, dict):
+        return _lookup(document.get(parts[0], _MISSING), parts[1:]) if parts[0] in document else [_MISSING]
+    if isinstance(document, list):
+        values = []
+        if parts[0].isdigit():
+            index = int(parts[0])
+            values.extend(_lookup(document[index], parts[1:]) if index < len(document) else [_MISSING])
+        for item in document:
+            if isinstance(item, dict):
+                values.extend(_lookup(item, parts))
+        return values or [_MISSING]
+    return [_MISSING]
+
+
+def _expand(values):
+    '''Candidates a query condition is evaluated against: each value reached along with the elements of the arrays
+    '''
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+# -------------------------------------------------------------------------------------------------------------------
+# Queries
+# -------------------------------------------------------------------------------------------------------------------
+
+def _regex(value):
+    if isinstance(value, _PATTERN_TYPE):
+        return value
+    if isinstance(value, Regex):
+        return value.try_compile()
+    raise NotImplementedError(f"Unsupported regex '{value}'")
+
+
+def _compile_regex(pattern, options=''):
+    if isinstance(pattern, (_PATTERN_TYPE, Regex)):
+        return _regex(pattern)
+    flags = 0
+    for option in options:
+        flags |= {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}[option]
+    return re.compile(pattern, flags)
+
+
+def _is_operator_dict(value):
+    return isinstance(value, dict) and value and all(key.startswith('$') for key in value)
+
+
+def _match_operator(operator, argument, values, condition):
+    '''Evaluate a single query operator against the values reached by the path of the field
+    '''
+    if operator == '$eq':
+        return _match_equality(argument, values)
+    if operator == '$ne':
+        return not _match_equality(argument, values)
+    if operator == '$in':
+        return any(_match_equality(item, values) for item in argument)
+    if operator == '$nin':
+        return not any(_match_equality(item, values) for item in argument)
+    if operator in ('$gt', '$gte', '$lt', '$lte'):
+        accepted = {'$gt': (1,), '$gte': (0, 1), '$lt': (-1,), '$lte': (-1, 0)}[operator]
+        return any(_compare(value, argument) in accepted for value in _expand(values) if value is not _MISSING)
+    if operator == '$exists':
+        return any(value is not _MISSING for value in values) == bool(argument)
+    if operator == '$not':
+        if isinstance(argument, dict):
+            return not all(_match_operator(key, item, values, argument) for key, item in argument.items())
+        return not _match_operator('$regex', argument, values, {})
+    if operator == '$regex':
+        pattern = _compile_regex(argument, condition.get('$options', ''))
+        return any(isinstance(value, str) and pattern.search(value) for value in _expand(values))
+    if operator == '$options':
+        return True
+    if operator == '$all':
+        return all(_match_equality(item, values) for item in argument)
+    if operator == '$size':
+        return any(isinstance(value, list) and len(value) == argument for value in values)
+    if operator == '$elemMatch':
+        for value in values:
+            for item in value if isinstance(value, list) else []:
+                if _is_operator_dict(argument):
+                    if all(_match_operator(key, arg, [item], argument) for key, arg in argument.items()):
+                        return True
+                elif isinstance(item, dict) and _match(item, argument):
+                    return True
+        return False
+    if operator == '$type':
+        raise NotImplementedError("The memory backend does not support '$type'")
+    raise OperationFailure(f"unknown operator: {operator}", code=BAD_VALUE)
+
+
+def _match_equality(expected, values):
+    if isinstance(expected, (_PATTERN_TYPE, Regex)):
+        return _match_operator('$regex', expected, values, {})
+    if expected is None:
+        return any(value is _MISSING or value is None for value in _expand(values))
+    return any(_equal(value, expected) for value in _expand(values) if value is not _MISSING)
+
+
+def _match_condition(document, path, condition):
+    values = _lookup(document, _split(path))
+    if _is_operator_dict(condition):
+        return all(_match_operator(operator, argument, values, condition) for operator, argument in condition.items())
+    return _match_equality(condition, values)
+
+
+def _match(document, query):
+    '''Check whether a document matches a query
+    '''
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(_match(document, sub_query) for sub_query in condition):
+                return False
+        elif key == '$or':
+            if not any(_match(document, sub_query) for sub_query in condition):
+                return False
+        elif key == '$nor':
+            if any(_match(document, sub_query) for sub_query in condition):
+                return False
+        elif key in ('$comment', '$isolated'):
+            continue
+        elif key.startswith('$'):
+            raise NotImplementedError(f"The memory backend does not support the query operator '{key}'")
+        elif not _match_condition(document, key, condition):
+            return False
+    return True
+
+
+# -------------------------------------------------------------------------------------------------------------------
+# Updates
+# -------------------------------------------------------------------------------------------------------------------
+
+def _parent_of(document, path, create):
+    '''Return the container holding the last part of the path and that part, creating intermediate documents if
+    required. Return (None, None) if the path cannot be reached
+    '''
+    parts = _split(path)
+    container = document
+    for part in parts[:-1]:
+        if isinstance(container, list):
+            if not part.isdigit():
+                raise WriteError(f"Cannot create field '{part}' in element {{{path}: {container!r}}}",
+                                 code=TYPE_MISMATCH)
+            index = int(part)
+            while create and len(container) <= index:
+                container.append(None)
+            if index >= len(container):
+                return None, None
+            if container[index] is None and create:
+                container[index] = {}
+            container = container[index]
+        elif isinstance(container, dict):
+            if part not in container or container[part] is None:
+                if not create:
+                    return None, None
+                container[part] = {}
+            container = container[part]
+        else:
+            raise WriteError(f"Cannot create field '{part}' in element {{{path}: {container!r}}}",
+                             code=TYPE_MISMATCH)
+    return container, parts[-1]
+
+
+def _get(container, key):
+    if isinstance(container, list):
+        index = int(key)
+        return container[index] if index < len(container) else _MISSING
+    return container.get(key, _MISSING)
+
+
+def _put(container, key, value):
+    if isinstance(container, list):
+        if not key.isdigit():
+            raise WriteError(f"Cannot create field '{key}' in an array", code=TYPE_MISMATCH)
+        index = int(key)
+        while len(container) <= index:
+            container.append(None)
+        container[index] = value
+    elif isinstance(container, dict):
+        container[key] = value
+    else:
+        raise WriteError(f"Cannot create field '{key}' in element {container!r}", code=TYPE_MISMATCH)
+
+
+def _array_at(document, path, operator):
+    container, key = _parent_of(document, path, create=True)
+    current = _get(container, key)
+    if current is _MISSING or current is None:
+        current = []
+        _put(container, key, current)
+    elif not isinstance(current, list):
+        raise WriteError(f"The field '{path}' must be an array but is of type {type(current).__name__} in document "
+                         f"{{_id: {document.get('_id')!r}}}", code=TYPE_MISMATCH if operator != '$push' else 2)
+    return current
+
+
+def _each(argument):
+    if isinstance(argument, dict) and '$each' in argument:
+        return argument['$each'], argument
+    return [argument], {}
+
+
+def _apply_update(document, update, is_insert):
+    '''Apply an update document to 'document' in place
+    '''
+    for operator, fields in update.items():
+        if not isinstance(fields, dict):
+            raise WriteError(f"Modifiers operate on fields but we found type {type(fields).__name__} instead.",
+                             code=FAILED_TO_PARSE)
+        if not fields:
+            raise WriteError(f"'{operator}' is empty. You must specify a field like so: {{{operator}: {{<field>: "
+                             f"...}}}}", code=FAILED_TO_PARSE)
+
+    paths = [path for fields in update.values() for path in fields]
+    for index, path in enumerate(paths):
+        for other in paths[index + 1:]:
+            if path == other or other.startswith(path + '.') or path.startswith(other + '.'):
+                raise WriteError(f"Updating the path '{other}' would create a conflict at '{path}'",
+                                 code=CONFLICTING_UPDATE_OPERATORS)
+
+    for operator, fields in update.items():
+        if operator == '$setOnInsert' and not is_insert:
+            continue
+        for path, argument in fields.items():
+            argument = _copy_in(argument)
+            if operator in ('$set', '$setOnInsert'):
+                container, key = _parent_of(document, path, create=True)
+                _put(container, key, argument)
+            elif operator == '$unset':
+                container, key = _parent_of(document, path, create=False)
+                if isinstance(container, dict):
+                    container.pop(key, None)
+                elif isinstance(container, list) and key.isdigit() and int(key) < len(container):
+                    container[int(key)] = None
+            elif operator in ('$inc', '$mul'):
+                container, key = _parent_of(document, path, create=True)
+                current = _get(container, key)
+                if current is _MISSING:
+                    current = 0
+                if _type_rank(current) != 2 or _type_rank(argument) != 2:
+                    raise WriteError(f"Cannot apply {operator} to a value of non-numeric type. {{_id: "
+                                     f"{document.get('_id')!r}}} has the field '{path}' of non-numeric type "
+                                     f"{type(current).__name__}", code=TYPE_MISMATCH)
+                _put(container, key, current + argument if operator == '$inc' else current * argument)
+            elif operator in ('$min', '$max'):
+                container, key = _parent_of(document, path, create=True)
+                current = _get(container, key)
+                if current is _MISSING or (_sort_key(argument) < _sort_key(current) if operator == '$min' else
+                                           _sort_key(argument) > _sort_key(current)):
+                    _put(container, key, argument)
+            elif operator == '$push':
+                array = _array_at(document, path, operator)
+                values, modifiers = _each(argument)
+                position = modifiers.get('$position')
+                if position is None:
+                    array.extend(values)
+                else:
+                    array[position:position] = values
+                if '$slice' in modifiers:
+                    limit = modifiers['$slice']
+                    array[:] = array[:limit] if limit >= 0 else array[limit:]
+            elif operator == '$addToSet':
+                array = _array_at(document, path, operator)
+                values, _ = _each(argument)
+                for value in values:
+                    if not any(_equal(value, item) for item in array):
+                        array.append(value)
+            elif operator in ('$pull', '$pullAll'):
+                container, key = _parent_of(document, path, create=False)
+                array = _get(container, key) if container is not None else _MISSING
+                if array is _MISSING:
+                    continue
+                if not isinstance(array, list):
+                    raise WriteError(f"Cannot apply {operator} to a non-array value", code=BAD_VALUE)
+                if operator == '$pullAll':
+                    array[:] = [item for item in array if not any(_equal(item, value) for value in argument)]
+                elif _is_operator_dict(argument):
+                    array[:] = [item for item in array
+                                if not all(_match_operator(op, arg, [item], argument) for op, arg in argument.items())]
+                elif isinstance(argument, dict):
+                    array[:] = [item for item in array if not (isinstance(item, dict) and _match(item, argument))]
+                else:
+                    array[:] = [item for item in array if not _match_equality(argument, [item])]
+            elif operator == '$currentDate':
+                container, key = _parent_of(document, path, create=True)
+                _put(container, key, _copy_in(datetime.datetime.utcnow()))
+            else:
+                raise WriteError(f"Unknown modifier: {operator}. Expected a valid update modifier or pipeline-style "
+                                 f"update specified as an array", code=FAILED_TO_PARSE)
+
+
+def _upsert_seed(query):
+    '''Document an upsert starts from: the fields of the query compared by equality
+    '''
+    document = {}
+    for key, condition in query.items():
+        if key == '$and':
+            for sub_query in condition:
+                document.update(_upsert_seed(sub_query))
+        elif key.startswith('$'):
+            continue
+        elif _is_operator_dict(condition):
+            if '$eq' in condition:
+                container, last = _parent_of(document, key, create=True)
+                _put(container, last, _copy_in(condition['$eq']))
+            elif '$in' in condition and len(condition['$in']) == 1:
+                container, last = _parent_of(document, key, create=True)
+                _put(container, last, _copy_in(condition['$in'][0]))
+        elif not isinstance(condition, (_PATTERN_TYPE, Regex)):
+            container, last = _parent_of(document, key, create=True)
+            _put(container, last, _copy_in(condition))
+    return document
+
+
+def _validate_update(update):
+    if not isinstance(update, dict) or not update:
+        raise ValueError('update cannot be empty')
+    if not all(key.startswith('$') for key in update):
+        raise ValueError('update only works with $ operators')
+
+
+def _validate_replacement(replacement):
+    if any(key.startswith('$') for key in replacement):
+        raise ValueError('replacement can not include $ operators')
+
+
+# -------------------------------------------------------------------------------------------------------------------
+# Projections
+# -------------------------------------------------------------------------------------------------------------------
+
+def _normalize_projection(projection):
+    if projection is None:
+        return None
+    if isinstance(projection, (list, tuple)):
+        projection = {field: True for field in projection}
+    return dict(projection)
+
+
+def _include(document, parts):
+    if not parts:
+        return _copy_out(document)
+    if isinstance(document, list):
+        items = [_include(item, parts) for item in document if isinstance(item, (dict, list))]
+        return [item for item in items if item is not _MISSING]
+    if not isinstance(document, dict) or parts[0] not in document:
+        return _MISSING
+    return {parts[0]: _include(document[parts[0]], parts[1:])} if len(parts) > 1 else \
+        {parts[0]: _copy_out(document[parts[0]])}
+
+
+def _merge(target, source):
+    for key, value in source.items():
+        if key in target and isinstance(target[key], dict) and isinstance(value, dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+def _exclude(document, parts):
+    if isinstance(document, list):
+        for item in document:
+            _exclude(item, parts)
+    elif isinstance(document, dict):
+        if len(parts) == 1:
+            document.pop(parts[0], None)
+        elif parts[0] in document:
+            _exclude(document[parts[0]], parts[1:])
+
+
+def _project(document, projection):
+    if not projection:
+        return _copy_out(document)
+    include_id = bool(projection.get('_id', True))
+    fields = {key: value for key, value in projection.items() if key != '_id'}
+    for value in fields.values():
+        if isinstance(value, dict):
+            raise NotImplementedError(f"The memory backend does not support projection operators: {value}")
+    if any(fields.values()):
+        result = {'_id': document['_id']} if include_id and '_id' in document else {}
+        for path in fields:
+            included = _include(document, _split(path))
+            if isinstance(included, dict):
+                _merge(result, included)
+        return result
+    result = _copy_out(document)
+    for path in fields:
+        _exclude(result, _split(path))
+    if not include_id:
+        result.pop('_id', None)
+    return result
+
+
+# -------------------------------------------------------------------------------------------------------------------
+# Aggregation
+# -------------------------------------------------------------------------------------------------------------------
+
+def _evaluate(expression, document, variables):
+    '''Evaluate an aggregation expression against a document
+    '''
+    if isinstance(expression, str) and expression.startswith('$$'):
+        name, _, path = expression[2:].partition('.')
+        value = variables[name] if name != 'ROOT' else document
+        return _single(_lookup(value, _split(path))) if path else value
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _single(_lookup(document, _split(expression[1:])))
+    if isinstance(expression, list):
+        return [_evaluate(item, document, variables) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if not _is_operator_dict(expression):
+        return {key: _evaluate(value, document, variables) for key, value in expression.items()}
+
+    operator, argument = next(iter(expression.items()))
+    if operator == '$literal':
+        return argument
+    if operator == '$map':
+        items = _evaluate(argument['input'], document, variables)
+        if items is None:
+            return None
+        name = argument.get('as', 'this')
+        return [_evaluate(argument['in'], document, dict(variables, **{name: item})) for item in items]
+    if operator == '$cond':
+        if isinstance(argument, dict):
+            argument = [argument['if'], argument['then'], argument['else']]
+        condition, then, otherwise = argument
+        return _evaluate(then if _truthy(_evaluate(condition, document, variables)) else otherwise, document,
+                         variables)
+    arguments = argument if isinstance(argument, list) else [argument]
+    values = [_evaluate(item, document, variables) for item in arguments]
+    if operator == '$ifNull':
+        return next((value for value in values if value is not None), values[-1])
+    if operator in ('$sum', '$add'):
+        if operator == '$sum' and len(values) == 1 and isinstance(values[0], list):
+            values = values[0]
+        return sum(value for value in values if _type_rank(value) == 2)
+    if operator == '$strLenBytes':
+        return len(values[0].encode('utf-8'))
+    if operator == '$size':
+        return len(values[0])
+    if operator in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte'):
+        order = _compare(values[0], values[1])
+        if order is None:
+            order = (_sort_key(values[0]) > _sort_key(values[1])) - (_sort_key(values[0]) < _sort_key(values[1]))
+        return {'$eq': order == 0, '$ne': order != 0, '$gt': order > 0, '$gte': order >= 0, '$lt': order < 0,
+                '$lte': order <= 0}[operator]
+    if operator == '$subtract':
+        if isinstance(values[0], datetime.datetime) and isinstance(values[1], datetime.datetime):
+            return int((values[0] - values[1]).total_seconds() * 1000)
+        return values[0] - values[1]
+    if operator in ('$min', '$max'):
+        values = values[0] if len(values) == 1 and isinstance(values[0], list) else values
+        values = [value for value in values if value is not None]
+        return (min if operator == '$min' else max)(values, key=_sort_key) if values else None
+    raise NotImplementedError(f"The memory backend does not support the aggregation operator '{operator}'")
+
+
+def _single(values):
+    values = [value for value in values if value is not _MISSING]
+    if not values:
+        return None
+    return values[0] if len(values) == 1 else values
+
+
+def _truthy(value):
+    return value not in (None, False, 0) and value is not _MISSING
+
+
+_ACCUMULATORS = ('$sum', '$min', '$max', '$first', '$last', '$push', '$addToSet', '$avg')
+
+
+def _group(documents, spec):
+    groups = collections.OrderedDict()
+    for document in documents:
+        group_id = _evaluate(spec['_id'], document, {})
+        state = groups.setdefault(_hash_key(group_id), {'_id': group_id, '_values': collections.defaultdict(list)})
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            operator, expression = next(iter(accumulator.items()))
+            if operator not in _ACCUMULATORS:
+                raise NotImplementedError(f"The memory backend does not support the accumulator '{operator}'")
+            state['_values'][field].append(_evaluate(expression, document, {}))
+
+    results = []
+    for state in groups.values():
+        result = {'_id': state['_id']}
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            operator = next(iter(accumulator))
+            values = state['_values'][field]
+            numbers = [value for value in values if _type_rank(value) == 2]
+            present = [value for value in values if value is not None]
+            if operator == '$sum':
+                result[field] = sum(numbers)
+            elif operator == '$avg':
+                result[field] = sum(numbers) / len(numbers) if numbers else None
+            elif operator in ('$min', '$max'):
+                result[field] = (min if operator == '$min' else max)(present, key=_sort_key) if present else None
+            elif operator == '$first':
+                result[field] = values[0]
+            elif operator == '$last':
+                result[field] = values[-1]
+            elif operator == '$push':
+                result[field] = values
+            else:
+                unique = collections.OrderedDict((_hash_key(value), value) for value in values)
+                result[field] = list(unique.values())
+        results.append(result)
+    return results
+
+
+def _unwind(documents, spec):
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = _split(spec['path'][1:])
+    preserve = spec.get('preserveNullAndEmptyArrays', False)
+    for document in documents:
+        container, key = _parent_of(document, '.'.join(path), create=False)
+        value = _get(container, key) if container is not None else _MISSING
+        if isinstance(value, list) and value:
+            for item in value:
+                unwound = _copy_out(document)
+                target, last = _parent_of(unwound, '.'.join(path), create=True)
+                _put(target, last, item)
+                yield unwound
+        elif isinstance(value, list) or value is _MISSING or value is None:
+            if preserve:
+                yield document
+        else:
+            yield document
+
+
+def _sorted(documents, keys):
+    documents = list(documents)
+    for field, direction in reversed(keys):
+        parts = _split(field)
+        documents.sort(key=lambda document: _sort_key(_single(_lookup(document, parts))), reverse=direction < 0)
+    return documents
+
+
+def _run_pipeline(documents, pipeline):
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == '$match':
+            documents = [document for document in documents if _match(document, spec)]
+        elif name in ('$project', '$addFields', '$set'):
+            projected = []
+            for document in documents:
+                if name == '$project':
+                    exclusion = all(not value for key, value in spec.items() if key != '_id' and
+                                    isinstance(value, (bool, int)))
+                    if exclusion and not any(isinstance(value, (dict, str, list)) for value in spec.values()):
+                        projected.append(_project(document, spec))
+                        continue
+                    result = {'_id': document['_id']} if spec.get('_id', True) and '_id' in document else {}
+                else:
+                    result = _copy_out(document)
+                for key, value in spec.items():
+                    if key == '_id' and isinstance(value, (bool, int)):
+                        continue
+                    if isinstance(value, bool) or (isinstance(value, int) and name == '$project'):
+                        if value:
+                            included = _include(document, _split(key))
+                            if isinstance(included, dict):
+                                _merge(result, included)
+                    else:
+                        container, last = _parent_of(result, key, create=True)
+                        _put(container, last, _evaluate(value, document, {}))
+                projected.append(result)
+            documents = projected
+        elif name == '$group':
+            documents = _group(documents, spec)
+        elif name in ('$replaceRoot', '$replaceWith'):
+            new_root = spec['newRoot'] if name == '$replaceRoot' else spec
+            documents = [_evaluate(new_root, document, {}) for document in documents]
+        elif name == '$unwind':
+            documents = list(_unwind(documents, spec))
+        elif name == '$sort':
+            documents = _sorted(documents, list(spec.items()))
+        elif name == '$skip':
+            documents = documents[spec:]
+        elif name == '$limit':
+            documents = documents[:spec]
+        elif name == '$count':
+            documents = [{spec: len(documents)}] if documents else []
+        else:
+            raise NotImplementedError(f"The memory backend does not support the aggregation stage '{name}'")
+    return documents
+
+
+# -------------------------------------------------------------------------------------------------------------------
+# Cursors, collections, databases and clients
+# -------------------------------------------------------------------------------------------------------------------
+
+class MemoryCursor:
+    '''Cursor over the documents matching a query. Results are computed from a snapshot taken on the first iteration.
+
+    Tailable cursors over capped collections keep the insertion number of the last document looked at once exhausted,
+    and return the matching documents inserted afterwards on the next iteration. Awaiting ones block until a document is
+    inserted or 'max_await_time_ms' elapses, as a 'getMore' does on the server.
+    '''
+
+    def __init__(self, collection, filter=None, projection=None, skip=0, limit=0, sort=None, batch_size=0,
+                 cursor_type=CursorType.NON_TAILABLE, **kwargs):
+        self.collection = collection
+        self._filter = filter or {}
+        self._projection = _normalize_projection(projection)
+        self._skip = skip
+        self._limit = limit
+        self._sort = list(sort) if sort else []
+        self._batch_size = batch_size
+        self._results = None
+        self._position = 0
+        self._tailable = cursor_type in (CursorType.TAILABLE, CursorType.TAILABLE_AWAIT)
+        self._await = cursor_type == CursorType.TAILABLE_AWAIT
+        self._await_seconds = 1.0
+        self._last_sequence = None  # Insertion number of the last document looked at by a tailable cursor
+        self._dead = False
+        if self._tailable and not collection.options_.get('capped'):
+            raise OperationFailure('tailable cursor requested on non capped collection', BAD_VALUE)
+
+    def _check_not_started(self):
+        if self._results is not None:
+            raise OperationFailure('cannot set options after executing query')
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        self._check_not_started()
+        self._sort = [(key_or_list, direction)] if isinstance(key_or_list, str) else list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._check_not_started()
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._check_not_started()
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size
+        return self
+
+    def hint(self, index):
+        return self
+
+    def comment(self, comment):
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        return self
+
+    def max_await_time_ms(self, max_await_time_ms):
+        if max_await_time_ms is not None:
+            self._await_seconds = max_await_time_ms / 1000
+        return self
+
+    def collation(self, collation):
+        if collation is not None:
+            raise NotImplementedError('The memory backend does not support collations')
+        return self
+
+    def allow_disk_use(self, allow_disk_use):
+        return self
+
+    def where(self, code):
+        raise NotImplementedError("The memory backend does not support '$where'")
+
+    def clone(self):
+        return MemoryCursor(self.collection, self._filter, self._projection, self._skip, self._limit, self._sort,
+                            self._batch_size)
+
+    def rewind(self):
+        self._results = None
+        self._position = 0
+        return self
+
+    def close(self):
+        self._results = []
+        self._position = 0
+        self._dead = True
+
+    @property
+    def alive(self):
+        if self._tailable:
+            return not self._dead
+        return self._results is None or self._position < len(self._results)
+
+    def _execute(self):
+        if self._results is None:
+            if self._tailable:
+                return self._tail()
+            documents = self.collection._find_documents(self._filter, self._sort)
+            documents = documents[self._skip:]
+            if self._limit:
+                documents = documents[:abs(self._limit)]
+            self._results = [_project(document, self._projection) for document in documents]
+            document_class = self.collection.codec_options.document_class
+            if document_class is not dict:
+                self._results = [document_class(bson.BSON.encode(document)) for document in self._results]
+        return self._results
+
+    def __iter__(self):
+        return self
+
+    def _tail(self):
+        '''Return the matching documents inserted after the last one looked at, in insertion order. The cursor dies if
+        the collection was empty when first executed, or if the last document looked at was overwritten since
+        '''
+        collection = self.collection
+        with collection._lock:
+            if self._last_sequence is None:
+                if not collection._documents:
+                    self._dead = True
+                documents = list(collection._documents.values())
+            else:
+                documents = collection._inserted_after(self._last_sequence)
+                if documents is None:
+                    self._dead = True
+                    raise OperationFailure('CollectionScan died due to position in capped collection being deleted',
+                                           CAPPED_POSITION_LOST)
+            if documents:
+                self._last_sequence = collection._sequence[_hash_key(documents[-1]['_id'])]
+            elif self._last_sequence is None:
+                self._last_sequence = -1
+        self._results = [_project(document, self._projection) for document in documents
+                         if _match(document, self._filter)]
+        self._position = 0
+        return self._results
+
+    def __next__(self):
+        results = self._execute()
+        if self._position >= len(results) and self._tailable and not self._dead:
+            results = self._tail()
+            if not results and self._await and not self._dead:
+                with self.collection._inserted:
+                    self.collection._inserted.wait_for(
+                        lambda: self.collection._counter_value > self._last_sequence + 1, self._await_seconds)
+                results = self._tail()
+        if self._position >= len(results):
+            raise StopIteration
+        self._position += 1
+        return results[self._position - 1]
+
+    next = __next__
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step is not None:
+                raise IndexError('Cursor instances do not support slice steps')
+            cursor = self.clone()
+            start = index.start or 0
+            cursor._skip = self._skip + start
+            if index.stop is not None:
+                cursor._limit = max(index.stop - start, 0) or -1
+            return cursor
+        cursor = self.clone()
+        cursor._skip = self._skip + index
+        cursor._limit = -1
+        for document in cursor:
+            return document
+        raise IndexError('no such item for Cursor instance')
+
+    def count(self, with_limit_and_skip=False):
+        documents = self.collection._find_documents(self._filter, None)
+        if with_limit_and_skip:
+            documents = documents[self._skip:]
+            if self._limit:
+                documents = documents[:abs(self._limit)]
+        return len(documents)
+
+    def distinct(self, key):
+        return self.collection.distinct(key, self._filter)
+
+    def explain(self):
+        return {'queryPlanner': {'winningPlan': {'stage': self.collection._plan(self._filter)[0]}}}
+
+
+class _Index:
+    def __init__(self, name, keys, unique=False, sparse=False):
+        self.name = name
+        self.keys = keys
+        self.fields = [_split(field) for field, _ in keys]
+        self.unique = unique
+        self.sparse = sparse
+        self.entries = {}  # Unique key -> '_id' of the document holding it
+
+    def unique_keys(self, document):
+        '''Return the index keys of a document, one per combination of the elements of the arrays indexed
+        '''
+        values = []
+        for parts in self.fields:
+            reached = _lookup(document, parts)
+            if all(value is _MISSING for value in reached):
+                if self.sparse:
+                    return []
+                reached = [None]
+            candidates = []
+            for value in reached:
+                value = None if value is _MISSING else value
+                candidates.extend(value if isinstance(value, list) and value else [value])
+            values.append({_hash_key(value): value for value in candidates}.keys())
+        return set(itertools.product(*values))
+
+
+class MemoryCollection:
+    '''Collection that keeps its documents in a dictionary keyed by '_id', in insertion order, along with a hash index
+    on every field of its indexes
+    '''
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self._documents = collections.OrderedDict()
+        self._indexes = collections.OrderedDict()
+        self._hashed = {}  # Indexed field -> value key -> set of document keys
+        self._sequence = {}  # Document key -> insertion number, so that candidates found by index keep natural order
+        self._counter = itertools.count()
+        self._counter_value = 0  # Next insertion number
+        self._lock = threading.RLock()
+        self._inserted = threading.Condition(self._lock)  # Notified on every insertion, for awaiting tailable cursors
+        self._sizes = collections.OrderedDict()  # Document key -> BSON size, only kept for capped collections
+        self.options_ = {}
+
+    def __getitem__(self, name):
+        return self.database[f"{self.name}.{name}"]
+
+    def __repr__(self):
+        return f"MemoryCollection({self.database!r}, {self.name!r})"
+
+    def with_options(self, codec_options=None, **kwargs):
+        '''Return this collection, or a copy sharing its storage that returns documents of the class given by
+        'codec_options', such as RawBSONDocument
+        '''
+        if codec_options is None or codec_options.document_class is self.codec_options.document_class:
+            return self
+        collection = copy.copy(self)
+        collection.codec_options = codec_options
+        return collection
+
+    codec_options = bson.codec_options.DEFAULT_CODEC_OPTIONS
+    write_concern = WriteConcern()
+    read_preference = ReadPreference.PRIMARY
+    read_concern = ReadConcern()
+
+    def options(self):
+        return dict(self.options_)
+
+    # Indexes
+
+    def create_index(self, keys, unique=False, sparse=False, name=None, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, ASCENDING)]
+        keys = [(field, direction) for field, direction in keys]
+        name = name or '_'.join(f"{field}_{direction}" for field, direction in keys)
+        with self._lock:
+            existing = self._indexes.get(name)
+            if existing:
+                return name
+            index = _Index(name, keys, unique=unique, sparse=sparse)
+            if unique:
+                for document in self._documents.values():
+                    for key in index.unique_keys(document):
+                        if key in index.entries:
+                            raise DuplicateKeyError(self._duplicate_message(index, key), DUPLICATE_KEY_ERROR)
+                        index.entries[key] = document['_id']
+            self._indexes[name] = index
+            self._hash_fields([field for field, _ in keys])
+        return name
+
+    def create_indexes(self, indexes):
+        return [self.create_index(index.document['key'].items(),
+                                  **{key: value for key, value in index.document.items() if key != 'key'})
+                for index in indexes]
+
+    def ensure_index(self, keys, **kwargs):
+        return self.create_index(keys, **kwargs)
+
+    def index_information(self):
+        information = {'_id_': {'key': [('_id', ASCENDING)], 'v': 2}}
+        for name, index in self._indexes.items():
+            information[name] = {'key': list(index.keys), 'v': 2}
+            if index.unique:
+                information[name]['unique'] = True
+            if index.sparse:
+                information[name]['sparse'] = True
+        return information
+
+    def list_indexes(self):
+        return iter([dict(value, name=name) for name, value in self.index_information().items()])
+
+    def drop_index(self, index_or_name):
+        with self._lock:
+            name = index_or_name if isinstance(index_or_name, str) else \
+                '_'.join(f"{field}_{direction}" for field, direction in index_or_name)
+            if name not in self._indexes:
+                raise OperationFailure(f"index not found with name [{name}]", code=27)
+            del self._indexes[name]
+            self._rebuild_hashes()
+
+    def drop_indexes(self):
+        with self._lock:
+            self._indexes.clear()
+            self._hashed.clear()
+
+    def _rebuild_hashes(self):
+        self._hashed = {}
+        for index in self._indexes.values():
+            self._hash_fields([field for field, _ in index.keys])
+
+    def _hash_fields(self, fields):
+        for field in fields:
+            if field != '_id' and field not in self._hashed:
+                entries = self._hashed[field] = {}
+                for document_key, document in self._documents.items():
+                    for key in self._field_keys(document, field):
+                        entries.setdefault(key, set()).add(document_key)
+
+    @staticmethod
+    def _field_keys(document, field):
+        keys = set()
+        for value in _lookup(document, _split(field)):
+            value = None if value is _MISSING else value
+            keys.add(_hash_key(value))
+            if isinstance(value, list):
+                keys.update(_hash_key(item) for item in value)
+        return keys
+
+    def _duplicate_message(self, index, key):
+        fields = ', '.join(f"{field}: {value!r}" for (field, _), value in zip(index.keys, key))
+        return f"E11000 duplicate key error collection: {self.full_name} index: {index.name} dup key: {{ {fields} }}"
+
+    def _index_document(self, document):
+        document_id = document['_id']
+        document_key = _hash_key(document_id)
+        for field, entries in self._hashed.items():
+            for key in self._field_keys(document, field):
+                entries.setdefault(key, set()).add(document_key)
+        for index in self._indexes.values():
+            if index.unique:
+                for key in index.unique_keys(document):
+                    index.entries[key] = document_id
+
+    def _unindex_document(self, document):
+        document_id = document['_id']
+        document_key = _hash_key(document_id)
+        for field, entries in self._hashed.items():
+            for key in self._field_keys(document, field):
+                keys = entries.get(key)
+                if keys is not None:
+                    keys.discard(document_key)
+                    if not keys:
+                        del entries[key]
+        for index in self._indexes.values():
+            if index.unique:
+                for key in index.unique_keys(document):
+                    if index.entries.get(key) == document_id:
+                        del index.entries[key]
+
+    def _check_unique(self, document, replaced_id=_MISSING):
+        '''Raise DuplicateKeyError if storing 'document' would violate a unique index. 'replaced_id' is the '_id' of the
+        document being replaced, if any
+        '''
+        document_id = document['_id']
+        if replaced_id is _MISSING and _hash_key(document_id) in self._documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: _id_ dup key: "
+                                    f"{{ _id: {document_id!r} }}", DUPLICATE_KEY_ERROR)
+        for index in self._indexes.values():
+            if index.unique:
+                for key in index.unique_keys(document):
+                    holder = index.entries.get(key, _MISSING)
+                    if holder is not _MISSING and holder != document_id:
+                        raise DuplicateKeyError(self._duplicate_message(index, key), DUPLICATE_KEY_ERROR)
+
+    # Queries
+
+    def _plan(self, query):
+        '''Return the name of the access path chosen for a query along with the candidate documents
+        '''
+        keys = self._candidate_keys(query)
+        if keys is None:
+            return 'COLLSCAN', list(self._documents.values())
+        keys = [key for key in keys if key in self._documents]
+        if len(keys) > 1:
+            keys.sort(key=self._sequence.__getitem__)
+        return 'IXSCAN', [self._documents[key] for key in keys]
+
+    def _candidate_keys(self, query):
+        '''Return the keys of the documents that may match the query according to the hash indexes, or None if no index
+        can narrow them down
+        '''
+        best = None
+        for field, condition in query.items():
+            if field == '$and':
+                for sub_query in condition:
+                    ids = self._candidate_keys(sub_query)
+                    if ids is not None and (best is None or len(ids) < len(best)):
+                        best = ids
+                continue
+            if field != '_id' and field not in self._hashed:
+                continue
+            if _is_operator_dict(condition):
+                if '$eq' in condition:
+                    values = [condition['$eq']]
+                elif '$in' in condition:
+                    values = condition['$in']
+                else:
+                    continue
+            elif isinstance(condition, (_PATTERN_TYPE, Regex)) or condition is None:
+                continue
+            else:
+                values = [condition]
+            if any(isinstance(value, (_PATTERN_TYPE, Regex)) or value is None for value in values):
+                continue
+            if field == '_id':
+                ids = {_hash_key(value) for value in values}
+            else:
+                entries = self._hashed[field]
+                ids = set()
+                for value in values:
+                    ids.update(entries.get(_hash_key(value), ()))
+            if best is None or len(ids) < len(best):
+                best = ids
+        return best
+
+    def _find_documents(self, query, sort):
+        with self._lock:
+            _, candidates = self._plan(query)
+            documents = [document for document in candidates if _match(document, query)]
+        if sort:
+            documents = _sorted(documents, sort)
+        return documents
+
+    def find(self, *args, **kwargs):
+        if args and not isinstance(args[0], dict) and args[0] is not None:
+            raise TypeError('filter must be an instance of dict')
+        kwargs.pop('no_cursor_timeout', None)
+        kwargs.pop('session', None)
+        return MemoryCursor(self, *args, **kwargs)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for document in self.find(filter, *args, **kwargs).limit(-1):
+            return document
+        return None
+
+    def count_documents(self, filter, skip=0, limit=0, **kwargs):
+        documents = self._find_documents(filter, None)[skip:]
+        return len(documents[:limit] if limit else documents)
+
+    def estimated_document_count(self, **kwargs):
+        return len(self._documents)
+
+    def count(self, filter=None, **kwargs):
+        return self.count_documents(filter or {})
+
+    def distinct(self, key, filter=None, **kwargs):
+        values = collections.OrderedDict()
+        for document in self._find_documents(filter or {}, None):
+            for value in _lookup(document, _split(key)):
+                for item in (value if isinstance(value, list) else [value]):
+                    if item is not _MISSING:
+                        values.setdefault((_type_rank(item), _hash_key(item)), item)
+        return [_copy_out(value) for value in values.values()]
+
+    def aggregate(self, pipeline, **kwargs):
+        documents = [_copy_out(document) for document in self._find_documents({}, None)]
+        return iter(_run_pipeline(documents, pipeline))
+
+    # Writes
+
+    def _insert(self, document):
+        if not isinstance(document, dict):
+            raise TypeError('document must be an instance of dict')
+        if '_id' not in document:
+            document['_id'] = bson.ObjectId()
+        stored = _copy_in({'_id': document['_id'], **{key: value for key, value in document.items()
+                                                      if key != '_id'}})
+        self._check_unique(stored)
+        document_key = _hash_key(stored['_id'])
+        self._documents[document_key] = stored
+        self._sequence[document_key] = self._counter_value = next(self._counter)
+        self._counter_value += 1
+        self._index_document(stored)
+        if self.options_.get('capped'):
+            self._sizes[document_key] = len(bson.BSON.encode(stored))
+            self._evict()
+        self._inserted.notify_all()
+        return stored['_id']
+
+    def _evict(self):
+        '''Remove the oldest documents of a capped collection until it fits within its 'size' and 'max' options
+        '''
+        max_size, max_documents = self.options_.get('size') or 0, self.options_.get('max') or 0
+        total = sum(self._sizes.values())
+        while len(self._documents) > 1 and ((max_size and total > max_size) or
+                                            (max_documents and len(self._documents) > max_documents)):
+            document_key, size = self._sizes.popitem(last=False)
+            total -= size
+            self._unindex_document(self._documents.pop(document_key))
+            del self._sequence[document_key]
+
+    def _inserted_after(self, sequence):
+        '''Return the documents inserted after the given insertion number, in insertion order, or None if some of them
+        were already evicted from the capped collection
+        '''
+        documents = []
+        for document_key in reversed(self._documents):
+            if self._sequence[document_key] <= sequence:
+                break
+            documents.append(self._documents[document_key])
+        else:
+            if documents and self._sequence[_hash_key(documents[-1]['_id'])] > sequence + 1:
+                return None
+        return documents[::-1]
+
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        if not documents:
+            raise TypeError('documents must be a non-empty list')
+        result = self.bulk_write([InsertOne(document) for document in documents], ordered=ordered)
+        return InsertManyResult([document['_id'] for document in documents], result.acknowledged)
+
+    def insert(self, doc_or_docs, **kwargs):
+        if isinstance(doc_or_docs, list):
+            return self.insert_many(doc_or_docs).inserted_ids
+        return self.insert_one(doc_or_docs).inserted_id
+
+    def _update(self, query, update, upsert, multi, replacement=False):
+        '''Apply an update to the documents matching the query and return the raw result the server would give
+        '''
+        with self._lock:
+            _, candidates = self._plan(query)
+            matched = [document for document in candidates if _match(document, query)]
+            if not multi:
+                matched = matched[:1]
+            modified = 0
+            for document in matched:
+                if replacement:
+                    updated = _copy_in({'_id': document['_id'], **{key: value for key, value in update.items()
+                                                                   if key != '_id'}})
+                    if '_id' in update and not _equal(update['_id'], document['_id']):
+                        raise WriteError("After applying the update, the (immutable) field '_id' was found to have "
+                                         "been altered", code=IMMUTABLE_FIELD)
+                else:
+                    updated = _copy_out(document)
+                    _apply_update(updated, update, is_insert=False)
+                    if not _equal(updated.get('_id'), document['_id']):
+                        raise WriteError("Performing an update on the path '_id' would modify the immutable field "
+                                         "'_id'", code=IMMUTABLE_FIELD)
+                if _hash_key(updated) != _hash_key(document):
+                    self._replace(document, updated)
+                    modified += 1
+            if matched or not upsert:
+                return {'n': len(matched), 'nModified': modified, 'ok': 1.0, 'updatedExisting': bool(matched)}
+
+            if replacement:
+                inserted = dict(update)
+                if '_id' not in inserted:
+                    seed = _upsert_seed(query)
+                    if '_id' in seed:
+                        inserted['_id'] = seed['_id']
+            else:
+                inserted = _upsert_seed(query)
+                _apply_update(inserted, update, is_insert=True)
+            upserted_id = self._insert(inserted)
+            return {'n': 1, 'nModified': 0, 'ok': 1.0, 'updatedExisting': False, 'upserted': upserted_id}
+
+    def _replace(self, document, updated):
+        self._unindex_document(document)
+        try:
+            self._check_unique(updated, replaced_id=document['_id'])
+        except DuplicateKeyError:
+            self._index_document(document)
+            raise
+        document.clear()
+        document.update(updated)
+        self._index_document(document)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        _validate_update(update)
+        return UpdateResult(self._update(filter, update, upsert, multi=False), True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        _validate_update(update)
+        return UpdateResult(self._update(filter, update, upsert, multi=True), True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        _validate_replacement(replacement)
+        return UpdateResult(self._update(filter, replacement, upsert, multi=False, replacement=True), True)
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        replacement = not any(key.startswith('$') for key in document)
+        return self._update(spec, document, upsert, multi, replacement=replacement)
+
+    def _delete(self, query, multi):
+        with self._lock:
+            _, candidates = self._plan(query)
+            matched = [document for document in candidates if _match(document, query)]
+            if not multi:
+                matched = matched[:1]
+            for document in matched:
+                self._unindex_document(document)
+                document_key = _hash_key(document['_id'])
+                del self._documents[document_key]
+                del self._sequence[document_key]
+                self._sizes.pop(document_key, None)
+            return {'n': len(matched), 'ok': 1.0}
+
+    def delete_one(self, filter, **kwargs):
+        return DeleteResult(self._delete(filter, multi=False), True)
+
+    def delete_many(self, filter, **kwargs):
+        return DeleteResult(self._delete(filter, multi=True), True)
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        return self._delete(spec_or_id or {}, multi)
+
+    def _find_and_modify(self, filter, projection, sort, return_document, modify):
+        with self._lock:
+            documents = self._find_documents(filter, list(sort) if sort else None)
+            before = _copy_out(documents[0]) if documents else None
+            query = {'_id': before['_id']} if before is not None else filter
+            raw_result = modify(query)
+            if return_document == ReturnDocument.AFTER:
+                document_id = raw_result.get('upserted', before['_id'] if before is not None else _MISSING)
+                after = self._documents.get(_hash_key(document_id)) if document_id is not _MISSING else None
+                return _project(after, _normalize_projection(projection)) if after is not None else None
+            return _project(before, _normalize_projection(projection)) if before is not None else None
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kwargs):
+        _validate_update(update)
+        return self._find_and_modify(filter, projection, sort, return_document,
+                                     lambda query: self._update(query, update, upsert, multi=False))
+
+    def find_one_and_replace(self, filter, replacement, projection=None, sort=None, upsert=False,
+                             return_document=ReturnDocument.BEFORE, **kwargs):
+        _validate_replacement(replacement)
+        return self._find_and_modify(filter, projection, sort, return_document,
+                                     lambda query: self._update(query, replacement, upsert, multi=False,
+                                                                replacement=True))
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        return self._find_and_modify(filter, projection, sort, ReturnDocument.BEFORE,
+                                     lambda query: self._delete(query, multi=False))
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        '''Apply a list of pymongo write operations, reporting the errors of each of them in the same terms as the
+        server does
+        '''
+        requests = list(requests)
+        if not requests:
+            raise OperationFailure('No operations provided', code=BAD_VALUE)
+        result = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0, 'nMatched': 0,
+                  'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self._lock:
+            for index, request in enumerate(requests):
+                try:
+                    if isinstance(request, InsertOne):
+                        self._insert(request._doc)
+                        result['nInserted'] += 1
+                    elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                        replacement = isinstance(request, ReplaceOne)
+                        if replacement:
+                            _validate_replacement(request._doc)
+                        else:
+                            _validate_update(request._doc)
+                        raw_result = self._update(request._filter, request._doc, request._upsert,
+                                                  multi=isinstance(request, UpdateMany), replacement=replacement)
+                        if 'upserted' in raw_result:
+                            result['nUpserted'] += 1
+                            result['upserted'].append({'index': index, '_id': raw_result['upserted']})
+                        else:
+                            result['nMatched'] += raw_result['n']
+                            result['nModified'] += raw_result['nModified']
+                    elif isinstance(request, (DeleteOne, DeleteMany)):
+                        result['nRemoved'] += self._delete(request._filter, isinstance(request, DeleteMany))['n']
+                    else:
+                        raise TypeError(f"{request!r} is not a valid request")
+                except (WriteError, OperationFailure) as ex:
+                    result['writeErrors'].append({'index': index, 'code': ex.code, 'errmsg': str(ex),
+                                                  'op': getattr(request, '_doc', None) or request._filter})
+                    if ordered:
+                        break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def drop(self, **kwargs):
+        self.database.drop_collection(self.name)
+
+    def rename(self, new_name, **kwargs):
+        self.database._rename_collection(self.name, new_name)
+
+
+class MemoryDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = MemoryCollection(self, name)
+            return collection
+
+    def __repr__(self):
+        return f"MemoryDatabase({self.client!r}, {self.name!r})"
+
+    def get_collection(self, name, **kwargs):
+        return self[name]
+
+    def create_collection(self, name, **kwargs):
+        with self._lock:
+            if name in self.list_collection_names():
+                raise OperationFailure(f"Collection {self.name}.{name} already exists", code=48)
+            collection = self[name]
+            collection.options_ = dict(kwargs) or {'create': name}
+            return collection
+
+    def list_collection_names(self, **kwargs):
+        return [name for name, collection in list(self._collections.items())
+                if collection._documents or collection._indexes or collection.options_]
+
+    def collection_names(self, include_system_collections=True):
+        return self.list_collection_names()
+
+    def drop_collection(self, name_or_collection, **kwargs):
+        name = getattr(name_or_collection, 'name', name_or_collection)
+        collection = self._collections.get(name)
+        if collection is not None:
+            # The collection is emptied rather than forgotten so that anyone still holding it, such as the collection
+            # cached by Mongoengine documents, sees it dropped and recreated on the next write as with the server
+            with collection._lock:
+                collection._documents.clear()
+                collection._sequence.clear()
+                collection._sizes.clear()
+                collection._indexes.clear()
+                collection._hashed.clear()
+                collection.options_ = {}
+        return {'ok': 1.0}
+
+    def _rename_collection(self, old_name, new_name):
+        with self._lock:
+            source, target = self[old_name], self[new_name]
+            with source._lock, target._lock:
+                target._documents, source._documents = source._documents, collections.OrderedDict()
+                target._sequence, source._sequence = source._sequence, {}
+                target._counter, source._counter = source._counter, itertools.count()
+                target._counter_value, source._counter_value = source._counter_value, 0
+                target._sizes, source._sizes = source._sizes, collections.OrderedDict()
+                target._indexes, source._indexes = source._indexes, collections.OrderedDict()
+                target._hashed, source._hashed = source._hashed, {}
+                target.options_, source.options_ = source.options_, {}
+
+    def dereference(self, dbref, **kwargs):
+        return self[dbref.collection].find_one({'_id': dbref.id})
+
+    def command(self, command, value=1, **kwargs):
+        if isinstance(command, str):
+            command = {command: value, **kwargs}
+        name = next(iter(command))
+        if name == 'ping':
+            return {'ok': 1.0}
+        if name == 'dropDatabase':
+            self.client.drop_database(self.name)
+            return {'ok': 1.0}
+        raise NotImplementedError(f"The memory backend does not support the command '{name}'")
+
+
+class MemoryClient:
+    '''Stand-in for pymongo's MongoClient holding all databases in the memory of the current process
+    '''
+
+    def __init__(self, host=MEMORY_HOST, *args, **kwargs):
+        self.host = host
+        self.is_primary = True
+        self.address = ('memory', 0)
+        self._databases = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            database = self._databases.get(name)
+            if database is None:
+                database = self._databases[name] = MemoryDatabase(self, name)
+            return database
+
+    def __repr__(self):
+        return f"MemoryClient({self.host!r})"
+
+    def get_database(self, name=None, **kwargs):
+        return self[name]
+
+    def get_default_database(self, default=None, **kwargs):
+        return self[default]
+
+    def list_database_names(self, **kwargs):
+        return list(self._databases)
+
+    def database_names(self):
+        return self.list_database_names()
+
+    def drop_database(self, name_or_database, **kwargs):
+        name = getattr(name_or_database, 'name', name_or_database)
+        with self._lock:
+            database = self._databases.get(name)
+        if database is not None:
+            for collection_name in list(database._collections):
+                database.drop_collection(collection_name)
+
+    def server_info(self, **kwargs):
+        return {'version': '4.0.0', 'versionArray': [4, 0, 0, 0], 'ok': 1.0}
+
+    def close(self):
+        pass
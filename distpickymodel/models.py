@@ -1,15 +1,126 @@
+import contextlib
 import datetime
-import re
+import heapq
+import itertools
+import math
+import threading
+import time
 import six
 import bson
 import mongoengine
+import pymongo
 
-from pymongo import UpdateOne
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateMany, UpdateOne
 from pymongo.errors import BulkWriteError
-from distpickymodel import errors, utils
+from pymongo.collection import ReturnDocument
+from mongoengine.queryset import transform
+from distpickymodel import bloom, connection, errors, raw, retry, utils, validators
 
 SITE_PRE_SAVE_UPDATE_KEYWORD = 'pre_save_update'
-URL_REGEX_STRING = r'(?i)' + utils.url_regex.pattern
+URL_REGEX_STRING = validators.URL_PATTERN
+DEFAULT_CHANGE_RATE = 1.0  # Estimated number of changes per day of a page never fetched before
+CHANGE_RATE_SMOOTHING = 0.3
+MIN_RECRAWL_INTERVAL = datetime.timedelta(hours=1)
+MAX_RECRAWL_INTERVAL = datetime.timedelta(days=30)
+NEVER_FETCHED = datetime.datetime(1970, 1, 1)  # 'next_fetch' of the pages stored before being fetched, due first
+DUPLICATE_KEY_ERROR = 11000
+SEEN_URLS_ERROR_RATE = 0.01
+SEEN_URLS_MIN_CAPACITY = 10000
+SEEN_URLS_COMPACT_EVERY = 1000  # Number of pending urls that triggers the compaction of a seen-url filter
+SEEN_URLS_COMPACT_ATTEMPTS = 3
+SEEN_URLS_ABSENT_SECONDS = 60  # Time during which a site found to have no seen-url filter is not asked again
+MAX_FILTER_BYTES = 15 * 1024 * 1024  # Bit arrays must fit within a single BSON document
+DOCUMENT_VALIDATION_FAILURE = 121
+SCAN_EVENTS_MAX_SIZE = 64 * 1024 * 1024
+SCAN_EVENTS_MAX_DOCUMENTS = 500000
+CAPPED_POSITION_LOST = 136
+
+_bookkeeping = threading.local()  # Pages and rollup increments deferred by 'WebDocuments.batched_bookkeeping'
+_sites_without_filter = {}  # Site id -> monotonic time until which it is assumed to have no seen-url filter
+
+
+def _reference_id(document, field_name):
+    '''Return the id held by a reference field of the given document without dereferencing it
+    '''
+    value = document._data.get(field_name)
+    return getattr(value, 'pk', getattr(value, 'id', value))
+
+
+def _raw_query(model, **filters):
+    '''Return the raw query built from the given Mongoengine filters on a model, restricted to the '_cls' of the model
+    and its subclasses as its QuerySets are, without building a QuerySet
+    '''
+    query = transform.query(_doc_cls=model, **filters)
+    if model._meta.get('allow_inheritance') is True:
+        subclasses = model._subclasses
+        query['_cls'] = subclasses[0] if len(subclasses) == 1 else {'$in': subclasses}
+    return query
+
+
+def _trusts_server_validation(model, trust_server_validation):
+    '''Resolve whether a bulk write of the given model skips client-side validation, either as given per call or, if
+    None, as set for the model
+    '''
+    if trust_server_validation is None:
+        return getattr(model, 'trust_server_validation', False)
+    return trust_server_validation
+
+
+def _insert_many_ignore_duplicates(model, documents, key, trust_server_validation=None):
+    '''Validate all given documents and insert them through a single unordered 'insert_many', so that those clashing
+    with a unique index do not prevent the rest from being inserted. Any error other than a duplicate key, such as a
+    rejection by the validator of the collection, is raised as DbModelOperationError naming the documents rejected,
+    once the documents inserted have been given their ids and flagged as saved.
+
+    :param model: Document class the documents belong to
+    :param documents: list of documents to be inserted
+    :param key: name of the unique field identifying each document
+    :param trust_server_validation: if True, only 'clean' is run on the documents and their validation is left to the
+    validator of the collection, as applied by 'schema.apply_validator'. It defaults to the setting of the model
+    :return: dictionary with the 'inserted_ids' and the values of 'key' of the documents found to be 'duplicates',
+    both in the same order as 'documents'
+    '''
+    trusted = _trusts_server_validation(model, trust_server_validation)
+    for document in documents:
+        if not isinstance(document, model):
+            raise errors.DbModelOperationError(f"Only '{model.__name__}' documents can be inserted. "
+                                               f"Instead '{document.__class__.__name__}'")
+        try:
+            if trusted:
+                document.clean()
+            else:
+                document.validate()
+        except mongoengine.errors.ValidationError as ex:
+            raise errors.DbModelOperationError(f"Document '{document}' with {key} '{document[key]}' is invalid") \
+                from ex
+    if not documents:
+        return {'inserted_ids': [], 'duplicates': []}
+
+    sons = [document.to_mongo() for document in documents]
+    failed, exception = {}, None
+    try:
+        model._get_collection().insert_many(sons, ordered=False)
+    except BulkWriteError as ex:
+        failed = {error['index']: error for error in ex.details['writeErrors']}
+        exception = ex
+
+    inserted_ids, duplicates, rejected = [], [], []
+    for index, (document, son) in enumerate(zip(documents, sons)):
+        error = failed.get(index)
+        if error is None:
+            document.id = son['_id']
+            document._created = False
+            document._clear_changed_fields()
+            inserted_ids.append(document.id)
+        elif error['code'] == DUPLICATE_KEY_ERROR:
+            duplicates.append(document[key])
+        else:
+            rejected.append(document[key])
+    if rejected:
+        raise errors.DbModelOperationError(f"Bulk insert of '{model.__name__}' failed for the documents with {key} "
+                                           f"{rejected} ({exception.details})") from exception
+    return {'inserted_ids': inserted_ids, 'duplicates': duplicates}
 
 
 class StringField(mongoengine.fields.StringField):
@@ -35,13 +146,34 @@ class StringField(mongoengine.fields.StringField):
         if self.min_length is not None and len(value) < self.min_length:
             self.error('String value is too short')
 
-        if self.regex is not None and not re.match(self.regex, value):
+        if self.regex is not None and not validators.matcher_for(self.regex)(value):
             self.error('String value did not match validation regex')
 
 
-class UniquenessMixin(mongoengine.Document):
+class Document(mongoengine.Document):
+    '''Base class of all models of this package. Models reach their client through '_get_db' and '_get_collection',
+    which cache the collection in the class, rather than through 'connection.get_client'. Checking the pid there keeps
+    children forked without 'os.register_at_fork' off the client of their parent
+    '''
+
+    @classmethod
+    def _get_db(cls):
+        connection.reset_if_forked()
+        return super()._get_db()
+
+    @classmethod
+    def _get_collection(cls):
+        connection.reset_if_forked()
+        return super()._get_collection()
+
+    meta = {'abstract': True}
+
+
+class UniquenessMixin(Document):
     '''Mixing class that wraps up Mongonengine's Document class to provide extra functionality
     '''
+    trust_server_validation = False  # Whether bulk writes leave validation to the validator of the collection
+    tracked_fields = ()  # Database fields whose updates are handed to '_after_update'
 
     @property
     def updates(self):
@@ -64,35 +196,300 @@ class UniquenessMixin(mongoengine.Document):
                 raise errors.DbModelOperationError(f"It looks like you are trying to save a {self_name} "
                                                    f"object with a non-empty list of {many_unique}. "
                                                    f"Please use '{self_name.lower()}.save_with_uniqueness()' instead")
-        return super().save(*args, **kwargs)
+        created = self._created
+        self._before_write([self])
+        before = {} if created else self._tracked_before_update([self], self._get_collection())
+        ret = super().save(*args, **kwargs)
+        if created:
+            self._after_insert([self])
+        else:
+            self._report_updates(self._get_collection(), before)
+        return ret
 
-    def save_with_uniqueness(self, many_unique):
+    def save_with_uniqueness(self, many_unique, raw=False):
         '''It performs a save in the same terms as 'Document.save' does however it ensures that the 'add_to_set'
-        modifier is used for the field indicated in many_unique. At present this method only supports one field where
-        to used the add_to_set modifier.
+        modifier is used for the fields indicated in many_unique. Only those elements that have been appended since the
+        document was loaded or last saved are sent, within a single '$addToSet: {field: {$each: [...]}}' per field. If
+        none of the modified fields has anything new to send, no round trip to the database is made.
 
-        :param many_unique: 'List-type' field to which apply the add_to_set_modifier
+        :param many_unique: 'List-type' field or list of fields to which apply the add_to_set_modifier
+        :param raw: if True, the update is sent straight through pymongo's 'update_one' with an update document built
+        from the per-class spec returned by '_update_spec', skipping the construction of a QuerySet and the
+        translation of keyword arguments. Semantics and errors are the same as those of the default path
         '''
-        attribute = getattr(self, many_unique)
+        many_unique = [many_unique] if isinstance(many_unique, str) else list(many_unique)
         self_name = self.__class__.__name__
-        if not len(attribute):
+        self._before_write([self])
+        if not any(len(getattr(self, field)) for field in many_unique):
             raise errors.DbModelOperationError(f"It looks like you are trying to save a {self_name} object with an "
-                                               f"empty list {many_unique}. Please use '{self_name.lower()}.save()' "
-                                               f"instead")
+                                               f"empty list {', '.join(many_unique)}. Please use "
+                                               f"'{self_name.lower()}.save()' instead")
 
         updates, removals = self._delta()
         if not updates:
             raise errors.DbModelOperationError(f"It looks like you are trying to update '{self_name}' "
                                                f"but no fields were modified since this object was created or saved")
-        kwargs = {(key if key != many_unique else 'add_to_set__' + key): value for key, value in updates.items()}
+        db_names = self._update_spec()[0]
+        unique_db_names = {db_names[field]: field for field in many_unique}
+        to_set, to_add = {}, {}
+        for key, value in updates.items():
+            if key in unique_db_names:
+                new_values = self._unsaved_values(key, value)
+                if new_values:
+                    to_add[key] = new_values
+            else:
+                to_set[key] = value
+        if not to_set and not to_add:
+            return self.id
+
         pk = bson.ObjectId() if not self.id else self.id
-        result = self.__class__.objects(id=pk).update_one(upsert=True, full_result=True, **kwargs)
+        before = self._tracked_before_update([self], self._get_collection())
+        if raw:
+            result = self._raw_update_one(pk, to_set, to_add)
+        else:
+            kwargs = dict(to_set)
+            kwargs.update({'add_to_set__' + unique_db_names[key]: values for key, values in to_add.items()})
+            queryset = mongoengine.QuerySet(self.__class__, self._get_collection())
+            result = queryset.filter(id=pk).update_one(upsert=True, full_result=True, **kwargs)
 
         if result.upserted_id:
             self.id = result.upserted_id
+            self._after_insert([self])
+        else:
+            self._report_updates(self._get_collection(), before)
+        self._persisted_lists = dict(getattr(self, '_persisted_lists', {}),
+                                     **{key: updates[key] for key in unique_db_names if key in updates})
 
         return self.id
 
+    @classmethod
+    def _from_son(cls, son, *args, **kwargs):
+        '''Overrides Mongoengine's BaseDocument._from_son so that a reference to the raw lists read from the database is
+        kept. save_with_uniqueness relies on them to send only those elements that were appended afterwards
+        '''
+        document = super()._from_son(son, *args, **kwargs)
+        document._persisted_lists = {key: value for key, value in son.items() if isinstance(value, list)}
+        return document
+
+    def _unsaved_values(self, db_name, values):
+        '''Given the database values of a 'List-type' field, return those that are not known to be stored already
+        '''
+        persisted = getattr(self, '_persisted_lists', {}).get(db_name)
+        if not persisted:
+            return list(values)
+        persisted_keys = {utils.value_key(value) for value in persisted}
+        return [value for value in values if utils.value_key(value) not in persisted_keys]
+
+    @classmethod
+    def _collection_of(cls, documents):
+        '''Return the collection the given documents are bound to, as 'Document.switch_collection' and 'Partitions.bind'
+        do, or that of the class if none is bound. Documents written together must all be bound to the same collection
+        '''
+        bound = [document._get_collection() for document in documents if '_get_collection' in document.__dict__]
+        if not bound:
+            return cls._get_collection()
+        if len(bound) != len(documents) or any(collection.name != bound[0].name for collection in bound):
+            raise errors.DbModelOperationError(f"'{cls.__name__}' documents written together must be bound to the same "
+                                               f"collection")
+        return bound[0]
+
+    @classmethod
+    def _before_write(cls, documents):
+        '''Hook run on the documents about to be written by 'save', 'save_with_uniqueness' or 'bulk_update', before they
+        are validated. Meant for preparations that read the database, which 'clean' must not do as it is run on every
+        validation
+        '''
+
+    @classmethod
+    def _after_insert(cls, documents):
+        '''Hook run on the documents once inserted in the database by 'save', 'save_with_uniqueness' or as upserts of
+        'write_buffer.WriteBuffer'
+        '''
+
+    @classmethod
+    def _after_update(cls, changes):
+        '''Hook run once documents already stored were updated by 'save', 'save_with_uniqueness' or 'bulk_update' with
+        a modification of any of 'tracked_fields'. Changes are given as a list of (state before, state after) per
+        document, as returned by '_tracked_state', the state after being None if the document was deleted meanwhile
+        '''
+
+    @classmethod
+    def _tracked_state(cls, collection, ids):
+        '''Return the stored values of 'tracked_fields' of the given documents, by '_id', read through a single query
+        '''
+        projection = dict.fromkeys(cls.tracked_fields, True)
+        return {son['_id']: son for son in collection.find({'_id': {'$in': ids}}, projection)}
+
+    @classmethod
+    def _tracked_before_update(cls, documents, collection):
+        '''Return the state of the given documents about to be updated, as returned by '_tracked_state', restricted to
+        those that may be stored already and whose modified fields include any of 'tracked_fields'. No query is made
+        otherwise
+        '''
+        if not cls.tracked_fields:
+            return {}
+        tracked = set(cls.tracked_fields)
+
+        def modifies_tracked(document):
+            changed = getattr(document, '_changed_fields', [])  # Not set on documents built from raw values
+            return document._created or tracked.intersection(key.split('.', 1)[0] for key in changed)
+
+        ids = [document.pk for document in documents if document.pk is not None and modifies_tracked(document)]
+        return cls._tracked_state(collection, ids) if ids else {}
+
+    @classmethod
+    def _report_updates(cls, collection, before):
+        '''Read the state of the documents given by '_tracked_before_update' once updated and hand both to
+        '_after_update'. Documents whose update failed are handed over as well, their state being unchanged. Concurrent
+        updates of the same tracked fields by other processes in between may be accounted for twice
+        '''
+        if before:
+            after = cls._tracked_state(collection, list(before))
+            cls._after_update([(state, after.get(pk)) for pk, state in before.items()])
+
+    def _mark_as_saved(self, *fields):
+        '''Stop flagging the given fields as modified, as their local values were written to the database directly
+        '''
+        self._changed_fields = [field for field in getattr(self, '_changed_fields', [])
+                                if field.split('.')[0] not in fields]
+
+    @classmethod
+    def _update_spec(cls):
+        '''Return the mapping of field names to database names, the '_cls' query that Mongoengine would add to any
+        QuerySet of this class and the '_cls' value to be set on upserts. The spec is computed only once per class.
+        '''
+        spec = cls.__dict__.get('_compiled_update_spec')
+        if spec is None:
+            db_names = {name: field.db_field for name, field in cls._fields.items()}
+            cls_query, cls_name = {}, None
+            if cls._meta.get('allow_inheritance') is True:
+                subclasses = cls._subclasses
+                cls_query = {'_cls': subclasses[0] if len(subclasses) == 1 else {'$in': subclasses}}
+                cls_name = cls._class_name
+            spec = (db_names, cls_query, cls_name)
+            cls._compiled_update_spec = spec
+        return spec
+
+    @classmethod
+    def _validation_spec(cls):
+        '''Return the list of (name, field, pass clean) of all fields in declaration order, the mapping of database
+        names to the same tuples and whether the class overrides 'clean'. The spec is computed only once per class.
+        '''
+        spec = cls.__dict__.get('_compiled_validation_spec')
+        if spec is None:
+            embedded = (mongoengine.EmbeddedDocumentField, mongoengine.GenericEmbeddedDocumentField)
+            checks = [(name, cls._fields[name], isinstance(cls._fields[name], embedded))
+                      for name in cls._fields_ordered]
+            by_db_name = {check[1].db_field: check for check in checks}
+            has_clean = cls.clean is not mongoengine.Document.clean
+            spec = (checks, by_db_name, has_clean)
+            cls._compiled_validation_spec = spec
+        return spec
+
+    def _delta_checks(self):
+        '''Return the entries of the validation spec of the fields modified since the document was loaded or last saved,
+        or of all of them if the document is new, along with whether the class overrides 'clean'
+        '''
+        checks, by_db_name, has_clean = self._validation_spec()
+        if not self._created and self.pk is not None:
+            changed = {key.split('.', 1)[0] for key in self._changed_fields}
+            checks = [by_db_name[key] for key in changed if key in by_db_name]
+        return checks, has_clean
+
+    def _validation_errors(self):
+        '''Return a dictionary of field name -> error in the same terms as 'Document.validate' would raise them, though
+        only the fields modified since the document was loaded or last saved are checked, unless the document is new
+        '''
+        checks, has_clean = self._delta_checks()
+        validation_errors = {}
+        if has_clean:
+            try:
+                self.clean()
+            except mongoengine.errors.ValidationError as error:
+                validation_errors[mongoengine.base.NON_FIELD_ERRORS] = error
+        data = self._data
+        for name, field, pass_clean in checks:
+            value = data.get(name)
+            if value is not None:
+                try:
+                    if pass_clean:
+                        field._validate(value, clean=True)
+                    else:
+                        field._validate(value)
+                except mongoengine.errors.ValidationError as error:
+                    validation_errors[name] = error.errors or error
+                except (ValueError, AttributeError, AssertionError) as error:
+                    validation_errors[name] = error
+            elif field.required and not getattr(field, '_auto_gen', False):
+                validation_errors[name] = mongoengine.errors.ValidationError('Field is required', field_name=name)
+        return validation_errors
+
+    def validate_delta(self):
+        '''Validate only the fields modified since the document was loaded or last saved, or all of them if the
+        document is new, through the validation spec compiled for its class. It raises the same ValidationError as
+        'Document.validate' would for those fields
+        '''
+        validation_errors = self._validation_errors()
+        if validation_errors:
+            raise mongoengine.errors.ValidationError(f"ValidationError ({self._class_name}:{self.pk}) ",
+                                                     errors=validation_errors)
+
+    def clean_delta(self):
+        '''Run the 'clean' method of the document and of the embedded documents held by the fields that 'validate_delta'
+        would check, without validating any field. Used by bulk writes that trust the server to validate documents
+        '''
+        checks, has_clean = self._delta_checks()
+        if has_clean:
+            self.clean()
+        data = self._data
+        for name, _, _ in checks:
+            value = data.get(name)
+            for embedded in value if isinstance(value, list) else [value]:
+                if isinstance(embedded, mongoengine.EmbeddedDocument):
+                    embedded.clean()
+
+    @classmethod
+    def validate_many(cls, documents):
+        '''Validate a list of documents in the same terms as 'validate_delta' does, without stopping at the first
+        invalid one.
+
+        :param documents: list of documents to be validated
+        :return: list with a dictionary holding the 'index' of the document in 'documents', its '_id' and the
+        ValidationError 'error' for each invalid document
+        '''
+        failures = []
+        for index, document in enumerate(documents):
+            try:
+                document.validate_delta()
+            except mongoengine.errors.ValidationError as error:
+                failures.append({'index': index, '_id': document.pk, 'error': error})
+        return failures
+
+    def _raw_update_one(self, pk, to_set, to_add):
+        '''Upsert the given fields through pymongo's 'update_one', building the same update document and raising the
+        same errors as Mongoengine's 'QuerySet.update_one' would do.
+
+        :param pk: '_id' of the document to be updated or upserted
+        :param to_set: dictionary of database field names and values to be set
+        :param to_add: dictionary of database field names and lists of values to be added to the set
+        '''
+        db_names, cls_query, cls_name = self._update_spec()
+        query = {'_id': pk}
+        update = {}
+        if cls_query:
+            query.update(cls_query)
+            to_set = dict(to_set, _cls=cls_name)
+        if to_set:
+            update['$set'] = to_set
+        if to_add:
+            update['$addToSet'] = {key: {'$each': values} for key, values in to_add.items()}
+        try:
+            return self._get_collection().update_one(query, update, upsert=True)
+        except pymongo.errors.DuplicateKeyError as ex:
+            raise mongoengine.errors.NotUniqueError(f"Update failed ({ex})")
+        except pymongo.errors.OperationFailure as ex:
+            raise mongoengine.errors.OperationError(f"Update failed ({ex})")
+
     def is_modified(self):
         '''Check if the document has been modified
         '''
@@ -102,27 +499,182 @@ class UniquenessMixin(mongoengine.Document):
         return False
 
     @classmethod
-    def bulk_update(cls, documents):
+    def bulk_update(cls, documents, parallelism=1, partition_size=None, full_result=False,
+                    retry_policy=None, trust_server_validation=None):
         '''Given a list of documents, send them all to the database to be updated in bulk by using pymongo's UpdateOne.
         Note that this is a class method so that I can be used with the model class instead.
+
+        Large batches can be split into partitions of contiguous '_id' ranges that are sent concurrently by up to
+        'parallelism' threads sharing the connection pool of the client. Write errors of all partitions are merged and
+        their 'index' always refers to the position of the document in 'documents', which is also returned as
+        'document'.
+
+        Operations failing because of a transient condition of the cluster, such as a primary stepping down or a network
+        error, are resubmitted according to 'retry_policy', if given, such as retry.DEFAULT_RETRY_POLICY. Only the
+        failed operations of each partition are sent again, so that a failover during a large batch costs the failed
+        fraction of it rather than the whole batch. When a whole request fails, as with a network error, it is unknown
+        which of its operations were applied, hence all pending operations of that partition are sent again. Completed
+        partitions are never sent again. Re-sending operations already applied relies on them being idempotent, which
+        holds as they only '$set' fields to given values, though a concurrent write to the same fields in between may be
+        overwritten. Errors that are not retryable, or still failing after the last attempt, are returned as write
+        errors; exceptions are raised once attempts run out. Write concern errors reported for a whole batch are not
+        retried as its writes were applied, and neither are requests failing with a write concern timeout unless the
+        policy opts in.
+
+        When trusting server validation, documents are not validated before being sent, though their 'clean' methods
+        are still run, and the validator applied to the collection by 'schema.apply_validator' rejects invalid ones.
+        Such rejections raise DbModelOperationError as client-side validation does, once the valid documents of the
+        batch have been written.
+
+        Documents modifying any of the 'tracked_fields' of the class are read before and after being written, through
+        one query each whatever their number, and handed to '_after_update', which keeps the statistics rollups in sync.
+
+        :param documents: list of documents to be updated
+        :param parallelism: maximum number of partitions sent concurrently
+        :param partition_size: maximum number of operations per partition. By default operations are evenly split into
+        'parallelism' partitions
+        :param full_result: if True, return a dictionary with the merged 'nMatched', 'nModified', 'nRetried',
+        'writeErrors' and 'writeConcernErrors' rather than only the list of write errors
+        :param retry_policy: RetryPolicy for the failed operations. Failed operations are never resubmitted by default
+        :param trust_server_validation: if True, skip client-side validation. It defaults to the setting of the class
         '''
 
-        write_errors = []
-        bulk_ops = []
-        for document in documents:
-            try:
-                document.validate()
-            except mongoengine.errors.ValidationError as ex:
-                raise errors.DbModelOperationError(f"Document '{document}' with id '{document.id}' is invalid") \
-                    from ex
-            else:
-                bulk_ops.append(UpdateOne({'_id': document.id}, {'$set': document.updates}))
         try:
-            cls._get_collection().bulk_write(bulk_ops, ordered=False)
-        except BulkWriteError as ex:
-            write_errors = ex.details['writeErrors']
+            cls._before_write(documents)
+        except mongoengine.errors.ValidationError as ex:
+            raise errors.DbModelOperationError(f"Bulk update of '{cls.__name__}' is invalid ({ex})") from ex
+        trusted = _trusts_server_validation(cls, trust_server_validation)
+        if trusted:
+            for document in documents:
+                try:
+                    document.clean_delta()
+                except mongoengine.errors.ValidationError as ex:
+                    raise errors.DbModelOperationError(f"Document '{document}' with id '{document.id}' is invalid") \
+                        from ex
+        else:
+            failures = cls.validate_many(documents)
+            if failures:
+                document = documents[failures[0]['index']]
+                raise errors.DbModelOperationError(f"Document '{document}' with id '{document.id}' is invalid") \
+                    from failures[0]['error']
+        bulk_ops = [UpdateOne({'_id': document.id}, {'$set': document.updates}) for document in documents]
+
+        collection = cls._collection_of(documents)
+        before = cls._tracked_before_update(documents, collection)
+        if parallelism <= 1 and not partition_size:
+            partitions = [list(range(len(bulk_ops)))]
+        else:
+            try:
+                order = sorted(range(len(documents)), key=lambda index: documents[index].id)
+            except TypeError:
+                order = list(range(len(documents)))
+            partition_size = partition_size or max(math.ceil(len(order) / parallelism), 1)
+            partitions = [order[start:start + partition_size] for start in range(0, len(order), partition_size)]
+
+        policy = retry_policy or retry.NO_RETRY
+
+        def write(partition):
+            result = {'nMatched': 0, 'nModified': 0, 'nRetried': 0, 'writeConcernErrors': []}
+            partition_errors = []
+            pending = partition
+            for attempt in range(1, policy.max_attempts + 1):
+                last_attempt = attempt == policy.max_attempts
+                if attempt > 1:
+                    policy.wait(attempt)
+                    result['nRetried'] += len(pending)
+                try:
+                    attempt_result = collection.bulk_write([bulk_ops[index] for index in pending],
+                                                           ordered=False).bulk_api_result
+                except BulkWriteError as ex:
+                    attempt_result = ex.details
+                except pymongo.errors.PyMongoError as ex:
+                    if last_attempt or not policy.is_retryable_exception(ex):
+                        raise
+                    continue
+                result['nMatched'] += attempt_result['nMatched']
+                result['nModified'] += attempt_result['nModified']
+                result['writeConcernErrors'].extend(attempt_result.get('writeConcernErrors', []))
+                failed = []
+                for error in attempt_result['writeErrors']:
+                    index = pending[error['index']]
+                    if not last_attempt and policy.is_retryable_error(error):
+                        failed.append(index)
+                    else:
+                        partition_errors.append(dict(error, index=index, document=documents[index]))
+                if not failed:
+                    break
+                pending = failed
+            return result, partition_errors
+
+        if len(partitions) == 1:
+            results = [write(partitions[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                results = list(executor.map(write, partitions))
+
+        write_errors = sorted((error for _, partition_errors in results for error in partition_errors),
+                              key=lambda error: error['index'])
+        cls._report_updates(collection, before)
+        if trusted:
+            invalid = next((error for error in write_errors if error['code'] == DOCUMENT_VALIDATION_FAILURE), None)
+            if invalid:
+                document = invalid['document']
+                raise errors.DbModelOperationError(f"Document '{document}' with id '{document.id}' is invalid "
+                                                   f"({invalid.get('errmsg')})")
+        if not full_result:
+            return write_errors
+        return {'nMatched': sum(result['nMatched'] for result, _ in results),
+                'nModified': sum(result['nModified'] for result, _ in results),
+                'nRetried': sum(result['nRetried'] for result, _ in results),
+                'writeErrors': write_errors,
+                'writeConcernErrors': [error for result, _ in results for error in result['writeConcernErrors']]}
+
+    @classmethod
+    def iterate(cls, batch_size=1000, fields=None, raw=False, prefetch=False, after=None, checkpoint=None, **filters):
+        '''Iterate over all documents matching the given filters with bounded memory, in '_id' order.
 
-        return write_errors
+        Documents are fetched in batches of 'batch_size' through keyset pagination on '_id': each batch is a new
+        'no_cache' query for the documents after the last '_id' seen, read in a single round trip. No cursor is thus
+        kept open while documents are processed, so that long jobs are never interrupted by cursor timeouts.
+
+        :param batch_size: number of documents fetched per query
+        :param fields: list of fields to be loaded. All fields are loaded by default
+        :param raw: if True, yield the raw dictionaries read from the database rather than documents
+        :param prefetch: if True, the next batch is fetched on a background thread while the current one is consumed
+        :param after: '_id' after which the iteration starts, such as the last one given to 'checkpoint'
+        :param checkpoint: callable invoked with the '_id' of the last document of each batch, once all the documents of
+        the batch were consumed
+        :param filters: keyword arguments given to the QuerySet as filters
+        '''
+        def fetch(last_id):
+            queryset = cls.objects(**filters)
+            if last_id is not None:
+                queryset = queryset.filter(id__gt=last_id)
+            if fields:
+                queryset = queryset.only(*fields)
+            if raw:
+                queryset = queryset.as_pymongo()
+            return list(queryset.order_by('id').limit(batch_size).batch_size(batch_size).no_cache())
+
+        def last_id_of(batch):
+            return batch[-1]['_id'] if raw else batch[-1].pk
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            batch = fetch(after)
+            while batch:
+                last_id = last_id_of(batch)
+                following = executor.submit(fetch, last_id) if executor and len(batch) == batch_size else None
+                for document in batch:
+                    yield document
+                if checkpoint:
+                    checkpoint(last_id)
+                if len(batch) < batch_size:
+                    break
+                batch = following.result() if following else fetch(last_id)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
 
     meta = {'allow_inheritance': True, 'abstract': True}
 
@@ -138,7 +690,35 @@ class Peers(UniquenessMixin):
     is_assigned = mongoengine.BooleanField(default=False)  # Flag that tell us if the Peer is assigned to a Scan
     is_allowed = mongoengine.BooleanField(default=False)
     created = mongoengine.DateTimeField(default=datetime.datetime.utcnow)
-    updated = mongoengine.DateTimeField()
+    updated = mongoengine.DateTimeField()  # Last heartbeat received from the peer
+
+    meta = {'indexes': [{'fields': ['is_assigned', 'updated'], 'cls': False}]}
+
+    @classmethod
+    def heartbeat(cls, *names, now=None):
+        '''Stamp the 'updated' field of the given peers with the current time through a single update_many operation,
+        so that workers can signal they are alive without having to load and save their own document.
+
+        :param names: unique names of the peers sending the heartbeat
+        :param now: datetime to be used as heartbeat. It defaults to datetime.utcnow()
+        :return: number of peers matched
+        '''
+        if not names:
+            raise errors.DbModelOperationError("At least one peer name is required to send a heartbeat")
+        now = now or datetime.datetime.utcnow()
+        result = cls._get_collection().update_many({'name': {'$in': list(names)}}, {'$set': {'updated': now}})
+        return result.matched_count
+
+    @classmethod
+    def insert_many_ignore_duplicates(cls, documents, trust_server_validation=None):
+        '''Register many peers at once through a single unordered 'insert_many'. Peers whose name is already registered
+        are skipped rather than aborting the whole batch.
+
+        :param documents: list of Peers objects to be inserted
+        :param trust_server_validation: if True, skip client-side validation. It defaults to 'trust_server_validation'
+        :return: dictionary with the 'inserted_ids' and the names of the peers that were 'duplicates'
+        '''
+        return _insert_many_ignore_duplicates(cls, documents, 'name', trust_server_validation)
 
 
 class SiteInstructions(mongoengine.EmbeddedDocument):
@@ -153,7 +733,7 @@ class SiteInstructions(mongoengine.EmbeddedDocument):
     is_active = mongoengine.BooleanField(default=True)
 
 
-class Sites(mongoengine.Document):
+class Sites(Document):
     '''Collection that will store the details of the sites to be scanned.
     '''
     url = StringField(required=True, unique=True, regex=URL_REGEX_STRING)
@@ -199,8 +779,8 @@ class Sites(mongoengine.Document):
         return super().save(*args, **kwargs)
 
     def update(self, **kwargs):
-        '''Overrides Mongoengine's Document.update method. It may perform one read and one update operation if pre_update
-        condition is met. It ensures that the field instructions contains only one active record.
+        '''Overrides Mongoengine's Document.update method. It may perform one read and one update operation if
+        pre_update condition is met. It ensures that the field instructions contains only one active record.
 
         '''
         upsert = kwargs.get('upsert', False)
@@ -214,9 +794,25 @@ class Sites(mongoengine.Document):
             self._pre_update(instructions)
         return super().update(**kwargs)
 
+    @classmethod
+    def insert_many_ignore_duplicates(cls, documents, trust_server_validation=None):
+        '''Register many sites at once through a single unordered 'insert_many'. The same rule as in 'save' is applied
+        locally to each site so that only one of its instructions is active. Sites whose url is already registered are
+        skipped rather than aborting the whole batch.
+
+        :param documents: list of Sites objects to be inserted
+        :param trust_server_validation: if True, skip client-side validation
+        :return: dictionary with the 'inserted_ids' and the urls of the sites that were 'duplicates'
+        '''
+        for document in documents:
+            if isinstance(document, cls) and document.instructions:
+                cls._enforce_only_one_active(document.instructions)
+        return _insert_many_ignore_duplicates(cls, documents, 'url', trust_server_validation)
+
 
 class Scans(UniquenessMixin):
-    '''Collection that will contain live data of each scan instance being undertaking by one peer on one site at one time.
+    '''Collection that will contain live data of each scan instance being undertaking by one peer on one site at one
+    time.
 
     Every time a scan is commenced by a peer this structure is instantiated. Every time such scan is finished  by the
     same peer that instantiated it, this structure is also updated.
@@ -230,6 +826,42 @@ class Scans(UniquenessMixin):
     finished_at = mongoengine.DateTimeField()
     documents = mongoengine.ListField(mongoengine.ReferenceField('WebDocuments'))
 
+    tracked_fields = ('peer', 'site', 'is_active', 'started_at', 'finished_at')
+
+    meta = {'indexes': [{'fields': ['peer', 'is_active'], 'cls': False},
+                        {'fields': ['is_active', 'finished_at'], 'cls': False}]}
+
+    @classmethod
+    def _after_insert(cls, documents):
+        ScanEvents.record_started([scan for scan in documents if scan.is_active])
+        Statistics.record_finished_scans([(scan.id, _reference_id(scan, 'site'), scan.started_at, scan.finished_at)
+                                          for scan in documents if not scan.is_active and scan.finished_at is not None])
+
+    @classmethod
+    def _after_update(cls, changes):
+        Statistics.record_scan_changes(changes)
+        ScanEvents.record_scan_changes(changes)
+
+    def finish(self, now=None):
+        '''Close this scan if still active by setting 'finished_at' and 'is_active' to False, account for its duration
+        in the statistics rollups and record its end in ScanEvents.
+
+        :param now: datetime to be used as 'finished_at'. It defaults to datetime.utcnow()
+        :return: True if the scan was closed, False if it was not active
+        '''
+        now = now or datetime.datetime.utcnow()
+        result = self._get_collection().update_one({'_id': self.id, 'is_active': True},
+                                                   {'$set': {'is_active': False, 'finished_at': now}})
+        if not result.modified_count:
+            return False
+        self.is_active = False
+        self.finished_at = now
+        self._mark_as_saved('is_active', 'finished_at')
+        Statistics.record_finished_scans([(self.id, _reference_id(self, 'site'), self.started_at, now)])
+        ScanEvents.record_finished([(self.id, _reference_id(self, 'peer'), _reference_id(self, 'site'),
+                                     self.started_at, now)])
+        return True
+
 
 class ScanSettings(UniquenessMixin):
     '''Collection that will contain the details of all scan instances performed on all sites all along time.
@@ -249,6 +881,8 @@ class ScanSettings(UniquenessMixin):
     created = mongoengine.DateTimeField(default=datetime.datetime.utcnow)
     scans = mongoengine.ListField(mongoengine.ReferenceField(Scans))
 
+    meta = {'indexes': [{'fields': ['scans'], 'cls': False}]}
+
 
 class WebContent(mongoengine.EmbeddedDocument):
     '''Structure that will contain the content of scraped web pages as a result of each scan taking place.
@@ -259,9 +893,16 @@ class WebContent(mongoengine.EmbeddedDocument):
     title = mongoengine.StringField()
     version = StringField(required=True, regex=utils.version_regex.pattern)
     content = mongoengine.StringField()
+    fingerprint = mongoengine.StringField()  # Digest of 'content' as given by utils.content_fingerprint
     created = mongoengine.DateTimeField(default=datetime.datetime.utcnow)
     updated = mongoengine.DateTimeField()
 
+    def clean(self):
+        '''Compute the fingerprint of the content when validating, if not computed yet or if the content was changed
+        '''
+        if self.content is not None and (self.fingerprint is None or 'content' in self._changed_fields):
+            self.fingerprint = utils.content_fingerprint(self.content)
+
 
 class WebDocuments(UniquenessMixin):
     '''Collection that stores the web pages scanned and the hierarchy defining the relationships of such pages.
@@ -270,18 +911,990 @@ class WebDocuments(UniquenessMixin):
     relationship between those pages. A page could have child links to other pages and an also ancestor. WebDocument
     defines this hierarchy through 'paren' and 'children' field.
 
+    'ancestors' materializes the path from the root page down to the parent of each page, so that whole subtrees can be
+    queried through the (ancestors, level) index instead of dereferencing 'children' recursively. It is computed from
+    'parent' when the document is saved, updated through 'bulk_update' or linked through 'link_children', though not
+    when it is merely validated. Moving a page that already has descendants under another parent is not supported, as
+    their paths would not be updated.
+
+    As every scan stores its own copy of each page, 'next_fetch' is only kept on the latest copy of each url, that of
+    the greatest 'created': it is set to NEVER_FETCHED on pages stored without one and removed from the older copies of
+    a url once a new copy is inserted.
     '''
     site = mongoengine.ReferenceField(Sites, required=True)
     scan = mongoengine.ReferenceField(Scans, required=True)
     parent = mongoengine.ReferenceField('self')
     children = mongoengine.ListField(mongoengine.ReferenceField('self'))
+    ancestors = mongoengine.ListField(mongoengine.ObjectIdField())  # Ids of the pages from the root down to 'parent'
     content = mongoengine.EmbeddedDocumentListField(WebContent)
     url = StringField(required=True, regex=URL_REGEX_STRING)
     site_url = StringField(required=True, regex=URL_REGEX_STRING)
     level = mongoengine.IntField(required=True)
     num_node = mongoengine.IntField(required=True)
     is_cover = mongoengine.BooleanField(default=False)
+    fingerprint = mongoengine.StringField()  # Fingerprint of the latest content version
+    etag = mongoengine.StringField()  # HTTP headers of the latest fetch
+    last_modified = mongoengine.DateTimeField()
+    last_fetched = mongoengine.DateTimeField()
+    change_rate = mongoengine.FloatField(default=DEFAULT_CHANGE_RATE)  # Estimated number of changes per day
+    next_fetch = mongoengine.DateTimeField()  # When the page is next expected to have changed
     created = mongoengine.DateTimeField(default=datetime.datetime.utcnow)
     updated = mongoengine.DateTimeField()
 
+    tracked_fields = ('site', 'scan', 'level', 'is_cover', 'content')
+
+    meta = {'indexes': [{'fields': ['site', 'url', 'created', 'fingerprint'], 'cls': False},
+                        {'fields': ['site', 'next_fetch'], 'cls': False},
+                        {'fields': ['scan'], 'cls': False},
+                        {'fields': ['ancestors', 'level'], 'cls': False}]}
+
+    def clean(self):
+        self._set_fingerprint()
+
+    @classmethod
+    def _before_write(cls, documents):
+        for document in documents:
+            document._set_fingerprint()
+            if document._created and document.next_fetch is None:
+                document.next_fetch = NEVER_FETCHED
+        cls.resolve_ancestors(documents)
+
+    @classmethod
+    def _after_insert(cls, documents):
+        deferred = getattr(_bookkeeping, 'documents', None)
+        if deferred is not None:
+            deferred.extend(documents)
+        else:
+            cls.record_inserted(documents)
+
+    @classmethod
+    def _tracked_state(cls, collection, ids):
+        '''Return the rollup fields of the given pages, with the size of their content computed on the server rather
+        than loading it
+        '''
+        pipeline = [{'$match': {'_id': {'$in': ids}}},
+                    {'$project': {'site': True, 'scan': True, 'level': True, 'is_cover': True,
+                                  'content_bytes': Statistics.CONTENT_BYTES}}]
+        return {son['_id']: son for son in collection.aggregate(pipeline)}
+
+    @classmethod
+    def _after_update(cls, changes):
+        Statistics.record_page_changes(changes)
+
+    @classmethod
+    def record_inserted(cls, documents, events=True):
+        '''Account for newly inserted pages in the statistics rollups, the scan events and the seen-url filters of their
+        sites, through one write per collection whatever the number of pages
+
+        :param events: whether ScanEvents.PAGES events are recorded, such as not for pages restored from an archive
+        '''
+        if not documents:
+            return
+        cls.retire_older_copies(documents)
+        Statistics.record_pages(documents)
+        if events:
+            ScanEvents.record_pages(documents)
+        urls = {}
+        for document in documents:
+            urls.setdefault(_reference_id(document, 'site'), []).append(document.url)
+        for site_id, site_urls in urls.items():
+            SeenUrlFilters.record(site_id, site_urls)
+
+    @classmethod
+    def retire_older_copies(cls, documents, collections=None):
+        '''Remove the 'next_fetch' of the copies of the given pages stored before them, through a single unordered
+        bulk_write per collection, so that only the latest copy of each url is in the recrawl frontier. Pages are
+        compared on 'created' inclusively and excluded by id, as the database truncates datetimes to milliseconds
+
+        :param collections: pymongo collections where copies are looked for. It defaults to the collection each page is
+        bound to, such as its partition
+        '''
+        groups = {}
+        for document in documents:
+            if document.created is None:
+                continue
+            operation = UpdateMany({'site': _reference_id(document, 'site'), 'url': document.url,
+                                    'created': {'$lte': document.created}, '_id': {'$ne': document.pk},
+                                    'next_fetch': {'$ne': None}},
+                                   {'$unset': {'next_fetch': True}})
+            for collection in collections if collections is not None else [document._get_collection()]:
+                groups.setdefault(collection.name, (collection, []))[1].append(operation)
+        for collection, bulk_ops in groups.values():
+            collection.bulk_write(bulk_ops, ordered=False)
+
+    @classmethod
+    @contextlib.contextmanager
+    def batched_bookkeeping(cls):
+        '''Context manager deferring the bookkeeping of the pages inserted by the current thread within the block, so
+        that it is recorded through a single 'record_inserted' call when the block exits rather than through a few round
+        trips per page. Statistics rollups incremented by the thread meanwhile, such as by updates of pages or scans,
+        are merged and written along with those of the pages through a single write. Pages inserted before an exception
+        is raised are still accounted for. Nested blocks are recorded by the outermost one.
+        '''
+        if getattr(_bookkeeping, 'documents', None) is not None:
+            yield
+            return
+        _bookkeeping.documents, _bookkeeping.increments = [], {}
+        try:
+            yield
+        finally:
+            try:
+                documents, _bookkeeping.documents = _bookkeeping.documents, None
+                cls.record_inserted(documents)
+            finally:
+                increments, _bookkeeping.increments = _bookkeeping.increments, None
+                Statistics._write_increments(increments)
 
+    def _set_fingerprint(self):
+        '''Keep 'fingerprint' equal to the fingerprint of the latest content version, as 'add_content_version' does, so
+        that pages saved along with their content are not reported by 'changed_urls' as changed
+        '''
+        if not self.content:
+            return
+        latest = self.content[-1]
+        latest.clean()
+        if latest.fingerprint != self.fingerprint:
+            self.fingerprint = latest.fingerprint
+
+    @classmethod
+    def resolve_ancestors(cls, documents):
+        '''Compute the 'ancestors' of the given pages that are new or whose parent changed, unless their path is up to
+        date already. Parents given along with their children are resolved first, whether or not they were stored yet,
+        whereas the paths of the rest of the parents are read through a single '$in' query.
+
+        :param documents: list of WebDocuments objects
+        :raise mongoengine.errors.ValidationError: if a parent does not exist or a page would be its own ancestor
+        '''
+        pending = {}
+        for document in documents:
+            if not document._created and 'parent' not in getattr(document, '_changed_fields', []):
+                continue
+            parent_id = _reference_id(document, 'parent')
+            if parent_id is None:
+                if document.ancestors:
+                    document.ancestors = []
+            elif not document.ancestors or document.ancestors[-1] != parent_id:
+                pending[id(document)] = (document, parent_id)
+        if not pending:
+            return
+        given = {document.pk: document for document in documents if document.pk is not None}
+        missing = list({parent_id for _, parent_id in pending.values() if parent_id not in given})
+        stored = {}
+        if missing:
+            stored = {son['_id']: son.get('ancestors', []) for son in
+                      cls._collection_of(documents).find({'_id': {'$in': missing}}, {'ancestors': True})}
+
+        def resolve(document, visiting):
+            if id(document) in visiting:
+                raise mongoengine.errors.ValidationError(f"Page '{document.pk}' would be its own ancestor",
+                                                         field_name='parent')
+            visiting.add(id(document))
+            parent_id = pending[id(document)][1]
+            parent = given.get(parent_id)
+            if parent is None:
+                if parent_id not in stored:
+                    raise mongoengine.errors.ValidationError(f"Parent '{parent_id}' does not exist",
+                                                             field_name='parent')
+                ancestors = stored[parent_id] + [parent_id]
+            else:
+                if id(parent) in pending:
+                    resolve(parent, visiting)
+                ancestors = list(parent.ancestors or []) + [parent_id]
+            if document.pk is not None and document.pk in ancestors:
+                raise mongoengine.errors.ValidationError(f"Page '{document.pk}' would be its own ancestor",
+                                                         field_name='parent')
+            document.ancestors = ancestors
+            del pending[id(document)]
+
+        while pending:
+            resolve(next(iter(pending.values()))[0], set())
+
+    @classmethod
+    def link_children(cls, parent, children):
+        '''Make the given pages children of 'parent' through two bulk operations whatever their number: one
+        'update_many' setting the 'parent' and 'ancestors' of all children and one '$addToSet' with '$each' on the
+        'children' of the parent. Children are expected to have no descendants of their own yet. Documents given are
+        updated locally too.
+
+        :param parent: WebDocuments object or id of the parent page
+        :param children: list of WebDocuments objects or ids of the child pages
+        :return: number of children whose parent changed
+        '''
+        parent_id = getattr(parent, 'pk', parent)
+        child_ids = [getattr(child, 'pk', child) for child in children]
+        if not child_ids:
+            return 0
+        if parent_id in child_ids:
+            raise errors.DbModelOperationError(f"Page '{parent_id}' cannot be a child of itself")
+        collection = cls._get_collection()
+        parent_son = collection.find_one({'_id': parent_id}, {'ancestors': True})
+        if parent_son is None:
+            raise errors.DbModelOperationError(f"Parent page '{parent_id}' does not exist")
+        ancestors = parent_son.get('ancestors', []) + [parent_id]
+        if set(ancestors[:-1]).intersection(child_ids):
+            raise errors.DbModelOperationError(f"Linking '{parent_id}' to its own ancestors would create a cycle")
+
+        result = collection.update_many({'_id': {'$in': child_ids}},
+                                        {'$set': {'parent': parent_id, 'ancestors': ancestors}})
+        collection.update_one({'_id': parent_id}, {'$addToSet': {'children': {'$each': child_ids}}})
+
+        for child in children:
+            if isinstance(child, cls):
+                child._data['parent'] = parent_id
+                child._data['ancestors'] = list(ancestors)
+                child._mark_as_saved('parent', 'ancestors')
+        if isinstance(parent, cls):
+            linked_ids = [getattr(value, 'pk', getattr(value, 'id', value))
+                          for value in parent._data.get('children') or []]
+            known = set(linked_ids)
+            for child_id in child_ids:
+                if child_id not in known:
+                    known.add(child_id)
+                    linked_ids.append(child_id)
+            parent._data['children'] = linked_ids
+            parent._persisted_lists = dict(getattr(parent, '_persisted_lists', {}), children=list(linked_ids))
+            parent._mark_as_saved('children')
+        return result.modified_count
+
+    @classmethod
+    def _collections(cls, partitions=None):
+        '''Return the collection of the class followed by those of the existing partitions of the given router, if any
+        '''
+        return [cls._get_collection()] + (partitions.collections() if partitions is not None else [])
+
+    @classmethod
+    def descendants(cls, page, level=None, partitions=None):
+        '''Return a QuerySet of all pages below the given one, optionally restricted to a given level, resolved through
+        the (ancestors, level) index
+
+        :param page: WebDocuments object or id
+        :param level: level of the descendants to be returned. All levels by default
+        :param partitions: partitions.Partitions router whose partitions are searched as well. A generator of the pages
+        found in the collection of the class and then in the partitions, bound to their partition, is returned instead
+        '''
+        query = {'ancestors': getattr(page, 'pk', page)}
+        if level is not None:
+            query['level'] = level
+        if partitions is None:
+            return cls.objects(__raw__=query)
+        return itertools.chain(cls.objects(__raw__=query), partitions.objects(__raw__=query))
+
+    @classmethod
+    def url_exists(cls, site, url, seen_urls=None, partitions=None):
+        '''Check whether a page with the given url was already stored for a site. If the seen-url filter of the site is
+        given, the database is only queried when the filter reports the url as possibly seen.
+
+        :param site: Sites object or id
+        :param url: url of the page
+        :param seen_urls: BloomFilter returned by 'SeenUrlFilters.load' for the same site
+        :param partitions: partitions.Partitions router whose partitions are checked, newest first, after the
+        collection of the model
+        '''
+        if seen_urls is not None and url not in seen_urls:
+            return False
+        site_id = getattr(site, 'pk', site)
+        if cls._get_collection().find_one({'site': site_id, 'url': url}, {'_id': True}) is not None:
+            return True
+        if partitions is None:
+            return False
+        return any(queryset.only('id').first() is not None
+                   for _, queryset in reversed(partitions.querysets(site=site_id, url=url)))
+
+    def record_fetch(self, changed, etag=None, last_modified=None, now=None):
+        '''Update the fetch metadata of this page after it has been fetched. The estimated change rate is an exponential
+        moving average of the changes observed between consecutive fetches and determines when the page is next due.
+        Fields are only modified locally so that they are persisted along with the next save or bulk_update.
+
+        :param changed: whether the page content changed since the previous fetch
+        :param etag: 'ETag' header returned by the server, if any
+        :param last_modified: datetime of the 'Last-Modified' header returned by the server, if any
+        :param now: datetime of the fetch. It defaults to datetime.utcnow()
+        '''
+        now = now or datetime.datetime.utcnow()
+        change_rate = self.change_rate if self.change_rate is not None else DEFAULT_CHANGE_RATE
+        if self.last_fetched:
+            elapsed_days = max((now - self.last_fetched).total_seconds(), 1) / 86400
+            observed_rate = 1 / elapsed_days if changed else 0
+            change_rate = CHANGE_RATE_SMOOTHING * observed_rate + (1 - CHANGE_RATE_SMOOTHING) * change_rate
+
+        interval = MAX_RECRAWL_INTERVAL if not change_rate else datetime.timedelta(days=1 / change_rate)
+        self.change_rate = change_rate
+        self.next_fetch = now + min(max(interval, MIN_RECRAWL_INTERVAL), MAX_RECRAWL_INTERVAL)
+        self.last_fetched = now
+        if etag is not None:
+            self.etag = etag
+        if last_modified is not None:
+            self.last_modified = last_modified
+
+    @classmethod
+    def recrawl_frontier(cls, site, limit=1000, now=None, batch_size=500, partitions=None):
+        '''Return the pages of a site that are due to be fetched again by an incremental scan, starting by those never
+        fetched and followed by those whose 'next_fetch' is the oldest.
+
+        As only the latest copy of each url holds a 'next_fetch', copies left by older scans are never returned. Due
+        pages are read in 'next_fetch' order straight from the (site, next_fetch) index, so that only the pages
+        returned are ever visited, and only the fields required to issue conditional requests are returned. The
+        returned cursor streams them in batches of 'batch_size'.
+
+        :param site: Sites object or id
+        :param limit: maximum number of pages to return
+        :param now: datetime up to which pages are considered due. It defaults to datetime.utcnow()
+        :param batch_size: number of pages fetched per round trip
+        :param partitions: partitions.Partitions router whose partitions are read as well, each through its own index,
+        and merged in 'next_fetch' order
+        :return: cursor of dictionaries with '_id', 'url', 'etag', 'last_modified' and 'next_fetch', which is
+        NEVER_FETCHED for the pages never fetched. An iterator of them is returned if 'partitions' is given
+        '''
+        now = now or datetime.datetime.utcnow()
+        index = [('site', pymongo.ASCENDING), ('next_fetch', pymongo.ASCENDING)]
+        cursors = [collection.find({'site': getattr(site, 'id', site), 'next_fetch': {'$lte': now}},
+                                   {'url': True, 'etag': True, 'last_modified': True, 'next_fetch': True})
+                   .sort('next_fetch', pymongo.ASCENDING).hint(index).limit(limit).batch_size(batch_size)
+                   for collection in cls._collections(partitions)]
+        if partitions is None:
+            return cursors[0]
+        return itertools.islice(heapq.merge(*cursors, key=lambda page: page['next_fetch']), limit)
+
+    def add_content_version(self, web_content, now=None):
+        '''Store 'web_content' as the latest content version of this document unless its fingerprint matches the one of
+        the latest version already stored, in which case only the 'updated' field is touched.
+
+        The check and the write are done atomically on the database so that two workers adding the same content do not
+        end up storing two identical versions.
+
+        :param web_content: WebContent object to be added
+        :param now: datetime to be used as 'updated'. It defaults to datetime.utcnow()
+        :return: True if the version was stored, False otherwise
+        '''
+        if not self.id:
+            raise errors.DbModelOperationError(f"It looks like you are trying to add a content version to a "
+                                               f"{self.__class__.__name__} object that has not been saved yet")
+        try:
+            web_content.validate()
+        except mongoengine.errors.ValidationError as ex:
+            raise errors.DbModelOperationError(f"Content version '{web_content.version}' is invalid") from ex
+
+        now = now or datetime.datetime.utcnow()
+        fingerprint = web_content.fingerprint
+        collection = self._get_collection()
+        result = collection.update_one({'_id': self.id, 'fingerprint': fingerprint}, {'$set': {'updated': now}})
+        is_new = not result.matched_count
+        if is_new:
+            result = collection.update_one({'_id': self.id, 'fingerprint': {'$ne': fingerprint}},
+                                           {'$push': {'content': web_content.to_mongo()},
+                                            '$set': {'fingerprint': fingerprint, 'updated': now}})
+            is_new = bool(result.matched_count)
+            if not is_new:
+                collection.update_one({'_id': self.id}, {'$set': {'updated': now}})
+
+        # Mirror the changes locally without flagging them as pending
+        if is_new:
+            web_content._clear_changed_fields()
+            self.content.append(web_content)
+            self.fingerprint = fingerprint
+            Statistics.record_content(self, web_content)
+        self.updated = now
+        self._mark_as_saved('content', 'fingerprint', 'updated')
+        return is_new
+
+    @classmethod
+    def changed_urls(cls, site, fingerprints, batch_size=1000, partitions=None):
+        '''Given a dictionary of urls and content fingerprints of a site, return those urls whose latest stored
+        fingerprint is different or which have never been stored.
+
+        The whole site is checked within one streamed pass of a query covered by the (site, url, created, fingerprint)
+        index, so that no document or content is ever loaded.
+
+        :param site: Sites object or id
+        :param fingerprints: dictionary of url -> fingerprint as given by utils.content_fingerprint
+        :param batch_size: number of index entries fetched per round trip
+        :param partitions: partitions.Partitions router whose partitions are checked as well, one pass each
+        :return: list of urls that changed
+        '''
+        latest = {}
+        cursors = [collection.find({'site': getattr(site, 'id', site)},
+                                   {'_id': False, 'url': True, 'created': True, 'fingerprint': True})
+                   .batch_size(batch_size) for collection in cls._collections(partitions)]
+        for entry in itertools.chain.from_iterable(cursors):
+            url = entry['url']
+            if url in fingerprints:
+                created = entry.get('created') or datetime.datetime.min
+                if url not in latest or created >= latest[url][0]:
+                    latest[url] = (created, entry.get('fingerprint'))
+        return [url for url, fingerprint in fingerprints.items() if url not in latest or latest[url][1] != fingerprint]
+
+    @classmethod
+    def find_raw(cls, fields=None, batch_size=100, **filters):
+        '''Stream the pages matching the given filters as lazy read-only views over the BSON returned by the database,
+        rather than as documents, for jobs that only forward their content or look at a few fields. Only the fields
+        accessed are decoded and the bodies of the content versions are given as memoryviews over the bytes received.
+
+        :param fields: names of the fields to be fetched. All of them by default
+        :param batch_size: number of pages fetched per round trip
+        :param filters: Mongoengine query filters such as site=site
+        :return: generator of raw.RawWebDocument objects
+        '''
+        projection = {field: True for field in fields} if fields else None
+        collection = cls._get_collection().with_options(codec_options=raw.RAW_CODEC_OPTIONS)
+        for document in collection.find(_raw_query(cls, **filters), projection).batch_size(batch_size):
+            yield raw.RawWebDocument(document)
+
+
+class SeenUrlFilters(Document):
+    '''Collection holding a Bloom filter of the urls of the WebDocuments stored for each site, so that crawlers can tell
+    whether a discovered link is new without querying WebDocuments, unless the filter reports it as possibly seen.
+
+    Each filter is stored as a binary bit array identified by the id of its site. Urls of pages inserted afterwards are
+    appended to 'pending' and folded into the bit array once SEEN_URLS_COMPACT_EVERY of them accumulate. 'version' is
+    bumped on every change of the bit array so that concurrent compactions never overwrite each other.
+    '''
+    id = mongoengine.ObjectIdField(primary_key=True)  # Id of the site
+    capacity = mongoengine.IntField(required=True)
+    error_rate = mongoengine.FloatField(required=True)
+    num_bits = mongoengine.IntField(required=True)
+    num_hashes = mongoengine.IntField(required=True)
+    count = mongoengine.IntField(default=0)
+    bits = mongoengine.BinaryField()
+    pending = mongoengine.ListField(mongoengine.StringField())
+    pending_count = mongoengine.IntField(default=0)
+    version = mongoengine.IntField(default=0)
+    updated = mongoengine.DateTimeField()
+
+    @classmethod
+    def build(cls, site, error_rate=SEEN_URLS_ERROR_RATE, capacity=None, headroom=2.0, batch_size=5000,
+              collections=None, partitions=None):
+        '''Build the filter of a site from the urls of its WebDocuments, read in a single streamed pass, and store it
+        replacing any previous one. Urls recorded as pending while the filter was being built are kept.
+
+        Other processes that found the site without a filter shortly before do not record the urls of the pages they
+        insert until SEEN_URLS_ABSENT_SECONDS elapse, so filters should be built before ingesting pages of the site, or
+        built again once the ingest that was running meanwhile is over.
+
+        :param site: Sites object or id
+        :param error_rate: false positive rate the filter is sized for
+        :param capacity: number of urls the filter is sized for. It defaults to 'headroom' times the number of pages
+        currently stored for the site, with a minimum of SEEN_URLS_MIN_CAPACITY
+        :param headroom: factor applied to the number of pages when 'capacity' is not given
+        :param batch_size: number of urls fetched per round trip
+        :param collections: pymongo collections holding the WebDocuments of the site. It defaults to the collection of
+        WebDocuments
+        :param partitions: partitions.Partitions router whose partitions are read along with 'collections'
+        :return: the BloomFilter built
+        '''
+        site_id = getattr(site, 'pk', site)
+        collections = [WebDocuments._get_collection()] if collections is None else collections
+        cursors = [lambda collection=collection: collection.find({'site': site_id}, {'url': True, '_id': False})
+                   for collection in collections]
+        counts = [lambda collection=collection: collection.count_documents({'site': site_id})
+                  for collection in collections]
+        for _, queryset in partitions.querysets(site=site_id) if partitions is not None else []:
+            cursors.append(lambda queryset=queryset: queryset.only('url').as_pymongo())
+            counts.append(queryset.count)
+        if capacity is None:
+            capacity = max(int(sum(count() for count in counts) * headroom), SEEN_URLS_MIN_CAPACITY)
+        seen_urls = bloom.BloomFilter.for_capacity(capacity, error_rate)
+        if seen_urls.num_bits // 8 > MAX_FILTER_BYTES:
+            raise errors.DbModelOperationError(f"A filter of '{capacity}' urls with an error rate of '{error_rate}' "
+                                               f"does not fit within '{MAX_FILTER_BYTES}' bytes")
+        for cursor in cursors:
+            for document in cursor().batch_size(batch_size):
+                seen_urls.add(document['url'])
+
+        cls._get_collection().update_one(
+            {'_id': site_id},
+            {'$set': {'capacity': capacity, 'error_rate': error_rate, 'num_bits': seen_urls.num_bits,
+                      'num_hashes': seen_urls.num_hashes, 'count': seen_urls.count,
+                      'bits': bson.Binary(seen_urls.to_bytes()), 'updated': datetime.datetime.utcnow()},
+             '$setOnInsert': {'pending': [], 'pending_count': 0},
+             '$inc': {'version': 1}},
+            upsert=True)
+        _sites_without_filter.pop(site_id, None)
+        return seen_urls
+
+    @classmethod
+    def rebuild(cls, sites, collections=None, partitions=None):
+        '''Build again the filters of those of the given sites that have one, keeping their error rates, such as after
+        their pages were removed, as Bloom filters cannot forget urls
+
+        :param sites: iterable of Sites objects or ids
+        :param collections: pymongo collections holding the WebDocuments of the sites, as given to 'build'
+        :param partitions: partitions.Partitions router, as given to 'build'
+        :return: number of filters rebuilt
+        '''
+        site_ids = [getattr(site, 'pk', site) for site in sites]
+        if not site_ids:
+            return 0
+        filters = list(cls._get_collection().find({'_id': {'$in': site_ids}}, {'error_rate': True}))
+        for son in filters:
+            cls.build(son['_id'], error_rate=son['error_rate'], collections=collections, partitions=partitions)
+        return len(filters)
+
+    @staticmethod
+    def _to_filter(son):
+        seen_urls = bloom.BloomFilter(son['num_bits'], son['num_hashes'], son['bits'], son.get('count', 0))
+        seen_urls.update(son.get('pending', []))
+        return seen_urls
+
+    @classmethod
+    def load(cls, site):
+        '''Return the BloomFilter of a site, including the urls still pending to be folded into it, or None if no filter
+        was built for the site. Meant to be called by workers at startup.
+        '''
+        son = cls._get_collection().find_one({'_id': getattr(site, 'pk', site)})
+        return cls._to_filter(son) if son else None
+
+    @classmethod
+    def record(cls, site, urls):
+        '''Record the urls of newly inserted pages in the filter of their site, if the site has one, compacting it when
+        enough urls are pending. It takes one round trip, which pages inserted within 'WebDocuments.batched_bookkeeping'
+        amortize to one per site and batch. Sites found to have no filter are not asked again by this process for
+        SEEN_URLS_ABSENT_SECONDS, or until it builds one for them
+
+        :param site: Sites object or id
+        :param urls: list of urls
+        '''
+        site_id = getattr(site, 'pk', site)
+        if not urls or _sites_without_filter.get(site_id, 0) > time.monotonic():
+            return
+        son = cls._get_collection().find_one_and_update(
+            {'_id': site_id},
+            {'$push': {'pending': {'$each': list(urls)}}, '$inc': {'pending_count': len(urls)}},
+            projection={'pending_count': True}, return_document=ReturnDocument.AFTER)
+        if son is None:
+            _sites_without_filter[site_id] = time.monotonic() + SEEN_URLS_ABSENT_SECONDS
+        elif son['pending_count'] >= SEEN_URLS_COMPACT_EVERY:
+            cls.compact(site)
+
+    @classmethod
+    def compact(cls, site, attempts=SEEN_URLS_COMPACT_ATTEMPTS):
+        '''Fold the pending urls of the filter of a site into its bit array. The filter is only replaced if neither a
+        compaction or build took place nor urls were recorded meanwhile, so that 'pending' and 'pending_count' are
+        always cleared together. Urls recorded meanwhile make the compaction start over with them.
+
+        :param attempts: maximum number of times the compaction is started over
+        :return: True if the filter was compacted
+        '''
+        collection = cls._get_collection()
+        for _ in range(attempts):
+            son = collection.find_one({'_id': getattr(site, 'pk', site)})
+            if not son or not son.get('pending'):
+                return False
+            seen_urls = cls._to_filter(son)
+            result = collection.update_one(
+                {'_id': son['_id'], 'version': son['version'], 'pending_count': son.get('pending_count')},
+                {'$set': {'bits': bson.Binary(seen_urls.to_bytes()), 'count': seen_urls.count, 'pending': [],
+                          'pending_count': 0, 'updated': datetime.datetime.utcnow()},
+                 '$inc': {'version': 1}})
+            if result.modified_count:
+                return True
+        return False
+
+
+class Statistics(Document):
+    '''Rollup collection holding statistics of each site and each scan that are incrementally maintained with '$inc' as
+    pages are ingested and scans are finished, so that they can be queried in O(1) instead of being aggregated over
+    WebDocuments and Scans on every request.
+
+    Site rollups are identified by 'site:<site id>' and scan rollups by 'scan:<scan id>'. 'levels' holds the number of
+    pages per depth level, keyed by the level as a string.
+
+    Scans are counted once closed, that is, not active and with a 'finished_at': either closed through 'Scans.finish'
+    or 'release_stale_peers', inserted already closed or updated so through 'save' or 'bulk_update'. Updates of the
+    rollup fields of stored pages and scans, such as their level or content, are accounted for as the difference
+    between their state before and after the update. Bulk ingestion of pages should go through
+    'WebDocuments.batched_bookkeeping' so that rollups are incremented once per batch rather than once per page.
+    '''
+    # Size in bytes of all content versions of a page, computed on the server
+    CONTENT_BYTES = {'$sum': {'$map': {'input': {'$ifNull': ['$content', []]}, 'as': 'version',
+                                       'in': {'$strLenBytes': {'$ifNull': ['$$version.content', '']}}}}}
+
+    id = mongoengine.StringField(primary_key=True)
+    site = mongoengine.ReferenceField(Sites)
+    scan = mongoengine.ReferenceField(Scans)
+    pages = mongoengine.IntField(default=0)
+    cover_pages = mongoengine.IntField(default=0)
+    content_bytes = mongoengine.IntField(default=0)
+    levels = mongoengine.DictField()
+    scans = mongoengine.IntField(default=0)  # Number of finished scans
+    scan_seconds = mongoengine.FloatField(default=0)  # Accumulated duration of the finished scans
+    updated = mongoengine.DateTimeField()
+
+    @staticmethod
+    def site_key(site):
+        return f"site:{getattr(site, 'pk', site)}"
+
+    @staticmethod
+    def scan_key(scan):
+        return f"scan:{getattr(scan, 'pk', scan)}"
+
+    @staticmethod
+    def _content_bytes(contents):
+        return sum(len(content.content.encode('utf-8')) for content in contents if content.content)
+
+    @classmethod
+    def _increment(cls, increments):
+        '''Apply the given dictionary of rollup key -> (site id, scan id, '$inc' document), unless called within
+        'WebDocuments.batched_bookkeeping', in which case they are merged with those written when the block exits
+        '''
+        deferred = getattr(_bookkeeping, 'increments', None)
+        if deferred is not None:
+            cls._merge(deferred, increments)
+        else:
+            cls._write_increments(increments)
+
+    @classmethod
+    def _write_increments(cls, increments, now=None):
+        '''Apply the given dictionary of rollup key -> (site id, scan id, '$inc' document) through a single unordered
+        bulk_write of upserts. Fields whose increments cancel out are left untouched
+        '''
+        now = now or datetime.datetime.utcnow()
+        bulk_ops = []
+        for key, (site_id, scan_id, inc) in increments.items():
+            inc = {field: value for field, value in inc.items() if value}
+            if not inc:
+                continue
+            on_insert = {'site': site_id}
+            if scan_id is not None:
+                on_insert['scan'] = scan_id
+            bulk_ops.append(UpdateOne({'_id': key}, {'$inc': inc, '$set': {'updated': now},
+                                                     '$setOnInsert': on_insert}, upsert=True))
+        if bulk_ops:
+            cls._get_collection().bulk_write(bulk_ops, ordered=False)
+
+    @staticmethod
+    def _merge(increments, other):
+        '''Add the increments of 'other' to those of 'increments', both given as rollup key -> (site id, scan id, '$inc'
+        document)
+        '''
+        for key, (site_id, scan_id, inc) in other.items():
+            rollup_inc = increments.setdefault(key, (site_id, scan_id, {}))[2]
+            for field, value in inc.items():
+                rollup_inc[field] = rollup_inc.get(field, 0) + value
+
+    @classmethod
+    def _rollup_keys(cls, site_id, scan_id):
+        keys = [(cls.site_key(site_id), site_id, None)]
+        if scan_id is not None:
+            keys.append((cls.scan_key(scan_id), site_id, scan_id))
+        return keys
+
+    @classmethod
+    def _add_page(cls, increments, site_id, scan_id, level, is_cover, content_bytes, sign=1):
+        inc = {'pages': sign, f"levels.{level}": sign}
+        if is_cover:
+            inc['cover_pages'] = sign
+        if content_bytes:
+            inc['content_bytes'] = sign * content_bytes
+        cls._merge(increments, {key: (rollup_site_id, rollup_scan_id, inc)
+                                for key, rollup_site_id, rollup_scan_id in cls._rollup_keys(site_id, scan_id)})
+
+    @classmethod
+    def _add_scan(cls, increments, scan_id, site_id, started_at, finished_at, sign=1):
+        seconds = (finished_at - started_at).total_seconds() if started_at and finished_at else 0
+        cls._merge(increments, {key: (rollup_site_id, rollup_scan_id, {'scans': sign, 'scan_seconds': sign * seconds})
+                                for key, rollup_site_id, rollup_scan_id in cls._rollup_keys(site_id, scan_id)})
+
+    @classmethod
+    def record_pages(cls, documents):
+        '''Account for newly inserted WebDocuments in the rollups of their sites and scans
+        '''
+        increments = {}
+        for document in documents:
+            cls._add_page(increments, _reference_id(document, 'site'), _reference_id(document, 'scan'), document.level,
+                          document.is_cover, cls._content_bytes(document.content))
+        cls._increment(increments)
+
+    @classmethod
+    def record_page_changes(cls, changes):
+        '''Account for updates of stored WebDocuments given as (state before, state after) as returned by
+        'WebDocuments._tracked_state', by subtracting the former and adding the latter. Pages deleted meanwhile are
+        skipped
+        '''
+        increments = {}
+        for before, after in changes:
+            if after is None:
+                continue
+            for state, sign in ((before, -1), (after, 1)):
+                cls._add_page(increments, state.get('site'), state.get('scan'), state.get('level'),
+                              state.get('is_cover'), state.get('content_bytes'), sign)
+        cls._increment(increments)
+
+    @classmethod
+    def record_content(cls, document, web_content):
+        '''Account for a new content version added to an existing WebDocuments
+        '''
+        content_bytes = cls._content_bytes([web_content])
+        if content_bytes:
+            cls._increment({key: (site_id, scan_id, {'content_bytes': content_bytes}) for key, site_id, scan_id in
+                            cls._rollup_keys(_reference_id(document, 'site'), _reference_id(document, 'scan'))})
+
+    @classmethod
+    def record_finished_scans(cls, scans):
+        '''Account for finished scans given as an iterable of (scan id, site id, started_at, finished_at)
+        '''
+        increments = {}
+        for scan_id, site_id, started_at, finished_at in scans:
+            cls._add_scan(increments, scan_id, site_id, started_at, finished_at)
+        cls._increment(increments)
+
+    @classmethod
+    def record_scan_changes(cls, changes):
+        '''Account for updates of stored Scans given as (state before, state after) as returned by
+        'Scans._tracked_state', so that scans closed or reopened through 'save' or 'bulk_update' are counted as those
+        closed through 'Scans.finish'. Scans deleted meanwhile are skipped
+        '''
+        increments = {}
+        for before, after in changes:
+            if after is None:
+                continue
+            for state, sign in ((before, -1), (after, 1)):
+                if not state.get('is_active') and state.get('finished_at') is not None:
+                    cls._add_scan(increments, state['_id'], state.get('site'), state.get('started_at'),
+                                  state['finished_at'], sign)
+        cls._increment(increments)
+
+    @classmethod
+    def record_removed_scans(cls, scans):
+        '''Subtract finished scans given as an iterable of (scan id, site id, started_at, finished_at), such as scans
+        about to be archived, from the rollups of their sites and delete their own rollups
+        '''
+        increments, keys = {}, []
+        for scan_id, site_id, started_at, finished_at in scans:
+            seconds = (finished_at - started_at).total_seconds() if started_at and finished_at else 0
+            rollup_inc = increments.setdefault(cls.site_key(site_id), (site_id, None, {}))[2]
+            rollup_inc['scans'] = rollup_inc.get('scans', 0) - 1
+            rollup_inc['scan_seconds'] = rollup_inc.get('scan_seconds', 0) - seconds
+            keys.append(cls.scan_key(scan_id))
+        cls._increment(increments)
+        if keys:
+            cls._get_collection().delete_many({'_id': {'$in': keys}})
+
+    @classmethod
+    def for_site(cls, site):
+        '''Return the rollup of the given site or None if nothing was recorded for it
+        '''
+        return cls.objects(id=cls.site_key(site)).no_dereference().first()
+
+    @classmethod
+    def for_scan(cls, scan):
+        '''Return the rollup of the given scan or None if nothing was recorded for it
+        '''
+        return cls.objects(id=cls.scan_key(scan)).no_dereference().first()
+
+    @staticmethod
+    def _page_groups(collection, match):
+        '''Aggregate the WebDocuments of the given collection matching 'match' on the server into their number of pages,
+        cover pages and content bytes per site, scan and level
+        '''
+        pipeline = [
+            {'$match': match},
+            {'$project': {'site': True, 'scan': True, 'level': True, 'is_cover': True,
+                          'content_bytes': Statistics.CONTENT_BYTES}},
+            {'$group': {'_id': {'site': '$site', 'scan': '$scan', 'level': '$level'}, 'pages': {'$sum': 1},
+                        'cover_pages': {'$sum': {'$cond': ['$is_cover', 1, 0]}},
+                        'content_bytes': {'$sum': '$content_bytes'}}},
+        ]
+        return collection.aggregate(pipeline, allowDiskUse=True)
+
+    @classmethod
+    def record_removed_pages(cls, collection, match=None):
+        '''Subtract the WebDocuments of the given collection, such as a partition about to be dropped, from the rollups
+        of their sites and scans
+
+        :param match: query selecting the pages about to be removed. All pages of the collection by default
+        :return: set of the ids of the sites whose pages were subtracted
+        '''
+        increments = {}
+        for group in cls._page_groups(collection, match or {}):
+            site_id, scan_id, level = group['_id']['site'], group['_id'].get('scan'), group['_id'].get('level')
+            inc = {'pages': -group['pages'], f"levels.{level}": -group['pages'],
+                   'cover_pages': -group['cover_pages'], 'content_bytes': -group['content_bytes']}
+            for key, rollup_site_id, rollup_scan_id in cls._rollup_keys(site_id, scan_id):
+                rollup_inc = increments.setdefault(key, (rollup_site_id, rollup_scan_id, {}))[2]
+                for field, value in inc.items():
+                    rollup_inc[field] = rollup_inc.get(field, 0) + value
+        cls._increment(increments)
+        return {site_id for site_id, _, _ in increments.values()}
+
+    @classmethod
+    def rebuild(cls, site=None, batch_size=1000):
+        '''Recompute the rollups of a site, or of all sites, from scratch by aggregating WebDocuments and Scans on the
+        server. Meant to repair rollups that drifted, for instance after documents were written bypassing this module.
+
+        :param site: Sites object or id to be rebuilt. All sites are rebuilt by default
+        :param batch_size: number of rollups written per round trip
+        :return: number of rollups written
+        '''
+        match = {} if site is None else {'site': getattr(site, 'pk', site)}
+        rollups = {}
+
+        def rollup(site_id, scan_id):
+            key = cls.site_key(site_id) if scan_id is None else cls.scan_key(scan_id)
+            if key not in rollups:
+                rollups[key] = {'_id': key, 'site': site_id, 'pages': 0, 'cover_pages': 0, 'content_bytes': 0,
+                                'levels': {}, 'scans': 0, 'scan_seconds': 0.0}
+                if scan_id is not None:
+                    rollups[key]['scan'] = scan_id
+            return rollups[key]
+
+        for group in cls._page_groups(WebDocuments._get_collection(), match):
+            site_id, scan_id, level = group['_id']['site'], group['_id'].get('scan'), group['_id'].get('level')
+            for entry in (rollup(site_id, None), rollup(site_id, scan_id)):
+                entry['pages'] += group['pages']
+                entry['cover_pages'] += group['cover_pages']
+                entry['content_bytes'] += group['content_bytes']
+                entry['levels'][str(level)] = entry['levels'].get(str(level), 0) + group['pages']
+
+        scans_query = dict(match, is_active={'$ne': True}, finished_at={'$ne': None})
+        cursor = Scans._get_collection().find(scans_query, {'site': True, 'started_at': True, 'finished_at': True})
+        for scan in cursor.batch_size(batch_size):
+            started_at = scan.get('started_at')
+            seconds = (scan['finished_at'] - started_at).total_seconds() if started_at else 0
+            for entry in (rollup(scan['site'], None), rollup(scan['site'], scan['_id'])):
+                entry['scans'] += 1
+                entry['scan_seconds'] += seconds
+
+        collection = cls._get_collection()
+        collection.delete_many(match)
+        now = datetime.datetime.utcnow()
+        entries = list(rollups.values())
+        for start in range(0, len(entries), batch_size):
+            collection.insert_many([dict(entry, updated=now) for entry in entries[start:start + batch_size]])
+        return len(entries)
+
+
+class ScanEvents(Document):
+    '''Capped collection streaming the progress of scans, so that the control server is notified of scan starts,
+    finishes and ingested pages through a tailable cursor instead of polling Scans and ServerInstructions.
+
+    Events are appended by the model layer when an active scan is inserted or a stored one is activated, when a scan is
+    finished, whether through 'Scans.finish', 'save' or 'bulk_update', or released along with a stale peer, and whenever
+    pages are inserted, one event per scan and write. Pages inserted within 'WebDocuments.batched_bookkeeping' are thus
+    streamed as one event per scan and batch, which bulk ingest should use so that the capped collection does not grow
+    by one event per page. Scans, peers and sites are held as plain ids so that consumers never dereference them. Being
+    capped, the oldest events are overwritten once SCAN_EVENTS_MAX_SIZE bytes or SCAN_EVENTS_MAX_DOCUMENTS events are
+    reached.
+    '''
+    STARTED = 'started'
+    FINISHED = 'finished'
+    RELEASED = 'released'  # Scan closed because its peer stopped sending heartbeats
+    PAGES = 'pages'
+    EVENTS = [STARTED, FINISHED, RELEASED, PAGES]
+
+    scan = mongoengine.ObjectIdField()
+    peer = mongoengine.ObjectIdField()  # Only known for scan state transitions
+    site = mongoengine.ObjectIdField()
+    event = mongoengine.StringField(required=True, choices=EVENTS)
+    pages = mongoengine.IntField()
+    cover_pages = mongoengine.IntField()
+    content_bytes = mongoengine.IntField()
+    scan_seconds = mongoengine.FloatField()
+    created = mongoengine.DateTimeField(default=datetime.datetime.utcnow)
+
+    meta = {'max_size': SCAN_EVENTS_MAX_SIZE, 'max_documents': SCAN_EVENTS_MAX_DOCUMENTS}
+
+    @classmethod
+    def _record(cls, events, now=None):
+        '''Append the given list of raw events through a single unordered 'insert_many'
+        '''
+        if not events:
+            return
+        now = now or datetime.datetime.utcnow()
+        cls._get_collection().insert_many([dict(event, created=now) for event in events], ordered=False)
+
+    @classmethod
+    def record_started(cls, scans):
+        '''Record the start of the given Scans objects
+        '''
+        cls._record([{'scan': scan.id, 'peer': _reference_id(scan, 'peer'), 'site': _reference_id(scan, 'site'),
+                      'event': cls.STARTED} for scan in scans])
+
+    @classmethod
+    def record_finished(cls, scans, event=FINISHED):
+        '''Record the end of scans given as an iterable of (scan id, peer id, site id, started_at, finished_at)
+
+        :param event: FINISHED or RELEASED
+        '''
+        cls._record([{'scan': scan_id, 'peer': peer_id, 'site': site_id, 'event': event,
+                      'scan_seconds': (finished_at - started_at).total_seconds() if started_at and finished_at else 0}
+                     for scan_id, peer_id, site_id, started_at, finished_at in scans])
+
+    @classmethod
+    def record_scan_changes(cls, changes):
+        '''Record the starts and finishes of stored Scans given as (state before, state after) as returned by
+        'Scans._tracked_state': scans becoming active are recorded as STARTED and scans closed, being inactive with a
+        'finished_at', as FINISHED. Scans deleted meanwhile are skipped
+        '''
+        started, finished = [], []
+        for before, after in changes:
+            if after is None:
+                continue
+            if after.get('is_active') and not before.get('is_active'):
+                started.append({'scan': after['_id'], 'peer': after.get('peer'), 'site': after.get('site'),
+                                'event': cls.STARTED})
+            elif not after.get('is_active') and after.get('finished_at') is not None and \
+                    (before.get('is_active') or before.get('finished_at') is None):
+                finished.append((after['_id'], after.get('peer'), after.get('site'), after.get('started_at'),
+                                 after['finished_at']))
+        cls._record(started)
+        cls.record_finished(finished)
+
+    @classmethod
+    def record_pages(cls, documents):
+        '''Record the ingestion of the given WebDocuments, as one event per scan holding the counts of its pages
+        '''
+        events = {}
+        for document in documents:
+            key = (_reference_id(document, 'site'), _reference_id(document, 'scan'))
+            event = events.setdefault(key, {'scan': key[1], 'site': key[0], 'event': cls.PAGES, 'pages': 0,
+                                            'cover_pages': 0, 'content_bytes': 0})
+            event['pages'] += 1
+            event['cover_pages'] += 1 if document.is_cover else 0
+            event['content_bytes'] += Statistics._content_bytes(document.content)
+        cls._record(list(events.values()))
+
+    @classmethod
+    def tail(cls, after=None, since=None, await_time_ms=1000, idle_timeout=None, **filters):
+        '''Generator of the events matching the given filters as they are recorded, read through a tailable await
+        cursor that blocks on the server for up to 'await_time_ms' while no new event arrives. The cursor is reopened
+        from the last event seen if it dies, for instance because the collection was empty or was overrun.
+
+        Consumers resume after a restart by giving the id of the last event they processed as 'after'. Events are
+        ordered by insertion, whereas ids of events written in the same second by different processes may not follow
+        that order. Consumers that cannot afford to miss such events can resume 'since' a datetime a little earlier
+        than that event and skip the ids they already processed.
+
+        :param after: id of the last event seen. Only later events are returned
+        :param since: datetime from which events are returned if 'after' is not given. All events kept are returned
+        by default
+        :param await_time_ms: maximum number of milliseconds the server waits for new events before returning control
+        :param idle_timeout: number of seconds without new events after which the generator stops. It never stops by
+        default
+        :param filters: Mongoengine filters on the events, such as scan=<id> or event=ScanEvents.FINISHED
+        :return: generator of ScanEvents objects
+        '''
+        collection = cls._get_collection()
+        query = _raw_query(cls, **filters)
+        last_event = time.monotonic()
+        while True:
+            cursor_query = dict(query)
+            if after is not None:
+                cursor_query['_id'] = {'$gt': after}
+            elif since is not None:
+                cursor_query['_id'] = {'$gte': bson.ObjectId.from_datetime(since)}
+            try:
+                cursor = collection.find(cursor_query, cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+                cursor.max_await_time_ms(await_time_ms)
+                while cursor.alive:
+                    for son in cursor:
+                        after = son['_id']
+                        last_event = time.monotonic()
+                        yield cls._from_son(son)
+                    if idle_timeout is not None and time.monotonic() - last_event >= idle_timeout:
+                        return
+            except pymongo.errors.OperationFailure as ex:
+                if ex.code != CAPPED_POSITION_LOST:
+                    raise
+            if idle_timeout is not None and time.monotonic() - last_event >= idle_timeout:
+                return
+            time.sleep(await_time_ms / 1000)
@@ -0,0 +1,291 @@
+'''Time-partitioned storage of WebDocuments, so that the indexes of recent scans fit in memory and old pages are removed
+by dropping whole collections rather than through 'delete_many'.
+
+Pages are routed to one collection per period, named after the collection of the model and the start of the period,
+such as 'web_documents_2026_10' when partitioning monthly. The period of a page is given either by the 'started_at' of
+its scan, which keeps all pages of a scan and hence their hierarchy within the same partition, or by its own 'created'.
+
+Documents saved or loaded through Partitions are bound to the collection of their partition in the same terms as
+'Document.switch_collection' does, so that later saves, content versions or fetch metadata of those documents keep
+going to their partition, and queries run on QuerySets built on the collection of each partition. None of them alters
+the model class, so routers are safe to share between threads. Class methods reading WebDocuments, such as
+'descendants', 'recrawl_frontier', 'changed_urls' or 'url_exists', take the router as their 'partitions' argument and
+fan out over the collection of the model and those of the partitions. The collections of the partitions are created
+along with all indexes of the model the first time they are used, and the pymongo collections cached by routers are
+dropped in forked children along with the clients of the parent.
+'''
+import datetime
+import itertools
+import re
+import weakref
+import mongoengine
+
+from distpickymodel import connection, errors, models
+
+MONTHLY = 'monthly'
+DAILY = 'daily'
+PERIODS = [MONTHLY, DAILY]
+BY_SCAN = 'scan'
+BY_CREATED = 'created'
+KEYS = [BY_SCAN, BY_CREATED]
+MAX_CACHED_SCANS = 10000
+
+_SUFFIX_FORMATS = {MONTHLY: '%Y_%m', DAILY: '%Y_%m_%d'}
+_SUFFIX_PATTERNS = {MONTHLY: r'\d{4}_\d{2}', DAILY: r'\d{4}_\d{2}_\d{2}'}
+_routers = weakref.WeakSet()  # Routers whose cached collections are dropped along with the clients
+
+
+def period_start(when, period=MONTHLY):
+    '''Return the start of the period the given datetime belongs to
+    '''
+    start = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return start.replace(day=1) if period == MONTHLY else start
+
+
+def period_end(start, period=MONTHLY):
+    '''Return the start of the period following the one starting at 'start'
+    '''
+    if period == MONTHLY:
+        return (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return start + datetime.timedelta(days=1)
+
+
+class Partitions:
+    '''Router of the documents of a model to per-period collections
+    '''
+
+    def __init__(self, model=models.WebDocuments, period=MONTHLY, key=BY_SCAN):
+        '''
+        :param model: Document class to be partitioned. Its documents must have a 'created' field, and a 'scan'
+        reference if partitioned BY_SCAN
+        :param period: MONTHLY or DAILY
+        :param key: BY_SCAN to partition on the 'started_at' of the scan of each document, BY_CREATED on its 'created'
+        '''
+        if period not in PERIODS:
+            raise errors.DbModelOperationError(f"Only the following periods are available '{PERIODS}'. "
+                                               f"Instead: '{period}'")
+        if key not in KEYS:
+            raise errors.DbModelOperationError(f"Only the following keys are available '{KEYS}'. Instead: '{key}'")
+        self.model = model
+        self.period = period
+        self.key = key
+        self.prefix = model._meta['collection']
+        self._name_regex = re.compile(rf"^{re.escape(self.prefix)}_({_SUFFIX_PATTERNS[period]})$")
+        self._collections = {}  # Partition name -> pymongo collection
+        self._indexed = set()  # Names of the partitions whose indexes were ensured
+        self._scan_starts = {}  # Scan id -> started_at, for BY_SCAN
+        _routers.add(self)
+
+    # Naming
+
+    def name_for(self, when):
+        '''Return the name of the partition holding the documents of the given datetime
+        '''
+        return f"{self.prefix}_{period_start(when, self.period).strftime(_SUFFIX_FORMATS[self.period])}"
+
+    def start_of(self, name):
+        '''Return the start of the period of the given partition name
+        '''
+        match = self._name_regex.match(name)
+        if not match:
+            raise errors.DbModelOperationError(f"'{name}' is not a partition of '{self.prefix}'")
+        return datetime.datetime.strptime(match.group(1), _SUFFIX_FORMATS[self.period])
+
+    def _scan_start(self, document):
+        scan = document._data.get('scan')
+        started_at = getattr(scan, 'started_at', None)
+        if started_at is not None:
+            return started_at
+        scan_id = models._reference_id(document, 'scan')
+        if scan_id not in self._scan_starts:
+            if len(self._scan_starts) >= MAX_CACHED_SCANS:
+                self._scan_starts.clear()
+            son = models.Scans._get_collection().find_one({'_id': scan_id}, {'started_at': True})
+            self._scan_starts[scan_id] = son.get('started_at') if son else None
+        return self._scan_starts[scan_id]
+
+    def partition_of(self, document):
+        '''Return the name of the partition of the given document: the one it is bound to, if any, or else the one of
+        the 'started_at' of its scan or of its 'created', depending on the key. Documents whose scan has not started are
+        partitioned on their 'created'
+        '''
+        name = getattr(document, '_partition', None)
+        if name is not None and self._name_regex.match(name):
+            return name
+        when = self._scan_start(document) if self.key == BY_SCAN else None
+        return self.name_for(when or document.created or datetime.datetime.utcnow())
+
+    def partitions(self, start=None, end=None):
+        '''Return the names of the existing partitions, oldest first, optionally only those overlapping [start, end)
+        '''
+        names = sorted(name for name in self.model._get_db().list_collection_names() if self._name_regex.match(name))
+        return [name for name in names
+                if (end is None or self.start_of(name) < end)
+                and (start is None or period_end(self.start_of(name), self.period) > start)]
+
+    # Routing
+
+    def collection(self, name):
+        '''Return the pymongo collection of the given partition, creating it along with the indexes of the model if
+        used for the first time by this router
+        '''
+        connection.reset_if_forked()
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self.model._get_db()[name]
+            if name not in self._indexed:
+                self._ensure_indexes(collection)
+                self._indexed.add(name)
+            self._collections[name] = collection
+        return collection
+
+    def collections(self, start=None, end=None):
+        '''Return the pymongo collections of the existing partitions, oldest first, in the same terms as 'partitions'
+        '''
+        return [self.collection(name) for name in self.partitions(start, end)]
+
+    def _forget_collections(self):
+        self._collections.clear()
+
+    def _ensure_indexes(self, collection):
+        '''Create the indexes declared by the model on the given collection, in the same terms as 'ensure_indexes' does
+        on the collection of the model
+        '''
+        meta = self.model._meta
+        background = meta.get('index_background', False)
+        index_opts = {key: value for key, value in (meta.get('index_opts') or {}).items() if key != 'cls'}
+        cls_indexed = False
+        for spec in meta.get('index_specs') or []:
+            options = dict(index_opts, **spec)
+            fields = options.pop('fields')
+            options.pop('cls', None)
+            cls_indexed = cls_indexed or (fields and fields[0][0] == '_cls')
+            collection.create_index(fields, background=background, **options)
+        if meta.get('index_cls', True) and not cls_indexed and meta.get('allow_inheritance'):
+            collection.create_index('_cls', background=background, **index_opts)
+
+    def bind(self, document, partition=None):
+        '''Bind the given document to the collection of its partition, as 'Document.switch_collection' does. The
+        collection is looked up through the router on every use, so that bound documents do not keep the collections of
+        the parent process in forked children
+
+        :param partition: partition name. It defaults to the one given by 'partition_of'
+        :return: the document
+        '''
+        name = partition or self.partition_of(document)
+        self.collection(name)
+        document._get_collection = lambda: self.collection(name)
+        document._partition = name
+        return document
+
+    def save(self, document, *args, **kwargs):
+        '''Save the given document into its partition in the same terms as its 'save' method does
+        '''
+        created = document._created or document.pk is None
+        result = self.bind(document).save(*args, **kwargs)
+        if created:
+            self._retire_older_copies(document)
+        return result
+
+    def save_with_uniqueness(self, document, many_unique, raw=False):
+        '''Save the given document into its partition in the same terms as its 'save_with_uniqueness' method does
+        '''
+        created = document._created or document.pk is None
+        result = self.bind(document).save_with_uniqueness(many_unique, raw=raw)
+        if created:
+            self._retire_older_copies(document)
+        return result
+
+    def _retire_older_copies(self, document):
+        '''Remove the 'next_fetch' of the copies of a newly inserted page stored in the collection of the model or in
+        older partitions, those of its own partition being retired when it is inserted, so that only the latest copy of
+        each url is in the recrawl frontier across partitions
+        '''
+        if self.model is not models.WebDocuments:
+            return
+        collections = [self.model._get_collection()] + self.collections(end=self.start_of(document._partition))
+        self.model.retire_older_copies([document], collections=collections)
+
+    def bulk_update(self, documents, **kwargs):
+        '''Update the given documents in bulk in the same terms as 'bulk_update' does, through one call per partition.
+        The 'index' of the write errors returned still refers to the position of each document in 'documents'.
+
+        :param kwargs: keyword arguments of 'bulk_update'
+        '''
+        groups = {}
+        for index, document in enumerate(documents):
+            groups.setdefault(self.partition_of(document), []).append(index)
+        full_result = kwargs.get('full_result', False)
+        merged = {'nMatched': 0, 'nModified': 0, 'nRetried': 0, 'writeErrors': [], 'writeConcernErrors': []}
+        for name, indexes in groups.items():
+            result = self.model.bulk_update([self.bind(documents[index], name) for index in indexes], **kwargs)
+            write_errors = result['writeErrors'] if full_result else result
+            merged['writeErrors'].extend(dict(error, index=indexes[error['index']]) for error in write_errors)
+            if full_result:
+                for field in ('nMatched', 'nModified', 'nRetried'):
+                    merged[field] += result[field]
+                merged['writeConcernErrors'].extend(result['writeConcernErrors'])
+        merged['writeErrors'].sort(key=lambda error: error['index'])
+        return merged if full_result else merged['writeErrors']
+
+    # Reading
+
+    def querysets(self, start=None, end=None, **filters):
+        '''Return one QuerySet per existing partition overlapping [start, end), oldest first, so that queries on recent
+        periods never touch older partitions. When partitioned BY_CREATED, documents are also filtered on 'created'
+        being within [start, end). When partitioned BY_SCAN, whole periods of scan starts are selected.
+
+        :param filters: Mongoengine query filters such as site=site
+        :return: list of (partition name, QuerySet)
+        '''
+        if self.key == BY_CREATED:
+            if start is not None:
+                filters['created__gte'] = start
+            if end is not None:
+                filters['created__lt'] = end
+        return [(name, mongoengine.QuerySet(self.model, self.collection(name)).filter(**filters))
+                for name in self.partitions(start, end)]
+
+    def objects(self, start=None, end=None, **filters):
+        '''Generator of the documents matching the given filters across the partitions overlapping [start, end), in the
+        same terms as 'querysets'. Documents are bound to their partition.
+        '''
+        return itertools.chain.from_iterable((self.bind(document, name) for document in queryset)
+                                             for name, queryset in self.querysets(start, end, **filters))
+
+    def count(self, start=None, end=None, **filters):
+        '''Return the number of documents matching the given filters across the partitions overlapping [start, end)
+        '''
+        return sum(queryset.count() for _, queryset in self.querysets(start, end, **filters))
+
+    # Retention
+
+    def drop_before(self, when):
+        '''Drop the partitions whose whole period is older than the given datetime, one collection drop each whatever
+        their number of documents. The pages dropped are subtracted from the statistics rollups beforehand, and the
+        seen-url filters of their sites are rebuilt from the remaining partitions afterwards, as Bloom filters cannot
+        forget urls.
+
+        :return: list of the names of the partitions dropped
+        '''
+        dropped, sites = [], set()
+        database = self.model._get_db()
+        for name in self.partitions(end=when):
+            if period_end(self.start_of(name), self.period) <= when:
+                if self.model is models.WebDocuments:
+                    sites.update(models.Statistics.record_removed_pages(database[name]))
+                database.drop_collection(name)
+                self._collections.pop(name, None)
+                self._indexed.discard(name)
+                dropped.append(name)
+        if sites:
+            models.SeenUrlFilters.rebuild(sites, collections=[], partitions=self)
+        return dropped
+
+
+def _forget_collections():
+    for router in list(_routers):
+        router._forget_collections()
+
+
+connection.register_cache_reset(_forget_collections)
@@ -0,0 +1,189 @@
+'''Read-only views over raw BSON documents, as returned by queries using RAW_CODEC_OPTIONS, that decode fields lazily.
+
+Creating a view only keeps a reference to the bytes received from the server. The first access to a field walks the
+elements of the document once to record where each of them starts and ends, skipping over their values, and only the
+field accessed is decoded. Embedded documents, such as the content versions of a page, are views over the same bytes,
+and 'bytes_of' returns string and binary values as memoryviews over them, so that page bodies can be forwarded without
+being decoded or copied.
+'''
+import struct
+import bson
+
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from distpickymodel import errors
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+_INT32 = struct.Struct('<i')
+_FIXED_SIZES = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0,
+                0xFF: 0}
+_STRING_TYPES = (0x02, 0x0D, 0x0E)
+_DOCUMENT_TYPE = 0x03
+_ARRAY_TYPE = 0x04
+_BINARY_TYPE = 0x05
+
+
+def _value_end(data, element_type, start):
+    '''Return the position right after the value of the given type starting at 'start'
+    '''
+    size = _FIXED_SIZES.get(element_type)
+    if size is not None:
+        return start + size
+    if element_type in _STRING_TYPES:
+        return start + 4 + _INT32.unpack_from(data, start)[0]
+    if element_type in (_DOCUMENT_TYPE, _ARRAY_TYPE, 0x0F):
+        return start + _INT32.unpack_from(data, start)[0]
+    if element_type == _BINARY_TYPE:
+        return start + 5 + _INT32.unpack_from(data, start)[0]
+    if element_type == 0x0B:
+        return data.index(b'\x00', data.index(b'\x00', start) + 1) + 1
+    if element_type == 0x0C:
+        return start + 4 + _INT32.unpack_from(data, start)[0] + 12
+    raise errors.DbModelOperationError(f"Unknown BSON type {element_type:#04x} at position {start}")
+
+
+def _elements(data, start, end):
+    '''Return a dictionary of name -> (type, element start, value start, value end) of the elements of the document
+    spanning data[start:end]
+    '''
+    elements = {}
+    position = start + 4
+    end -= 1  # Trailing null byte
+    while position < end:
+        element_type = data[position]
+        name_end = data.index(b'\x00', position + 1)
+        value_start = name_end + 1
+        value_end = _value_end(data, element_type, value_start)
+        elements[data[position + 1:name_end].decode('utf-8')] = (element_type, position, value_start, value_end)
+        position = value_end
+    return elements
+
+
+class RawView:
+    '''Lazy read-only view of a BSON document. Fields are available both as attributes and as keys, 'id' standing for
+    '_id'. Embedded documents are returned as views of the class given for their field in EMBEDDED, if any
+    '''
+    EMBEDDED = {}
+
+    __slots__ = ('_data', '_start', '_end', '_elements')
+
+    def __init__(self, document, start=0, end=None):
+        '''
+        :param document: RawBSONDocument or bytes of a BSON document
+        :param start: position at which the document starts within the bytes, if embedded in another document
+        :param end: position right after the end of the document
+        '''
+        self._data = document.raw if isinstance(document, RawBSONDocument) else document
+        self._start = start
+        self._end = end if end is not None else start + _INT32.unpack_from(self._data, start)[0]
+        self._elements = None
+
+    def _element(self, key):
+        if self._elements is None:
+            self._elements = _elements(self._data, self._start, self._end)
+        return self._elements.get(key)
+
+    def _decode(self, key, element):
+        element_type, element_start, value_start, value_end = element
+        data = self._data
+        if element_type == _DOCUMENT_TYPE:
+            return self.EMBEDDED.get(key, RawView)(data, value_start, value_end)
+        if element_type == _ARRAY_TYPE:
+            view_cls = self.EMBEDDED.get(key, RawView)
+            items = _elements(data, value_start, value_end).values()
+            return [view_cls(data, start, end) if item_type == _DOCUMENT_TYPE else
+                    self._decode(key, (item_type, item_start, start, end))
+                    for item_type, item_start, start, end in items]
+        if element_type == 0x02:
+            return data[value_start + 4:value_end - 1].decode('utf-8')
+        # Any other value is decoded by wrapping the bytes of its element alone into a document of its own
+        name_size = value_start - element_start
+        size = 4 + value_end - element_start + 1
+        element_bytes = _INT32.pack(size) + data[element_start:value_end] + b'\x00'
+        return bson.BSON(element_bytes).decode()[data[element_start + 1:element_start + name_size - 1].decode('utf-8')]
+
+    def __getitem__(self, key):
+        element = self._element(key)
+        if element is None:
+            raise KeyError(key)
+        return self._decode(key, element)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        key = '_id' if name == 'id' else name
+        element = self._element(key)
+        return self._decode(key, element) if element is not None else None
+
+    def __setattr__(self, name, value):
+        if name in RawView.__slots__:
+            return object.__setattr__(self, name, value)
+        raise AttributeError(f"'{type(self).__name__}' objects are read-only")
+
+    def __contains__(self, key):
+        return self._element(key) is not None
+
+    def get(self, key, default=None):
+        element = self._element(key)
+        return self._decode(key, element) if element is not None else default
+
+    def keys(self):
+        self._element('_id')
+        return list(self._elements)
+
+    def bytes_of(self, key):
+        '''Return a memoryview over the bytes of a string, without its trailing null byte, or of a binary value, or None
+        if the field is missing or null
+        '''
+        element = self._element(key)
+        if element is None or element[0] == 0x0A:
+            return None
+        element_type, _, value_start, value_end = element
+        if element_type in _STRING_TYPES:
+            return memoryview(self._data)[value_start + 4:value_end - 1]
+        if element_type == _BINARY_TYPE:
+            return memoryview(self._data)[value_start + 5:value_end]
+        raise errors.DbModelOperationError(f"Field '{key}' holds neither a string nor a binary value")
+
+    @property
+    def raw(self):
+        '''Bytes of this document, copied out of the enclosing one if embedded
+        '''
+        if self._start == 0 and self._end == len(self._data):
+            return self._data
+        return self._data[self._start:self._end]
+
+    def to_dict(self):
+        return bson.BSON(self.raw).decode()
+
+    def __repr__(self):
+        return f"{type(self).__name__}(id={self.get('_id')!r})"
+
+
+class RawWebContent(RawView):
+    '''View of a content version of a page whose 'content' is a memoryview over the UTF-8 bytes of the body
+    '''
+    __slots__ = ()
+
+    @property
+    def content(self):
+        return self.bytes_of('content')
+
+    @property
+    def text(self):
+        return self.get('content')
+
+
+class RawWebDocument(RawView):
+    '''View of a page whose content versions are RawWebContent views
+    '''
+    __slots__ = ()
+    EMBEDDED = {'content': RawWebContent}
+
+    @property
+    def latest_content(self):
+        '''Latest content version of the page, or None if it has none
+        '''
+        versions = self.content
+        return versions[-1] if versions else None
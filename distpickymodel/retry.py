@@ -0,0 +1,88 @@
+'''Retry policy applied to the operations of a bulk write that fail because of transient conditions of the cluster,
+such as an election, a primary stepping down or a network error, rather than because of the operation itself.
+
+Write concern timeouts are not retried by default: the writes were applied on the primary, only their replication was
+not acknowledged in time, so sending them again applies them twice. Policies may opt in for operations known to be
+idempotent.
+'''
+import random
+import time
+
+from pymongo import errors as pymongo_errors
+
+# Server error codes of transient conditions, as considered retryable by the MongoDB drivers
+RETRYABLE_ERROR_CODES = frozenset({
+    6,  # HostUnreachable
+    7,  # HostNotFound
+    89,  # NetworkTimeout
+    91,  # ShutdownInProgress
+    189,  # PrimarySteppedDown
+    262,  # ExceededTimeLimit
+    9001,  # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+    13436,  # NotPrimaryOrSecondary
+})
+# Failures of a whole request, after which it is unknown which of its operations were applied
+RETRYABLE_EXCEPTIONS = (pymongo_errors.AutoReconnect,)
+WRITE_CONCERN_FAILED = 64
+
+
+class RetryPolicy:
+    '''How many times, and how long apart, operations failing with retryable errors are resubmitted. Only operations
+    that are safe to be applied more than once, such as the '$set' of bulk_update, should be retried.
+    '''
+
+    def __init__(self, max_attempts=3, backoff=0.1, multiplier=2.0, max_backoff=5.0, jitter=True,
+                 retryable_codes=RETRYABLE_ERROR_CODES, sleep=time.sleep, retry_write_concern_timeouts=False):
+        '''
+        :param max_attempts: maximum number of times an operation is sent, the first one included
+        :param backoff: seconds waited before the first retry
+        :param multiplier: factor by which the wait grows after each retry
+        :param max_backoff: maximum number of seconds waited before any retry
+        :param jitter: if True, each wait is randomly shortened by up to half so that clients do not retry in lockstep
+        :param retryable_codes: server error codes considered retryable
+        :param sleep: function used to wait
+        :param retry_write_concern_timeouts: if True, requests failing with a write concern timeout are sent again.
+        Their writes were already applied, so this is only safe when every operation retried is idempotent
+        '''
+        if max_attempts < 1:
+            raise ValueError(f"'max_attempts' must be at least 1, not {max_attempts}")
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retryable_codes = frozenset(retryable_codes)
+        self.sleep = sleep
+        self.retry_write_concern_timeouts = retry_write_concern_timeouts
+
+    def is_retryable_error(self, write_error):
+        '''Check whether an entry of the 'writeErrors' of a bulk write failed because of a transient condition
+        '''
+        return write_error.get('code') in self.retryable_codes
+
+    def is_retryable_exception(self, exception):
+        '''Check whether an exception raised by a whole request was caused by a transient condition
+        '''
+        if isinstance(exception, pymongo_errors.WTimeoutError) or \
+                getattr(exception, 'code', None) == WRITE_CONCERN_FAILED:
+            return self.retry_write_concern_timeouts
+        if isinstance(exception, RETRYABLE_EXCEPTIONS):
+            return True
+        return isinstance(exception, pymongo_errors.OperationFailure) and exception.code in self.retryable_codes
+
+    def delay(self, attempt):
+        '''Seconds to wait before sending the given attempt, the first retry being attempt 2
+        '''
+        delay = min(self.backoff * self.multiplier ** (attempt - 2), self.max_backoff)
+        return random.uniform(delay / 2, delay) if self.jitter else delay
+
+    def wait(self, attempt):
+        self.sleep(self.delay(attempt))
+
+
+NO_RETRY = RetryPolicy(max_attempts=1)
+DEFAULT_RETRY_POLICY = RetryPolicy()
@@ -0,0 +1,166 @@
+'''Generation of MongoDB '$jsonSchema' validators from the model definitions, so that the server enforces the same
+constraints as Mongoengine's validation and ingest hot paths can skip the latter.
+
+Each field is translated into the BSON types Mongoengine stores it as, along with its 'required' flag, its 'choices' as
+an 'enum', the 'min_value'/'max_value' of numbers, the 'min_length'/'max_length' of strings and the 'regex' of
+StringFields as a 'pattern'. Embedded documents and lists are translated recursively. Patterns are anchored at the start
+as 're.match' does, whereas '$' matches right before a trailing newline both in Python and in the server's PCRE.
+Fields of types not listed in BSON_TYPES are not constrained.
+
+Documents of the subclasses stored in the same collection as a model, such as ExtendedScans in that of Scans, must
+satisfy the schema of their own class as given by their '_cls'. Documents without '_cls' must satisfy that of the model.
+'''
+import re
+import mongoengine
+import pymongo
+
+from mongoengine.base import get_document
+from distpickymodel import errors, models, extended_model
+
+NAMESPACE_NOT_FOUND = 26
+VALIDATION_LEVEL = 'strict'
+VALIDATION_ACTION = 'error'
+
+# Models whose collections are validated by 'apply_validators' by default. The rollups, seen-url filters and scan events
+# are only written through raw pymongo operations of this library
+MODELS = [models.Peers, models.Sites, models.Scans, models.ScanSettings, models.WebDocuments,
+          extended_model.ServerInstructions]
+
+# Field classes and the BSON types they are stored as, subclasses first
+BSON_TYPES = [
+    (mongoengine.ObjectIdField, ['objectId']),
+    (mongoengine.CachedReferenceField, ['object']),
+    (mongoengine.GenericReferenceField, ['object']),
+    (mongoengine.GenericEmbeddedDocumentField, ['object']),
+    (mongoengine.BooleanField, ['bool']),
+    (mongoengine.DateTimeField, ['date']),
+    (mongoengine.ComplexDateTimeField, ['string']),
+    (mongoengine.StringField, ['string']),
+    (mongoengine.LongField, ['int', 'long']),
+    (mongoengine.IntField, ['int', 'long']),
+    (mongoengine.FloatField, ['double', 'int', 'long']),  # Integers pass Mongoengine's validation of floats
+    (mongoengine.BinaryField, ['binData']),
+    (mongoengine.DictField, ['object']),
+]
+
+_INLINE_FLAGS = re.compile(r'\(\?[a-zA-Z]+\)')
+
+
+def _anchored(pattern):
+    '''Return the given regular expression anchored at the start of the string, as 're.match' implicitly does
+    '''
+    flags = _INLINE_FLAGS.match(pattern)
+    body = pattern[flags.end():] if flags else pattern
+    if body.startswith('^'):
+        return pattern
+    return f"{flags.group() if flags else ''}^(?:{body})"
+
+
+def _choices(choices):
+    return [choice[0] if isinstance(choice, (list, tuple)) else choice for choice in choices]
+
+
+def field_schema(field):
+    '''Return the '$jsonSchema' of the values of the given Mongoengine field
+    '''
+    if isinstance(field, (mongoengine.ReferenceField, mongoengine.LazyReferenceField)):
+        schema = {'bsonType': 'object' if getattr(field, 'dbref', False) else 'objectId'}
+    elif isinstance(field, mongoengine.EmbeddedDocumentField):
+        schema = document_schema(field.document_type)
+    elif isinstance(field, mongoengine.ListField):
+        schema = {'bsonType': 'array'}
+        if field.field is not None:
+            schema['items'] = field_schema(field.field)
+    else:
+        schema = {}
+        for field_class, bson_types in BSON_TYPES:
+            if isinstance(field, field_class):
+                schema['bsonType'] = bson_types[0] if len(bson_types) == 1 else bson_types
+                break
+
+    if field.choices:
+        schema['enum'] = _choices(field.choices)
+    if getattr(field, 'min_value', None) is not None:
+        schema['minimum'] = field.min_value
+    if getattr(field, 'max_value', None) is not None:
+        schema['maximum'] = field.max_value
+    if isinstance(field, mongoengine.StringField):
+        if field.min_length is not None:
+            schema['minLength'] = field.min_length
+        if field.max_length is not None:
+            schema['maxLength'] = field.max_length
+        if field.regex is not None:
+            schema['pattern'] = _anchored(getattr(field.regex, 'pattern', field.regex))
+    return schema
+
+
+def document_schema(document_class, class_names=None):
+    '''Return the '$jsonSchema' of the documents of the given class, either top-level or embedded.
+
+    :param document_class: Mongoengine Document or EmbeddedDocument class
+    :param class_names: values of '_cls' the documents may have. '_cls' is not constrained by default
+    '''
+    properties, required = {}, []
+    for name in document_class._fields_ordered:
+        field = document_class._fields[name]
+        properties[field.db_field] = field_schema(field)
+        if field.required and not getattr(field, '_auto_gen', False):
+            required.append(field.db_field)
+    if class_names:
+        properties['_cls'] = {'bsonType': 'string', 'enum': list(class_names)}
+    schema = {'bsonType': 'object', 'properties': properties}
+    if required:
+        schema['required'] = required
+    return schema
+
+
+def json_schema(model):
+    '''Return the validator of the collection of the given model, covering the subclasses stored along with it
+
+    :param model: top-level Mongoengine Document class
+    :return: dictionary of the form {'$jsonSchema': {...}}
+    '''
+    subclasses = model._subclasses if model._meta.get('allow_inheritance') is True else (model._class_name,)
+    if len(subclasses) == 1:
+        return {'$jsonSchema': document_schema(model)}
+    branches = []
+    for class_name in subclasses:
+        schema = document_schema(get_document(class_name), class_names=[class_name])
+        if class_name != model._class_name:
+            schema['required'] = ['_cls'] + schema.get('required', [])
+        branches.append(schema)
+    return {'$jsonSchema': {'bsonType': 'object', 'anyOf': branches}}
+
+
+def apply_validator(model, validation_level=VALIDATION_LEVEL, validation_action=VALIDATION_ACTION):
+    '''Set the validator generated for the given model on its collection through 'collMod', creating the collection if
+    it does not exist yet.
+
+    :param model: top-level Mongoengine Document class
+    :param validation_level: 'strict' validates all inserts and updates, 'moderate' skips updates of existing documents
+    that are already invalid
+    :param validation_action: 'error' rejects invalid writes, 'warn' only logs them on the server
+    :return: the validator applied
+    '''
+    validator = json_schema(model)
+    options = {'validator': validator, 'validationLevel': validation_level, 'validationAction': validation_action}
+    collection = model._get_collection()
+    try:
+        try:
+            collection.database.command('collMod', collection.name, **options)
+        except pymongo.errors.OperationFailure as ex:
+            if ex.code != NAMESPACE_NOT_FOUND:
+                raise
+            collection.database.create_collection(collection.name, **options)
+    except pymongo.errors.PyMongoError as ex:
+        raise errors.DbModelOperationError(f"Validator of '{model.__name__}' could not be applied ({ex})") from ex
+    return validator
+
+
+def apply_validators(model_classes=None, **kwargs):
+    '''Apply the generated validators to the collections of the given models, or of all models in MODELS by default.
+    Keyword arguments are those of 'apply_validator'.
+
+    :return: dictionary of model name -> validator applied
+    '''
+    return {model.__name__: apply_validator(model, **kwargs) for model in (model_classes or MODELS)}
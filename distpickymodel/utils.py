@@ -1,4 +1,7 @@
+import hashlib
 import re
+import bson
+
 from datetime import datetime, timedelta
 
 ip_address_regex = re.compile(r'^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}'
@@ -48,3 +51,21 @@ def string_to_seconds(time_string):
     '''
     tokens = time_string.split(':')
     return int(tokens[0]) * 3600 + int(tokens[1]) * 60 + int(tokens[2]) + 1
+
+
+def value_key(value):
+    '''Return a hashable key representing the given database value so that duplicates can be detected with set-like
+    semantics. Unhashable values such as embedded documents are keyed by their BSON representation
+    '''
+    try:
+        hash(value)
+    except TypeError:
+        return bson.BSON.encode({'v': value})
+    return type(value), value
+
+
+def content_fingerprint(content):
+    '''Return the hexadecimal blake2b digest of the given page content so that byte-identical versions can be detected
+    without comparing the contents themselves
+    '''
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
@@ -0,0 +1,146 @@
+'''Dedicated validators that accept and reject exactly the same strings as the regular expressions of 'utils' they
+stand for, when matched with 're.match' as 'StringField.validate' does.
+
+Patterns are compiled once rather than looked up in the cache of the 're' module on every call, which also recompiles
+them whenever they are evicted. 'utils.url_regex' nests quantifiers over overlapping character classes, so its
+backtracking grows with the number of dots and colons of a host that ends up failing. Urls longer than
+URL_REGEX_MAX_LENGTH are hence validated by a linear parser that splits the host on its dots or colons and checks each
+part separately. Character classes are still matched through simple precompiled patterns so that their Unicode and
+case-insensitive semantics are those of the original expressions. Note that '$' also matches right before a trailing
+newline, hence such newline is always stripped before parsing.
+'''
+import re
+
+from distpickymodel import utils
+
+URL_PATTERN = r'(?i)' + utils.url_regex.pattern
+# Up to this length the compiled regex is faster on well-formed urls and its worst case is small
+URL_REGEX_MAX_LENGTH = 128
+
+_URL = re.compile(URL_PATTERN)
+
+_SCHEME = re.compile(r'https?://', re.IGNORECASE)
+_LOCALHOST = re.compile(r'localhost', re.IGNORECASE)
+_DOMAIN_RUN = re.compile(r'[A-Z0-9.-]*', re.IGNORECASE)
+_IPV4_RUN = re.compile(r'[\d.]*')
+_IPV6_RUN = re.compile(r'[A-F0-9:]*', re.IGNORECASE)
+_PORT = re.compile(r':\d+')
+_NON_SPACES = re.compile(r'\S+')
+_MAX_LABEL_LENGTH = 63
+
+
+def _strip_newline(value):
+    return value[:-1] if value.endswith('\n') else value
+
+
+def _is_url_tail(value, start):
+    '''Check whether value[start:] matches the optional port and path of the url regex: (?::\\d+)?(?:/?|[/?]\\S+)
+    '''
+    end = len(value)
+    port = _PORT.match(value, start)
+    if port:
+        start = port.end()
+    if start == end or (start + 1 == end and value[start] == '/'):
+        return True
+    return value[start] in '/?' and _NON_SPACES.fullmatch(value, start + 1) is not None
+
+
+def _is_domain(host):
+    '''Check whether host fully matches (?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\\.)+(?:[A-Z]{2,6}\\.?|[A-Z0-9-]{2,}\\.?)
+    given that it only holds characters of [A-Z0-9.-]. The first alternative of the top-level domain is contained in the
+    second one
+    '''
+    labels = (host[:-1] if host.endswith('.') else host).split('.')
+    if len(labels) < 2 or len(labels[-1]) < 2:
+        return False
+    return all(0 < len(label) <= _MAX_LABEL_LENGTH and label[0] != '-' and label[-1] != '-' for label in labels[:-1])
+
+
+def _is_ipv4_host(host):
+    '''Check whether host fully matches \\d{1,3}\\.\\d{1,3}\\.\\d{1,3}\\.\\d{1,3} given that it only holds digits and
+    dots
+    '''
+    parts = host.split('.')
+    return len(parts) == 4 and all(0 < len(part) <= 3 for part in parts)
+
+
+def _ipv6_host_ends(value, start):
+    '''Return the positions at which a host matching \\[?[A-F0-9]*:[A-F0-9:]+\\]? starting at 'start' may end and be
+    followed by a valid tail. Within the run of hexadecimal digits and colons, the tail can only start at the end of
+    the run or at its last colon, provided that what follows is a port
+    '''
+    if value.startswith('[', start):
+        start += 1
+    run_end = _IPV6_RUN.match(value, start).end()
+    first_colon = value.find(':', start, run_end)
+    if first_colon < 0 or run_end - first_colon < 2:
+        return []
+    ends = [run_end]
+    last_colon = value.rfind(':', first_colon + 1, run_end)
+    if last_colon > first_colon + 1:
+        ends.append(last_colon)
+    if value.startswith(']', run_end):
+        ends.append(run_end + 1)
+    return ends
+
+
+def _parse_url(value):
+    value = _strip_newline(value)
+    scheme = _SCHEME.match(value)
+    if not scheme:
+        return False
+    start = scheme.end()
+
+    end = _DOMAIN_RUN.match(value, start).end()
+    if end > start and _is_domain(value[start:end]) and _is_url_tail(value, end):
+        return True
+    end = _IPV4_RUN.match(value, start).end()
+    if end > start and _is_ipv4_host(value[start:end]) and _is_url_tail(value, end):
+        return True
+    if _LOCALHOST.match(value, start) and _is_url_tail(value, start + len('localhost')):
+        return True
+    return any(_is_url_tail(value, end) for end in _ipv6_host_ends(value, start))
+
+
+def is_url(value):
+    '''Equivalent to re.match(URL_PATTERN, value)
+    '''
+    if len(value) <= URL_REGEX_MAX_LENGTH:
+        return _URL.match(value) is not None
+    return _parse_url(value)
+
+
+def is_ip_address(value):
+    '''Equivalent to utils.ip_address_regex.match(value)
+    '''
+    return utils.ip_address_regex.match(value) is not None
+
+
+def is_version(value):
+    '''Equivalent to utils.version_regex.match(value), though faster as it only takes a few string operations
+    '''
+    major, dot, minor = _strip_newline(value).partition('.')
+    if not dot or not 0 < len(major) <= 2 or major[0] not in '123456789' or \
+            (len(major) == 2 and not major[1].isdecimal()):
+        return False
+    if len(minor) == 2:
+        return minor[0] != '0' and minor.isdecimal()
+    return len(minor) == 1 and minor.isdecimal()
+
+
+VALIDATORS = {
+    URL_PATTERN: is_url,
+    utils.ip_address_regex.pattern: is_ip_address,
+    utils.version_regex.pattern: is_version,
+}
+_compiled = {}
+
+
+def matcher_for(pattern):
+    '''Return the dedicated validator of the given pattern or, failing that, the 'match' method of the pattern compiled
+    once
+    '''
+    matcher = VALIDATORS.get(pattern) or _compiled.get(pattern)
+    if matcher is None:
+        matcher = _compiled[pattern] = re.compile(pattern).match
+    return matcher
@@ -0,0 +1,268 @@
+'''Compact binary codec used to ship ServerInstructions, ScanSettings and SiteInstructions from the server to workers.
+
+Documents are encoded as BSON under short keys and following a schema pinned to a version number, so that workers can
+decode messages produced by older or newer servers. Compared to Mongoengine's to_json:
+
+    - Datetimes are integers of microseconds since the epoch and the 'times' of the instructions packed day-seconds
+    - Weekdays become a bitmask and operations the index of their name in the operations of the schema
+    - Lists of ObjectIds, such as the scans of the settings, are packed into a single bytes value
+
+Messages decode into read-only named tuples without going through Mongoengine, whose lists are returned as tuples.
+'to_model' turns them back into the documents they were encoded from, field by field.
+'''
+import collections
+import datetime
+import struct
+import bson
+
+from distpickymodel import errors
+
+VERSION = 1
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_OBJECT_ID_SIZE = 12
+_MAX_DAY_SECONDS = 2 ** 32 - 1
+_NUM_WEEK_DAYS = 7
+
+_Codec = collections.namedtuple('_Codec', ['encode', 'decode'])
+
+
+def _encode_datetime(value):
+    if not isinstance(value, datetime.datetime) or value.tzinfo is not None:
+        raise errors.DbModelOperationError(f"Only naive datetimes can be encoded, not {value!r}")
+    return bson.Int64((value - _EPOCH) // _MICROSECOND)
+
+
+def _decode_datetime(value):
+    return _EPOCH + value * _MICROSECOND
+
+
+def _encode_datetimes(values):
+    return struct.pack(f"<{len(values)}q", *(_encode_datetime(value) for value in values))
+
+
+def _decode_datetimes(value):
+    return tuple(_decode_datetime(micros) for micros in struct.unpack(f"<{len(value) // 8}q", value))
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _encode_day_seconds(values):
+    '''Pack the seconds as unsigned 32 bit integers unless any of them would not fit, in which case they are sent as a
+    plain list
+    '''
+    if all(_is_int(value) and 0 <= value <= _MAX_DAY_SECONDS for value in values):
+        return struct.pack(f"<{len(values)}I", *values)
+    return list(values)
+
+
+def _decode_day_seconds(value):
+    return struct.unpack(f"<{len(value) // 4}I", value) if isinstance(value, bytes) else tuple(value)
+
+
+def _encode_weekdays(values):
+    '''Turn the weekdays into a bitmask provided that they are sorted and unique week days, as otherwise the bitmask
+    could not give them back as they are. In such case they are sent as a plain list
+    '''
+    values = list(values)
+    if all(_is_int(value) and 0 <= value < _NUM_WEEK_DAYS for value in values) and values == sorted(set(values)):
+        return sum(1 << value for value in values)
+    return values
+
+
+def _decode_weekdays(value):
+    if isinstance(value, list):
+        return tuple(value)
+    return tuple(day for day in range(_NUM_WEEK_DAYS) if value & (1 << day))
+
+
+def _id_of(value):
+    '''Return the ObjectId held by a reference, whether it is a document, a DBRef or the ObjectId itself
+    '''
+    value = getattr(value, 'pk', getattr(value, 'id', value))
+    if not isinstance(value, bson.ObjectId):
+        raise errors.DbModelOperationError(f"Only ObjectIds can be encoded as references, not {value!r}")
+    return value
+
+
+def _encode_ids(values):
+    return b''.join(_id_of(value).binary for value in values)
+
+
+def _decode_ids(value):
+    return tuple(bson.ObjectId(value[start:start + _OBJECT_ID_SIZE]) for start in range(0, len(value), _OBJECT_ID_SIZE))
+
+
+def _choice(choices):
+    def encode(value):
+        try:
+            return choices.index(value)
+        except ValueError:
+            raise errors.DbModelOperationError(f"'{value}' is not any of {choices}") from None
+
+    return _Codec(encode, choices.__getitem__)
+
+
+def _decode_value(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+ID = _Codec(_id_of, lambda value: value)
+VALUE = _Codec(lambda value: value, _decode_value)
+DATETIME = _Codec(_encode_datetime, _decode_datetime)
+DATETIMES = _Codec(_encode_datetimes, _decode_datetimes)
+DAY_SECONDS = _Codec(_encode_day_seconds, _decode_day_seconds)
+WEEKDAYS = _Codec(_encode_weekdays, _decode_weekdays)
+IDS = _Codec(_encode_ids, _decode_ids)
+
+# Schemas are never modified once released: changes are introduced as a new version, along with its own copy of any
+# list of choices, so that messages of any version are always decoded as they were encoded. Each schema maps the name
+# of a model to its kind on the wire and the list of its fields as (name, key, codec). Keys 'v', 'k' and 'd' are
+# reserved for the version, the kind and the documents of the messages
+SCHEMAS = {
+    1: {
+        'ServerInstructions': ('i', [('id', '_', ID),
+                                     ('site', 's', ID),
+                                     ('operation', 'o', _choice(('RUN', 'STOP', 'STOP AND RUN'))),
+                                     ('stop_at', 't', DATETIME),
+                                     ('exclude_dates', 'x', DATETIMES),
+                                     ('weekdays', 'w', WEEKDAYS),
+                                     ('times', 'h', DAY_SECONDS),
+                                     ('running', 'r', VALUE)]),
+        'ScanSettings': ('s', [('id', '_', ID),
+                               ('site', 's', ID),
+                               ('num_levels', 'l', VALUE),
+                               ('min_span', 'n', VALUE),
+                               ('max_span', 'x', VALUE),
+                               ('max_links', 'L', VALUE),
+                               ('max_size', 'z', VALUE),
+                               ('parser', 'p', VALUE),
+                               ('mime_types', 'm', VALUE),
+                               ('is_active', 'a', VALUE),
+                               ('created', 'c', DATETIME),
+                               ('scans', 'S', IDS)]),
+        'SiteInstructions': ('a', [('cover_instructions', 'c', VALUE),
+                                   ('article_instructions', 'a', VALUE),
+                                   ('created', 't', DATETIME),
+                                   ('updated', 'u', DATETIME),
+                                   ('is_active', 'i', VALUE)]),
+    },
+}
+
+
+def _read_only(model_name):
+    fields = [name for name, _, _ in SCHEMAS[VERSION][model_name][1]]
+    view_cls = collections.namedtuple(model_name + 'View', fields)
+    view_cls.__new__.__defaults__ = (None,) * len(fields)  # Fields unknown to the version of a message are None
+    return view_cls
+
+
+ServerInstructionsView = _read_only('ServerInstructions')
+ScanSettingsView = _read_only('ScanSettings')
+SiteInstructionsView = _read_only('SiteInstructions')
+VIEWS = {'ServerInstructions': ServerInstructionsView, 'ScanSettings': ScanSettingsView,
+         'SiteInstructions': SiteInstructionsView}
+_MODEL_NAMES = {view_cls: model_name for model_name, view_cls in VIEWS.items()}
+
+
+def _model_name(document):
+    model_name = _MODEL_NAMES.get(type(document))
+    if model_name:
+        return model_name
+    for cls in type(document).__mro__:
+        if cls.__name__ in VIEWS:
+            return cls.__name__
+    raise errors.DbModelOperationError(f"Documents of type {type(document).__name__} cannot be encoded")
+
+
+def _to_son(document, version):
+    try:
+        schema = SCHEMAS[version]
+    except KeyError:
+        raise errors.DbModelOperationError(f"Unknown wire schema version {version}") from None
+    model_name = _model_name(document)
+    kind, fields = schema[model_name]
+    # Models are read through '_data' so that references are not dereferenced
+    values = document._data if hasattr(document, '_data') else document._asdict()
+    son = {'k': kind}
+    for name, key, codec in fields:
+        value = values.get(name)
+        if value is not None:
+            son[key] = codec.encode(value)
+    return son
+
+
+def _from_son(son, version):
+    try:
+        schema = SCHEMAS[version]
+    except KeyError:
+        raise errors.DbModelOperationError(f"Unknown wire schema version {version}") from None
+    for model_name, (kind, fields) in schema.items():
+        if kind == son['k']:
+            return VIEWS[model_name](**{name: codec.decode(son[key]) for name, key, codec in fields if key in son})
+    raise errors.DbModelOperationError(f"Unknown kind of document '{son['k']}' in wire schema version {version}")
+
+
+def encode(document, version=VERSION):
+    '''Encode a ServerInstructions, ScanSettings or SiteInstructions, either a model or a view of one
+
+    :param document: document to be encoded
+    :param version: version of the schema to encode it with
+    :return: bytes of the message
+    '''
+    return bson.BSON.encode({'v': version, **_to_son(document, version)})
+
+
+def encode_many(documents, version=VERSION):
+    '''Encode several documents within a single message
+    '''
+    return bson.BSON.encode({'v': version, 'd': [_to_son(document, version) for document in documents]})
+
+
+def encode_assignment(server_instructions, scan_settings, site, version=VERSION):
+    '''Encode everything a worker needs to run a scan: its ServerInstructions, the ScanSettings of the site and the
+    active SiteInstructions of the site, if any
+
+    :return: bytes of a message to be decoded through 'decode_many'
+    '''
+    active = [instruction for instruction in site.instructions if instruction.is_active][:1]
+    return encode_many([server_instructions, scan_settings] + active, version)
+
+
+def _decode_message(data):
+    try:
+        message = bson.BSON(data).decode()
+    except (bson.errors.InvalidBSON, TypeError) as ex:
+        raise errors.DbModelOperationError(f"Invalid wire message: {ex}") from ex
+    return message
+
+
+def decode(data):
+    '''Decode a message produced by 'encode' into a read-only view of the document
+    '''
+    message = _decode_message(data)
+    return _from_son(message, message['v'])
+
+
+def decode_many(data):
+    '''Decode a message produced by 'encode_many' or 'encode_assignment' into a list of read-only views
+    '''
+    message = _decode_message(data)
+    return [_from_son(son, message['v']) for son in message['d']]
+
+
+def to_model(view):
+    '''Build the Mongoengine document a view was decoded from, as it would be loaded from the database
+    '''
+    from distpickymodel import extended_model, models
+
+    model_cls = {ServerInstructionsView: extended_model.ServerInstructions, ScanSettingsView: models.ScanSettings,
+                 SiteInstructionsView: models.SiteInstructions}[type(view)]
+    son = {}
+    for name, value in view._asdict().items():
+        if value is not None:
+            son['_id' if name == 'id' else name] = list(value) if isinstance(value, tuple) else value
+    return model_cls._from_son(son)
@@ -0,0 +1,218 @@
+import atexit
+import collections
+import threading
+import time
+import bson
+import mongoengine
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from distpickymodel import errors, models, utils
+
+
+class WriteBuffer:
+    '''Write-behind buffer that coalesces successive updates of UniquenessMixin documents of a given model into a single
+    'bulk_write' operation.
+
+    Updates addressed to the same '_id' are merged together: '$set' fields follow a last-writer-wins policy while
+    '$addToSet' fields are merged as the union of all values given. The buffer is flushed when the number of buffered
+    values reaches 'max_size', when an update is added after the oldest pending one got older than 'max_age' seconds or
+    when 'flush' is explicitly called. There is no background timer: the age is only checked when updates are added or
+    'flush_if_due' is called, so callers that may stop adding updates for a while must call 'flush_if_due'
+    periodically, or 'flush', for pending updates not to be held indefinitely. Documents inserted by the upserts of a
+    flush go through the '_after_insert' hook of the model as if they had been saved. Errors reported by the database
+    for individual documents are accumulated in 'write_errors'.
+    '''
+
+    def __init__(self, model, max_size=10000, max_age=1.0, flush_at_exit=True):
+        '''
+        :param model: UniquenessMixin subclass whose documents will be buffered
+        :param max_size: maximum number of field values held in memory before the buffer is flushed
+        :param max_age: maximum number of seconds an update may be held in memory before the buffer is flushed
+        :param flush_at_exit: whether pending updates should be flushed when the interpreter exits
+        '''
+        if not (isinstance(model, type) and issubclass(model, models.UniquenessMixin)):
+            raise errors.DbModelOperationError(f"WriteBuffer only accepts UniquenessMixin subclasses. "
+                                               f"Instead '{model}'")
+        self.model = model
+        self.max_size = max_size
+        self.max_age = max_age
+        self.write_errors = []
+        self._pending = collections.OrderedDict()
+        self._size = 0
+        self._oldest = None
+        self._lock = threading.RLock()
+        self._flush_at_exit = flush_at_exit
+        if flush_at_exit:
+            atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, document, many_unique=None):
+        '''Buffer the fields modified in 'document' since it was created, loaded or last buffered. Fields listed in
+        'many_unique' are merged with the '$addToSet' modifier in the same terms as 'save_with_uniqueness' does: only
+        the elements appended since the document was loaded or last buffered are sent.
+
+        :param document: instance of the model given to this buffer
+        :param many_unique: name or list of names of 'List-type' fields to which apply the add_to_set modifier
+        :return: the id of the document, which is generated if the document has none
+        '''
+        if not isinstance(document, self.model):
+            raise errors.DbModelOperationError(f"This buffer only accepts '{self.model.__name__}' documents. "
+                                               f"Instead '{document.__class__.__name__}'")
+        try:
+            self.model._before_write([document])
+            document.validate_delta()
+        except mongoengine.errors.ValidationError as ex:
+            raise errors.DbModelOperationError(f"Document '{document}' with id '{document.id}' is invalid") from ex
+
+        many_unique = [many_unique] if isinstance(many_unique, str) else (many_unique or [])
+        updates = document.updates
+        if not updates:
+            raise errors.DbModelOperationError(f"It looks like you are trying to update '{self.model.__name__}' "
+                                               f"but no fields were modified since this object was created or saved")
+        if not document.id:
+            document.id = bson.ObjectId()
+        db_names = self.model._update_spec()[0]
+        unique_db_names = {db_names[field] for field in many_unique}
+        set_fields, add_to_set = {}, {}
+        for key, value in updates.items():
+            if key in unique_db_names:
+                new_values = document._unsaved_values(key, value)
+                if new_values:
+                    add_to_set[key] = new_values
+            else:
+                set_fields[key] = value
+        if set_fields or add_to_set:
+            self.update(document.id, set_fields=set_fields, add_to_set=add_to_set)
+        document._clear_changed_fields()
+        document._persisted_lists = dict(getattr(document, '_persisted_lists', {}),
+                                         **{key: updates[key] for key in unique_db_names if key in updates})
+        return document.id
+
+    def update(self, pk, set_fields=None, add_to_set=None):
+        '''Buffer a raw update for the document identified by 'pk'
+
+        :param pk: '_id' of the document to be updated or upserted
+        :param set_fields: dictionary of database field names and values to be set
+        :param add_to_set: dictionary of database field names and a value or list of values to be added to the set
+        '''
+        set_fields = set_fields or {}
+        add_to_set = add_to_set or {}
+        with self._lock:
+            if any(self._has_path_conflict(pk, key) for key in [*set_fields, *add_to_set]):
+                self.flush()
+            entry = self._pending.get(pk)
+            if entry is None:
+                entry = self._pending[pk] = {'$set': {}, '$addToSet': {}}
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+
+            for key, value in set_fields.items():
+                if key not in entry['$set']:
+                    self._size += 1
+                entry['$set'][key] = value
+                dropped = entry['$addToSet'].pop(key, None)
+                if dropped:
+                    self._size -= len(dropped[0])
+
+            for key, values in add_to_set.items():
+                values = values if isinstance(values, (list, tuple)) else [values]
+                if isinstance(entry['$set'].get(key), list):
+                    current = entry['$set'][key]
+                    seen = {utils.value_key(value) for value in current}
+                else:
+                    current, seen = entry['$addToSet'].setdefault(key, ([], set()))
+                for value in values:
+                    value_key = utils.value_key(value)
+                    if value_key not in seen:
+                        seen.add(value_key)
+                        current.append(value)
+                        self._size += 1
+
+            if self._size >= self.max_size or self.is_due():
+                self.flush()
+
+    def is_due(self):
+        '''Return True if the oldest pending update has been held longer than 'max_age' seconds
+        '''
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.max_age
+
+    def flush_if_due(self):
+        '''Flush the buffer only if the oldest pending update is older than 'max_age'. Meant to be called periodically
+        by idle workers so that buffered updates are not held indefinitely
+        '''
+        with self._lock:
+            if self.is_due():
+                return self.flush()
+            return []
+
+    def flush(self):
+        '''Send all pending updates to the database through a single unordered 'bulk_write'. Pending updates are only
+        dropped once the database has answered, either successfully or with the errors of individual documents. Any
+        other failure, such as a network error or a primary stepping down, is raised and leaves every update pending
+        for the next flush. As the buffer is locked meanwhile, no update can be added while the write is in flight.
+
+        :return: list of write errors reported for this flush. Each error contains the '_id' of the document it
+        belongs to
+        '''
+        with self._lock:
+            if not self._pending:
+                return []
+            ids = list(self._pending)
+            bulk_ops = [UpdateOne({'_id': pk}, self._to_update(entry), upsert=True)
+                        for pk, entry in self._pending.items()]
+
+            collection = self.model._get_collection()
+            write_errors = []
+            try:
+                upserted = collection.bulk_write(bulk_ops, ordered=False).bulk_api_result['upserted']
+            except BulkWriteError as ex:
+                upserted = ex.details['upserted']
+                write_errors = ex.details['writeErrors']
+                for error in write_errors:
+                    error['_id'] = ids[error['index']]
+                self.write_errors.extend(write_errors)
+            self._pending.clear()
+            self._size = 0
+            self._oldest = None
+            if upserted:
+                inserted = collection.find({'_id': {'$in': [entry['_id'] for entry in upserted]}})
+                self.model._after_insert([self.model._from_son(son) for son in inserted])
+            return write_errors
+
+    def close(self):
+        '''Flush pending updates and detach the buffer from the interpreter exit hook
+        '''
+        self.flush()
+        if self._flush_at_exit:
+            atexit.unregister(self.flush)
+            self._flush_at_exit = False
+
+    def _has_path_conflict(self, pk, key):
+        '''Check whether 'key' overlaps with a different dotted path already pending for the same document, such as
+        'content' and 'content.0.title', which MongoDB would reject within a single update
+        '''
+        entry = self._pending.get(pk)
+        if entry is None:
+            return False
+        for pending_key in [*entry['$set'], *entry['$addToSet']]:
+            if pending_key != key and (pending_key.startswith(key + '.') or key.startswith(pending_key + '.')):
+                return True
+        return False
+
+    @staticmethod
+    def _to_update(entry):
+        update = {}
+        if entry['$set']:
+            update['$set'] = dict(entry['$set'])
+        if entry['$addToSet']:
+            update['$addToSet'] = {key: {'$each': values} for key, (values, _) in entry['$addToSet'].items()}
+        return update
@@ -19,7 +19,7 @@ setuptools.setup(
     packages=['distpickymodel'],
     python_requires='>=3.6',
     install_requires=['pymongo>=3.7.2', 'mongoengine>=0.17.0', 'six'],
-    tests_require=['pytest>=4.4.0', 'PyYAML>=5.1'],
+    tests_require=['pytest>=4.4.0', 'PyYAML>=5.1', 'hypothesis>=4.24.3'],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Web Environment',
@@ -1,6 +1,13 @@
 import mongoengine
+import os
 
-DATABASE = 'distpickymodel'
-HOST = 'localhost'
-db = mongoengine.connect(DATABASE, host=HOST)
+from distpickymodel import connection, memory_backend
 
+DATABASE = 'distpickymodel'
+HOST = os.environ.get('DISTPICKYMODEL_TEST_HOST', 'localhost')  # Set it to 'memory://' to run without a MongoDB server
+MEMORY = HOST.startswith(memory_backend.MEMORY_HOST)
+if MEMORY:
+    connection.connect(DATABASE, host=HOST)
+    db = connection.get_client()
+else:
+    db = mongoengine.connect(DATABASE, host=HOST)
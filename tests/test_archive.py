@@ -0,0 +1,134 @@
+import os
+import pytest
+
+from datetime import datetime, timedelta
+from distpickymodel import archive, errors, models, partitions
+from tests import conftest as cfg_test
+from tests import utils
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+def create_scan(site, peer, finished_at, num_documents):
+    scan = models.Scans(peer=peer, site=site, started_at=finished_at - timedelta(hours=1), finished_at=finished_at)
+    scan.save()
+    for num_node in range(num_documents):
+        models.WebDocuments(site=site, scan=scan, url=f"{site.url}/{scan.id}/{num_node}.html", site_url=site.url,
+                            level=1, num_node=num_node).save()
+    return scan
+
+
+def test_archive_and_restore_scans(tmp_path):
+    ''' Test that old finished scans are moved to the archive and can be brought back as follows:
+
+    1) The archive directory must exist
+    2) Only finished scans older than the cut-off are archived, along with their pages, and pulled out of ScanSettings
+    3) The manifest records each archived scan
+    4) A single scan can be restored with its pages and ScanSettings reference
+    5) A restored scan is archived again by a later run
+    '''
+
+    site = models.Sites.objects.first()
+    peer = models.Peers.objects.first()
+    now = datetime.utcnow().replace(microsecond=0)
+    old_scan = create_scan(site, peer, now - timedelta(days=40), num_documents=7)
+    older_scan = create_scan(site, peer, now - timedelta(days=50), num_documents=3)
+    recent_scan = create_scan(site, peer, now - timedelta(days=1), num_documents=2)
+    active_scan = models.Scans(peer=peer, site=site, is_active=True)
+    active_scan.save()
+    scan_settings = models.ScanSettings(site=site)
+    scan_settings.scans = [old_scan, older_scan, recent_scan]
+    scan_settings.save()
+
+    # (1)
+    with pytest.raises(errors.DbModelOperationError):
+        archive.archive_scans(str(tmp_path / 'missing'), timedelta(days=30))
+
+    # (2)
+    ret = archive.archive_scans(str(tmp_path), timedelta(days=30), now=now, batch_size=2, pause=0)
+    assert ret['scans'] == 2
+    assert ret['documents'] == 10
+    assert {scan.id for scan in models.Scans.objects.all()} == {recent_scan.id, active_scan.id}
+    assert models.WebDocuments.objects(scan__in=[old_scan.id, older_scan.id]).count() == 0
+    assert models.WebDocuments.objects(scan=recent_scan.id).count() == 2
+    assert [scan.id for scan in models.ScanSettings.objects(id=scan_settings.id).first().scans] == [recent_scan.id]
+
+    # (3)
+    manifest = archive.read_manifest(str(tmp_path))
+    assert set(manifest) == {old_scan.id, older_scan.id}
+    assert manifest[old_scan.id]['documents'] == 7
+    assert manifest[old_scan.id]['scan_settings'] == [scan_settings.id]
+    assert os.path.getsize(tmp_path / manifest[old_scan.id]['file']) == manifest[old_scan.id]['bytes']
+
+    # (4)
+    assert archive.restore_scan(str(tmp_path), old_scan.id) == 7
+    assert models.Scans.objects(id=old_scan.id).first().finished_at == old_scan.finished_at
+    assert models.WebDocuments.objects(scan=old_scan.id).count() == 7
+    assert old_scan.id in [scan.id for scan in models.ScanSettings.objects(id=scan_settings.id).first().scans]
+    assert set(archive.read_manifest(str(tmp_path))) == {older_scan.id}
+
+    # (5)
+    ret = archive.archive_scans(str(tmp_path), timedelta(days=30), now=now, pause=0)
+    assert ret['scans'] == 1
+    assert models.WebDocuments.objects(scan=old_scan.id).count() == 0
+    assert set(archive.read_manifest(str(tmp_path))) == {old_scan.id, older_scan.id}
+
+
+def test_archive_bookkeeping_and_partitions(tmp_path):
+    ''' Test that archiving and restoring scans keeps the rollups and seen-url filters in sync and covers partitions as
+    follows:
+
+    1) Pages are archived from the collection of WebDocuments and from the partitions of the router given
+    2) Archived pages and scans are subtracted from the rollups and the seen-url filter of their site forgets them
+    3) Restored pages go back to the collection they were archived from and are accounted for again
+    '''
+
+    site = models.Sites.objects()[1]
+    peer = models.Peers.objects.first()
+    now = datetime.utcnow().replace(microsecond=0)
+    router = partitions.Partitions(period=partitions.MONTHLY, key=partitions.BY_SCAN)
+    hot_scan = create_scan(site, peer, now - timedelta(days=40), num_documents=2)
+    partitioned_scan = models.Scans(peer=peer, site=site, started_at=datetime(2026, 8, 1),
+                                    finished_at=now - timedelta(days=40))
+    partitioned_scan.save()
+    for num_node in range(3):
+        router.save(models.WebDocuments(site=site, scan=partitioned_scan, site_url=site.url, level=2,
+                                        url=f"{site.url}/{partitioned_scan.id}/{num_node}.html", num_node=num_node))
+    urls = [page['url'] for page in models.WebDocuments._get_collection().find({'site': site.id})] + \
+        [page.url for page in router.objects(site=site.id)]
+    collections = [models.WebDocuments._get_collection()] + [router.collection(name) for name in router.partitions()]
+    models.SeenUrlFilters.build(site, error_rate=0.0001, collections=collections)
+    rollup = models.Statistics.for_site(site)
+    before = (rollup.pages, rollup.levels, rollup.scans, rollup.scan_seconds)
+
+    # (1)
+    ret = archive.archive_scans(str(tmp_path), timedelta(days=30), now=now, pause=0, partitions=router)
+    assert (ret['scans'], ret['documents']) == (2, 5)
+    assert router.count(site=site.id) == 0
+    assert models.WebDocuments.objects(site=site.id).count() == 0
+    assert archive.read_manifest(str(tmp_path))[partitioned_scan.id]['collections'] == [['web_documents_2026_08', 3]]
+
+    # (2)
+    rollup = models.Statistics.for_site(site)
+    assert (rollup.pages, rollup.levels.get('2'), rollup.scans) == (before[0] - 5, before[1]['2'] - 3, before[2] - 2)
+    assert models.Statistics.for_scan(partitioned_scan) is None
+    seen_urls = models.SeenUrlFilters.load(site)
+    assert not any(url in seen_urls for url in urls)
+
+    # (3)
+    assert archive.restore_scan(str(tmp_path), partitioned_scan.id, batch_size=2, partitions=router) == 3
+    assert archive.restore_scan(str(tmp_path), hot_scan.id) == 2
+    assert router.count(scan=partitioned_scan.id) == 3
+    assert models.WebDocuments.objects(scan=hot_scan.id).count() == 2
+    rollup = models.Statistics.for_site(site)
+    assert (rollup.pages, rollup.levels, rollup.scans, rollup.scan_seconds) == before
+    assert models.Statistics.for_scan(partitioned_scan).pages == 3
+    seen_urls = models.SeenUrlFilters.load(site)
+    assert all(url in seen_urls for url in urls)
@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+import pytest
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from distpickymodel import connection, models
+from tests import conftest as cfg_test
+from tests import utils
+
+pytestmark = pytest.mark.skipif(cfg_test.MEMORY, reason="requires a MongoDB server shared by several processes")
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+def touch_peers(num_round):
+    '''Worker run in a child process: update all peers in bulk through the client created by the child itself
+    '''
+    peers = list(models.Peers.objects.all())
+    for peer in peers:
+        peer.updated = datetime.utcnow()
+    return os.getpid(), id(connection.get_client()), models.Peers.bulk_update(peers)
+
+
+def test_connection_settings():
+    ''' Test that connections are registered lazily with explicit pool sizes and are re-created once forgotten
+    '''
+
+    connection.connect(cfg_test.DATABASE, host=cfg_test.HOST, alias='pool-test', max_pool_size=7, min_pool_size=1)
+    try:
+        client = connection.get_client('pool-test')
+        assert client.options.pool_options.max_pool_size == 7
+        assert client.options.pool_options.min_pool_size == 1
+        assert connection.get_client('pool-test') is client
+        connection._forget_clients()
+        assert connection.get_client('pool-test') is not client
+    finally:
+        connection.disconnect('pool-test')
+
+
+def test_models_check_fork():
+    ''' Test that models discard the client of the parent process when they reach their collection from a fork that
+    was not notified through 'os.register_at_fork'
+    '''
+
+    collection = models.Peers._get_collection()
+    client = connection.get_client()
+    assert models.Peers._get_collection() is collection
+    connection._owner_pid = -1  # Simulate a fork
+    assert models.Peers._get_collection() is not collection
+    assert connection._owner_pid == os.getpid()
+    assert connection.get_client() is not client
+    assert models.Peers.objects.count() == 3
+
+
+def test_bulk_update_from_forked_processes():
+    ''' Test that child processes forked after the parent has used its client can hammer bulk_update concurrently,
+    each one through a client of its own
+    '''
+
+    parent_client = id(connection.get_client())
+    assert models.Peers.objects.count() == 3
+    with ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context('fork')) as executor:
+        results = list(executor.map(touch_peers, range(40)))
+
+    assert all(not write_errors for _, _, write_errors in results)
+    assert len({pid for pid, _, _ in results}) > 1
+    assert all(os.getpid() != pid for pid, _, _ in results)
+    assert parent_client == id(connection.get_client())
+    assert all(peer.updated for peer in models.Peers.objects.all())
@@ -0,0 +1,136 @@
+import gzip
+import bson
+import pytest
+
+from bson import json_util
+from datetime import datetime
+from distpickymodel import errors, export, models, partitions
+from tests import conftest as cfg_test
+from tests import utils
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        site = models.Sites.objects.first()
+        scan = models.Scans(peer=models.Peers.objects.first(), site=site)
+        scan.save()
+        for num_node in range(25):
+            models.WebDocuments(site=site, scan=scan, url=f"{site.url}/{num_node}.html", site_url=site.url, level=1,
+                                num_node=num_node).save()
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+def test_export_documents(tmp_path):
+    ''' Test that documents are streamed into the requested format as follows:
+
+    1) A scan or a site and a known format are required
+    2) JSON Lines exports contain every document of the scan once, in '_id' order, with the requested fields only
+    3) Compressed BSON exports can be read back and no checkpoint is left behind
+    '''
+
+    scan = models.Scans.objects.first()
+    doc_ids = [doc.id for doc in models.WebDocuments.objects(scan=scan).order_by('id').only('id')]
+
+    # (1)
+    with pytest.raises(errors.DbModelOperationError):
+        export.export_documents(str(tmp_path / 'out.jsonl'))
+    with pytest.raises(errors.DbModelOperationError):
+        export.export_documents(str(tmp_path / 'out.csv'), scan=scan, fmt='csv')
+
+    # (2)
+    path = str(tmp_path / 'out.jsonl')
+    stats = export.export_documents(path, scan=scan, fields=['url', 'level'], checkpoint_every=10)
+    with open(path, 'rb') as fh:
+        lines = [json_util.loads(line) for line in fh]
+    assert [line['_id'] for line in lines] == doc_ids
+    assert 'num_node' not in lines[0] and lines[0]['level'] == 1
+    assert stats['documents'] == len(doc_ids)
+    assert stats['bytes'] == (tmp_path / 'out.jsonl').stat().st_size
+
+    # (3)
+    path = str(tmp_path / 'out.bson.gz')
+    export.export_documents(path, site=scan.site, fmt='bson', compress=True, checkpoint_every=10)
+    with gzip.open(path, 'rb') as fh:
+        assert [doc['_id'] for doc in bson.decode_all(fh.read())] == doc_ids
+    assert not (tmp_path / ('out.bson.gz' + export.CHECKPOINT_SUFFIX)).exists()
+
+
+def test_export_documents_resume(tmp_path):
+    ''' Test that an interrupted export resumes from its last checkpoint as follows:
+
+    1) Resuming with different arguments is refused and the checkpoint is kept
+    2) Resuming with the same arguments neither duplicates nor loses documents
+    '''
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(stats):
+        if stats['documents'] >= 10:
+            raise Interrupted()
+
+    scan = models.Scans.objects.first()
+    doc_ids = [doc.id for doc in models.WebDocuments.objects(scan=scan).order_by('id').only('id')]
+    path = str(tmp_path / 'out.bson.gz')
+
+    with pytest.raises(Interrupted):
+        export.export_documents(path, scan=scan, fmt='bson', compress=True, checkpoint_every=10, progress=interrupt)
+    assert (tmp_path / ('out.bson.gz' + export.CHECKPOINT_SUFFIX)).exists()
+    # --> Simulate a partial write after the last checkpoint, which has to be discarded on resume
+    with open(path, 'ab') as fh:
+        fh.write(b'garbage')
+
+    # (1)
+    arguments = {'scan': scan, 'fmt': 'bson', 'compress': True, 'checkpoint_every': 10}
+    for changed in ({'scan': None, 'site': scan.site}, {'fmt': 'jsonl'}, {'compress': False}, {'fields': ['url']},
+                    {'checkpoint_every': 20}):
+        with pytest.raises(errors.DbModelOperationError):
+            export.export_documents(path, **{**arguments, **changed})
+    assert (tmp_path / ('out.bson.gz' + export.CHECKPOINT_SUFFIX)).exists()
+
+    # (2)
+    stats = export.export_documents(path, **arguments)
+    assert stats['documents'] == len(doc_ids)
+    with gzip.open(path, 'rb') as fh:
+        assert [doc['_id'] for doc in bson.decode_all(fh.read())] == doc_ids
+
+
+def test_export_documents_partitions(tmp_path):
+    ''' Test that documents stored in partitions are exported along with the others, in '_id' order across all of
+    them, and that interrupted exports resume from their checkpoint across partitions as well
+    '''
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(stats):
+        if stats['documents'] >= 5:
+            raise Interrupted()
+
+    site = models.Sites.objects[1]
+    scan = models.Scans(peer=models.Peers.objects.first(), site=site, started_at=datetime(2026, 9, 1))
+    scan.save()
+    router = partitions.Partitions()
+    doc_ids = []
+    for num_node in range(12):
+        page = models.WebDocuments(site=site, scan=scan, url=f"{site.url}/{num_node}.html", site_url=site.url, level=1,
+                                   num_node=num_node)
+        if num_node % 3:
+            router.save(page)
+        else:
+            page.save()
+        doc_ids.append(page.id)
+    path = str(tmp_path / 'out.bson')
+
+    with pytest.raises(Interrupted):
+        export.export_documents(path, site=site, fmt='bson', checkpoint_every=5, progress=interrupt, partitions=router)
+    with pytest.raises(errors.DbModelOperationError):
+        export.export_documents(path, site=site, fmt='bson', checkpoint_every=5)
+    stats = export.export_documents(path, site=site, fmt='bson', checkpoint_every=5, partitions=router)
+    assert stats['documents'] == len(doc_ids)
+    with open(path, 'rb') as fh:
+        assert [doc['_id'] for doc in bson.decode_all(fh.read())] == doc_ids
@@ -1,9 +1,11 @@
 import re
+import types
 import mongoengine
 import pytest
 
-from datetime import datetime
-from distpickymodel import models, extended_model as e_model
+from datetime import datetime, timedelta
+from pymongo.errors import AutoReconnect, BulkWriteError, WTimeoutError
+from distpickymodel import errors, models, retry, extended_model as e_model
 from tests import conftest as cfg_test
 from tests import utils
 
@@ -120,6 +122,169 @@ def test_bulk_update_operation():
     assert documents[2].weekdays == [1, 6]
 
 
+def test_bulk_update_partitioned():
+    ''' Test that bulk_update behaves as a single bulk_write when sent in concurrent partitions:
+
+    1) All documents are updated and the counts of all partitions are merged
+    2) Write errors refer to the position of the failing document in the list given, whatever the partition
+    '''
+
+    # (1)
+    documents = list(e_model.ServerInstructions.objects().no_dereference().all())
+    assert len(documents) == 3
+    for document, weekday in zip(documents, [2, 3, 4]):
+        document.weekdays = [weekday]
+    ret = e_model.ServerInstructions.bulk_update(documents, parallelism=3, partition_size=1, full_result=True)
+    assert ret['nMatched'] == 3
+    assert ret['nModified'] == 3
+    assert not ret['writeErrors']
+    documents = list(e_model.ServerInstructions.objects().no_dereference().all())
+    assert [document.weekdays for document in documents] == [[2], [3], [4]]
+
+    # (2) --> Documents are given in reverse '_id' order and the one in the middle is not modified
+    documents.reverse()
+    documents[0].weekdays = [5]
+    documents[2].weekdays = [6]
+    ret = e_model.ServerInstructions.bulk_update(documents, parallelism=2)
+    assert [error['index'] for error in ret] == [1]
+
+
+class FlakyCollection:
+    '''Collection whose bulk writes fail as scripted in 'failures': each call takes the next entry, which is either
+    an exception to be raised or a dictionary of _id -> error code of the operations to be failed
+    '''
+
+    def __init__(self, collection, failures):
+        self.collection = collection
+        self.failures = list(failures)
+        self.calls = []
+
+    def bulk_write(self, requests, ordered=True):
+        ids = [request._filter['_id'] for request in requests]
+        self.calls.append(ids)
+        failure = self.failures.pop(0) if self.failures else {}
+        if isinstance(failure, Exception):
+            raise failure
+        applied = [request for request in requests if request._filter['_id'] not in failure]
+        result = self.collection.bulk_write(applied, ordered=ordered).bulk_api_result if applied else \
+            {'nMatched': 0, 'nModified': 0, 'writeErrors': [], 'writeConcernErrors': []}
+        write_errors = [{'index': index, 'code': failure[_id], 'errmsg': f"Error {failure[_id]}"}
+                        for index, _id in enumerate(ids) if _id in failure]
+        if write_errors:
+            raise BulkWriteError(dict(result, writeErrors=write_errors))
+        return types.SimpleNamespace(bulk_api_result=result)
+
+
+def test_bulk_update_retry(monkeypatch):
+    ''' Test that bulk_update resubmits the operations failing because of transient errors as follows:
+
+    1) Only the operations failing with retryable errors are sent again, after waiting, whereas permanent errors are
+    returned along with their documents
+    2) All pending operations are sent again when the whole request fails because of a network error
+    3) Operations still failing after the last attempt are returned as write errors and no operation is resubmitted
+    without a retry policy, which is the default
+    4) Requests failing with a write concern timeout, whose writes were applied, are only sent again by policies
+    opting in
+    '''
+
+    waits = []
+    policy = retry.RetryPolicy(max_attempts=3, backoff=1, jitter=False, sleep=waits.append)
+    documents = list(e_model.ServerInstructions.objects().no_dereference().all())
+    ids = [document.id for document in documents]
+
+    def bulk_update(failures, **kwargs):
+        collection = FlakyCollection(e_model.ServerInstructions._get_collection(), failures)
+        monkeypatch.setattr(e_model.ServerInstructions, '_get_collection', classmethod(lambda cls: collection))
+        for document, weekday in zip(documents, [0, 1, 2]):
+            document.weekdays = [weekday + len(collection.failures)]
+        ret = e_model.ServerInstructions.bulk_update(documents, full_result=True, **kwargs)
+        monkeypatch.undo()
+        return ret, collection.calls
+
+    # (1)
+    ret, calls = bulk_update([{ids[0]: 189, ids[1]: 11000}], retry_policy=policy)
+    assert calls == [ids, [ids[0]]]
+    assert waits == [1]
+    assert ret['nMatched'] == 2
+    assert ret['nRetried'] == 1
+    assert [(error['index'], error['code'], error['document']) for error in ret['writeErrors']] == \
+           [(1, 11000, documents[1])]
+    assert e_model.ServerInstructions.objects(weekdays=1).count() == 1
+
+    # (2)
+    ret, calls = bulk_update([AutoReconnect('Primary stepped down'), {ids[2]: 91}], retry_policy=policy)
+    assert calls == [ids, ids, [ids[2]]]
+    assert waits == [1, 1, 2]
+    assert ret['nMatched'] == 3
+    assert ret['nRetried'] == 4
+    assert not ret['writeErrors']
+
+    # (3)
+    ret, calls = bulk_update([{ids[1]: 91}] * 3, retry_policy=policy)
+    assert calls == [ids, [ids[1]], [ids[1]]]
+    assert [(error['index'], error['code']) for error in ret['writeErrors']] == [(1, 91)]
+    for kwargs in ({}, {'retry_policy': None}):
+        ret, calls = bulk_update([{ids[1]: 91}], **kwargs)
+        assert calls == [ids]
+        assert [(error['index'], error['code']) for error in ret['writeErrors']] == [(1, 91)]
+    assert waits == [1, 1, 2, 1, 2]
+    with pytest.raises(ValueError):
+        retry.RetryPolicy(max_attempts=0)
+
+    # (4)
+    timeout = WTimeoutError('Waiting for replication timed out', 64)
+    with pytest.raises(WTimeoutError):
+        bulk_update([timeout], retry_policy=policy)
+    monkeypatch.undo()
+    assert not retry.DEFAULT_RETRY_POLICY.is_retryable_exception(timeout)
+    idempotent = retry.RetryPolicy(max_attempts=2, backoff=1, jitter=False, sleep=waits.append,
+                                   retry_write_concern_timeouts=True)
+    ret, calls = bulk_update([timeout], retry_policy=idempotent)
+    assert calls == [ids, ids]
+    assert (ret['nMatched'], ret['nRetried'], ret['writeErrors']) == (3, 3, [])
+    assert waits == [1, 1, 2, 1, 2, 1]
+
+
+def test_validate_many():
+    ''' Test the compiled validation of whole lists of documents as follows:
+
+    1) Only fields modified since the documents were loaded are validated, whereas new documents are fully validated
+    2) All invalid documents are reported at once, with the same errors as 'validate' would raise
+    3) bulk_update refuses to send any document if one of them is invalid
+    '''
+
+    # (1)
+    documents = list(e_model.ServerInstructions.objects().no_dereference().all())
+    e_model.ServerInstructions._get_collection().update_one({'_id': documents[0].id}, {'$set': {'times': [0]}})
+    documents = list(e_model.ServerInstructions.objects().no_dereference().all())
+    assert not e_model.ServerInstructions.validate_many(documents)
+    with pytest.raises(mongoengine.errors.ValidationError):
+        documents[0].validate()
+    documents[0].running = True
+    assert not e_model.ServerInstructions.validate_many(documents)
+
+    # (2)
+    documents[0].times = [0, 5]
+    documents[2].operation = 'JUMP'
+    documents.append(e_model.ServerInstructions(times=[1]))
+    failures = e_model.ServerInstructions.validate_many(documents)
+    assert [(failure['index'], failure['_id']) for failure in failures] == \
+           [(0, documents[0].id), (2, documents[2].id), (3, None)]
+    assert set(failures[0]['error'].errors) == {'times'}
+    assert set(failures[1]['error'].errors) == {'operation'}
+    assert set(failures[2]['error'].errors) == {'site', 'operation'}
+    for failure in failures:
+        with pytest.raises(mongoengine.errors.ValidationError) as ex:
+            documents[failure['index']].validate()
+        assert set(ex.value.errors) == set(failure['error'].errors)
+
+    # (3)
+    with pytest.raises(errors.DbModelOperationError) as ex:
+        e_model.ServerInstructions.bulk_update(documents[:3])
+    assert re.search(str(documents[0].id), str(ex.value))
+    assert e_model.ServerInstructions.objects(running=True).count() == 0
+
+
 def test_extended_scan():
     ''' Check that the new required field Instruction for ExtendedScan is as such
     '''
@@ -130,7 +295,104 @@ def test_extended_scan():
     assert re.search(r"\brun_instruction\b", str(ex.value))
 
 
+@utils.truncate_collections([models.Scans, e_model.ServerInstructions], tear='both')
+def test_release_stale_peers():
+    ''' Test that peers without a recent heartbeat are released along with the scans and instructions they left behind:
+
+    1) Heartbeat only refreshes the 'updated' field of the given peers
+    2) Stale peers are released, their active scans closed and their linked instructions stopped
+    3) Peers with a recent heartbeat, their scans and instructions are left untouched
+    4) A second sweep finds nothing else to clean up
+    '''
+
+    sites = list(models.Sites.objects.all())
+    peers = list(models.Peers.objects.all())
+    models.Peers.objects.update(is_assigned=True)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    e_scans = []
+    for peer, site in zip(peers, sites):
+        instruction = e_model.ServerInstructions(site=site, operation=e_model.RUN_OP, running=True)
+        instruction.save()
+        e_scan = e_model.ExtendedScans(peer=peer, site=site, run_instruction=instruction, is_active=True,
+                                       started_at=now)
+        e_scan.save()
+        e_scans.append(e_scan)
+
+    # (1)
+    assert models.Peers.heartbeat(peers[0].name, now=now) == 1
+    assert models.Peers.heartbeat(peers[1].name, peers[2].name, now=now - timedelta(minutes=10)) == 2
+    assert models.Peers.objects(id=peers[0].id).first().updated == now
 
+    # (2)
+    ret = e_model.release_stale_peers(timedelta(minutes=5), now=now)
+    assert ret == {'peers': 2, 'scans': 2, 'instructions': 2}
+    for peer, e_scan in zip(peers[1:], e_scans[1:]):
+        assert models.Peers.objects(id=peer.id).first().is_assigned is False
+        db_scan = e_model.ExtendedScans.objects(id=e_scan.id).first()
+        assert db_scan.is_active is False
+        assert db_scan.finished_at == now
+        assert db_scan.run_instruction.running is False
 
+    # (3)
+    assert models.Peers.objects(id=peers[0].id).first().is_assigned is True
+    db_scan = e_model.ExtendedScans.objects(id=e_scans[0].id).first()
+    assert db_scan.is_active is True
+    assert db_scan.finished_at is None
+    assert db_scan.run_instruction.running is True
 
+    # (4)
+    assert e_model.release_stale_peers(300, now=now) == {'peers': 0, 'scans': 0, 'instructions': 0}
+
+
+@utils.truncate_collections([models.Scans, e_model.ServerInstructions], tear='both')
+def test_release_stale_peers_concurrent_finish(monkeypatch):
+    ''' Test that scans finished between the selection and the release of stale peers are not accounted for twice:
+
+    1) A scan is finished through Scans.finish right after release_stale_peers selected it
+    2) Only the other scan is released and the finished one keeps its 'finished_at'
+    3) Rollups and events hold a single end for each scan
+    '''
+
+    sites = list(models.Sites.objects.all())
+    peers = list(models.Peers.objects.all())
+    models.Peers.objects.update(is_assigned=True)
+    now = datetime.utcnow().replace(microsecond=0)
+    models.Peers.heartbeat(*[peer.name for peer in peers], now=now - timedelta(minutes=10))
+
+    e_scans = []
+    for peer, site in zip(peers[:2], sites):
+        instruction = e_model.ServerInstructions(site=site, operation=e_model.RUN_OP, running=True)
+        instruction.save()
+        e_scan = e_model.ExtendedScans(peer=peer, site=site, run_instruction=instruction, is_active=True,
+                                       started_at=now - timedelta(minutes=30))
+        e_scan.save()
+        e_scans.append(e_scan)
+
+    # (1)
+    collection = models.Scans._get_collection()
+
+    class FinishingCollection:
+        def __getattr__(self, name):
+            return getattr(collection, name)
+
+        def find(self, *args, **kwargs):
+            selected = list(collection.find(*args, **kwargs))
+            assert e_scans[0].finish(now=now - timedelta(minutes=1)) is True
+            return selected
+
+    monkeypatch.setattr(models.Scans, '_get_collection', classmethod(lambda cls: FinishingCollection()))
+    ret = e_model.release_stale_peers(timedelta(minutes=5), now=now)
+    monkeypatch.undo()
+
+    # (2)
+    assert ret == {'peers': 3, 'scans': 1, 'instructions': 1}
+    assert e_model.ExtendedScans.objects(id=e_scans[0].id).first().finished_at == now - timedelta(minutes=1)
+    assert e_model.ExtendedScans.objects(id=e_scans[1].id).first().finished_at == now
 
+    # (3)
+    for e_scan, event in zip(e_scans, (models.ScanEvents.FINISHED, models.ScanEvents.RELEASED)):
+        assert models.Statistics.for_scan(e_scan).scans == 1
+        assert models.ScanEvents.objects(scan=e_scan.id).filter(event__in=[models.ScanEvents.FINISHED,
+                                                                           models.ScanEvents.RELEASED]).count() == 1
+        assert models.ScanEvents.objects(scan=e_scan.id, event=event).count() == 1
@@ -0,0 +1,193 @@
+import re
+import mongoengine
+import pytest
+
+from bson import ObjectId
+from datetime import datetime
+from pymongo import CursorType, DESCENDING, InsertOne, UpdateOne
+from pymongo.collection import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from distpickymodel import connection, memory_backend, models
+
+
+class MemoryPeers(models.UniquenessMixin):
+    name = models.StringField(required=True, unique=True)
+    meta = {'db_alias': 'memory-test', 'collection': 'peers'}
+
+
+@pytest.fixture
+def collection():
+    client = memory_backend.MemoryClient()
+    collection = client['distpickymodel']['web_documents']
+    collection.create_index([('site', 1), ('url', 1)], unique=True)
+    collection.create_index([('level', 1)])
+    return collection
+
+
+def test_queries(collection):
+    ''' Test that queries return what the server would as follows:
+
+    1) Documents are found by '_id' and indexed fields through the hash indexes, in insertion order
+    2) Arrays, dotted paths, regular expressions and comparisons follow MongoDB's semantics
+    3) Projections, sorts, skips and limits are applied to the documents found
+    4) Stored values are copies, truncated to milliseconds as BSON datetimes are
+    '''
+
+    site_1, site_2 = ObjectId(), ObjectId()
+    ids = collection.insert_many([{'site': site_1, 'url': f"https://www.site.com/{num}", 'level': num % 3,
+                                   'tags': ['a', 'b'] if num % 2 else [], 'content': {'size': num}}
+                                  for num in range(10)] +
+                                 [{'site': site_2, 'url': 'https://www.site.com/0', 'level': 0}]).inserted_ids
+
+    # (1)
+    assert collection.find_one(ids[3])['url'] == 'https://www.site.com/3'
+    cursor = collection.find({'site': site_1, 'url': 'https://www.site.com/0'})
+    assert cursor.explain()['queryPlanner']['winningPlan']['stage'] == 'IXSCAN'
+    assert [doc['_id'] for doc in cursor] == [ids[0]]
+    levels = collection.find({'level': {'$in': [2, 0]}})
+    assert [doc['_id'] for doc in levels] == [ids[num] for num in (0, 2, 3, 5, 6, 8, 9, 10)]
+    assert collection.find({'content.size': 1}).explain()['queryPlanner']['winningPlan']['stage'] == 'COLLSCAN'
+
+    # (2)
+    assert collection.count_documents({'tags': 'a'}) == 5
+    assert collection.count_documents({'tags': {'$size': 0}}) == 5
+    assert collection.count_documents({'tags': {'$all': ['a', 'b']}, 'content.size': {'$gte': 5}}) == 3
+    assert collection.count_documents({'content': {'$exists': False}}) == 1
+    assert collection.count_documents({'url': re.compile(r'/1$')}) == 1
+    assert collection.count_documents({'url': {'$regex': 'SITE', '$options': 'i'}, 'level': {'$ne': 0}}) == 6
+    assert collection.count_documents({'$or': [{'level': 1}, {'content.size': {'$lt': 1}}]}) == 4
+    assert collection.count_documents({'level': {'$gt': '0'}}) == 0
+
+    # (3)
+    documents = list(collection.find({'site': site_1}, {'url': True, '_id': False}).sort('level', DESCENDING)
+                     .skip(1).limit(2))
+    assert documents == [{'url': 'https://www.site.com/5'}, {'url': 'https://www.site.com/8'}]
+    assert 'content' not in collection.find_one({'_id': ids[1]}, {'content': False})
+    assert collection.find({'site': site_1}).count(with_limit_and_skip=False) == 10
+    assert collection.distinct('site') == [site_1, site_2]
+
+    # (4)
+    now = datetime(2019, 5, 1, 10, 0, 0, 123456)
+    document = {'_id': 1, 'site': site_2, 'url': 'https://www.site.com/now', 'created': now, 'tags': ['a']}
+    collection.insert_one(document)
+    document['tags'].append('b')
+    stored = collection.find_one({'_id': 1})
+    assert stored['tags'] == ['a'] and stored['created'] == now.replace(microsecond=123000)
+    stored['tags'].append('c')
+    assert collection.find_one({'_id': 1})['tags'] == ['a']
+
+
+def test_writes(collection):
+    ''' Test that writes are applied and rejected as the server would as follows:
+
+    1) Unique indexes, '_id' included, raise DuplicateKeyError and unordered inserts go on after a duplicate
+    2) Upserts build the new document from the query and apply $set, $addToSet and $setOnInsert
+    3) bulk_write reports the failed operations along with their index and server error code
+    4) find_one_and_update returns the document before or after the update
+    5) A dropped collection can still be used by those holding it and has no indexes left
+    '''
+
+    site = ObjectId()
+
+    # (1)
+    collection.insert_one({'_id': 1, 'site': site, 'url': 'https://www.site.com'})
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({'_id': 2, 'site': site, 'url': 'https://www.site.com'})
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({'_id': 1, 'site': site, 'url': 'https://www.site.com/other'})
+    with pytest.raises(BulkWriteError) as ex:
+        collection.insert_many([{'site': site, 'url': 'https://www.site.com'}, {'site': site, 'url': 'https://a.com'}],
+                               ordered=False)
+    assert [(error['index'], error['code']) for error in ex.value.details['writeErrors']] == [(0, 11000)]
+    assert ex.value.details['nInserted'] == 1
+    with pytest.raises(DuplicateKeyError):
+        collection.update_one({'_id': 1}, {'$set': {'url': 'https://a.com'}})
+    assert collection.find_one({'_id': 1})['url'] == 'https://www.site.com'
+
+    # (2)
+    for _ in range(2):
+        result = collection.update_one({'site': site, 'url': 'https://b.com'},
+                                       {'$set': {'level': 1}, '$addToSet': {'tags': {'$each': ['a', 'b', 'a']}},
+                                        '$setOnInsert': {'created': True}}, upsert=True)
+    assert (result.matched_count, result.modified_count, result.upserted_id) == (1, 0, None)
+    document = collection.find_one({'url': 'https://b.com'}, {'_id': False})
+    assert document == {'site': site, 'url': 'https://b.com', 'level': 1, 'tags': ['a', 'b'], 'created': True}
+
+    # (3)
+    with pytest.raises(BulkWriteError) as ex:
+        collection.bulk_write([UpdateOne({'_id': 1}, {'$inc': {'level': 1}}),
+                               UpdateOne({'_id': 1}, {'$set': {}}),
+                               UpdateOne({'_id': 1}, {'$set': {'_id': 5}}),
+                               InsertOne({'_id': 1}),
+                               UpdateOne({'_id': 1}, {'$set': {'level': 3}, '$inc': {'level': 1}})], ordered=False)
+    details = ex.value.details
+    write_errors = [(error['index'], error['code']) for error in details['writeErrors']]
+    assert write_errors == [(1, 9), (2, 66), (3, 11000), (4, 40)]
+    assert (details['nMatched'], details['nModified']) == (1, 1)
+    assert collection.find_one({'_id': 1})['level'] == 1
+
+    # (4)
+    before = collection.find_one_and_update({'_id': 1}, {'$push': {'tags': 'c'}})
+    after = collection.find_one_and_update({'_id': 1}, {'$pull': {'tags': 'c'}}, return_document=ReturnDocument.AFTER)
+    assert 'tags' not in before and after['tags'] == []
+
+    # (5)
+    collection.database.drop_collection(collection.name)
+    assert collection.count_documents({}) == 0 and list(collection.index_information()) == ['_id_']
+    collection.insert_one({'site': site, 'url': 'https://www.site.com'})
+    assert collection.database.list_collection_names() == [collection.name]
+
+
+def test_capped_collections():
+    ''' Test that capped collections behave as the server's as follows:
+
+    1) The oldest documents are evicted once the 'max' number of documents is reached
+    2) Tailable cursors return the documents inserted after the last one looked at on every new iteration
+    3) Tailable cursors fail with CappedPositionLost once the last document looked at has been evicted
+    '''
+
+    database = memory_backend.MemoryClient()['distpickymodel']
+    collection = database.create_collection('events', capped=True, size=1024 * 1024, max=3)
+    database['other'].insert_one({})
+    with pytest.raises(OperationFailure):
+        database['other'].find({}, cursor_type=CursorType.TAILABLE)
+
+    # (1)
+    collection.insert_many([{'num': num} for num in range(4)])
+    assert [document['num'] for document in collection.find()] == [1, 2, 3]
+
+    # (2)
+    cursor = collection.find({'num': {'$ne': 4}}, cursor_type=CursorType.TAILABLE_AWAIT).max_await_time_ms(10)
+    assert [document['num'] for document in cursor] == [1, 2, 3]
+    collection.insert_many([{'num': 4}, {'num': 5}])
+    assert [document['num'] for document in cursor] == [5]
+    assert cursor.alive and list(cursor) == []
+
+    # (3)
+    collection.insert_many([{'num': num} for num in range(6, 10)])
+    with pytest.raises(OperationFailure) as ex:
+        list(cursor)
+    assert ex.value.code == memory_backend.CAPPED_POSITION_LOST and not cursor.alive
+
+
+def test_memory_connection():
+    ''' Test that models run against the memory backend once connected to a memory host, which survives the clients
+    being forgotten and is shared by all aliases of the same host
+    '''
+
+    connection.connect('memory-test', host='memory://models', alias='memory-test')
+    try:
+        client = connection.get_client('memory-test')
+        assert isinstance(client, memory_backend.MemoryClient)
+        MemoryPeers(name='Peer-memory').save()
+        with pytest.raises(mongoengine.NotUniqueError):
+            MemoryPeers(name='Peer-memory').save()
+        connection._forget_clients()
+        assert connection.get_client('memory-test') is client
+        assert MemoryPeers.objects(name='Peer-memory').count() == 1
+        connection.connect('memory-test', host='memory://models', alias='memory-test-2')
+        assert connection.get_client('memory-test-2') is client
+    finally:
+        client.drop_database('memory-test')
+        connection.disconnect('memory-test')
+        connection.disconnect('memory-test-2')
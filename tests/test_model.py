@@ -4,13 +4,22 @@ import mongoengine
 import pytest
 import yaml
 
+from datetime import datetime, timedelta
 from distpickymodel import errors
-from distpickymodel import models
+from distpickymodel import models, raw
+from distpickymodel import utils as utils_module
+from unittest import mock
 from unittest.mock import Mock
 from tests import conftest as cfg_test
 from tests import utils
 
 
+class UniqueTags(models.UniquenessMixin):
+    name = mongoengine.StringField(required=True, unique=True)
+    tags = mongoengine.ListField(mongoengine.StringField())
+    meta = {'collection': 'unique_tags'}
+
+
 @pytest.fixture(scope='module', autouse=True)
 def tear_up_down_db():
     try:
@@ -319,6 +328,392 @@ def test_scans_db_operations():
         scans.save_with_uniqueness('documents')
 
 
+def test_save_with_uniqueness_raw():
+    '''Test that the raw path of save_with_uniqueness behaves exactly as the default one:
+
+    1) Inserts produce the same database document, '_cls' included
+    2) Uniqueness is enforced on updates
+    3) The per-class update spec is compiled only once
+    '''
+
+    sites = models.Sites.objects()
+    peers = models.Peers.objects()
+    documents = models.WebDocuments.objects()
+
+    # (1)
+    saved = []
+    for use_raw in (False, True):
+        scans = models.Scans(peer=peers[0], site=sites[0], process_name='Process-raw', is_active=True)
+        scans.documents.append(documents[0])
+        scan_id = scans.save_with_uniqueness('documents', raw=use_raw)
+        saved.append(models.Scans._get_collection().find_one({'_id': scan_id}, {'_id': False}))
+    assert saved[0] == saved[1]
+    assert saved[1]['_cls'] == 'Scans'
+
+    # (2)
+    scans.documents.append(documents[0])
+    scans.documents.append(documents[1])
+    scans.save_with_uniqueness('documents', raw=True)
+    ret = models.Scans.objects(id=scan_id).first()
+    assert [doc.id for doc in ret.documents] == [documents[0].id, documents[1].id]
+
+    # (3)
+    assert models.Scans._update_spec() is models.Scans._update_spec()
+    assert models.Scans._update_spec()[0]['documents'] == 'documents'
+
+
+def test_save_with_uniqueness_raw_errors():
+    '''Test that the raw path of save_with_uniqueness raises the same errors as the default one when an upsert clashes
+    with a unique index, and that the stored document is left untouched
+    '''
+
+    UniqueTags(name='tag-owner', tags=['a']).save()
+    for use_raw in (False, True):
+        document = UniqueTags(name='tag-owner', tags=['b'])
+        with pytest.raises(mongoengine.errors.NotUniqueError):
+            document.save_with_uniqueness('tags', raw=use_raw)
+    assert [stored.tags for stored in UniqueTags.objects(name='tag-owner')] == [['a']]
+
+
+def test_save_with_uniqueness_many_fields():
+    '''Test that save_with_uniqueness applies set semantics to several fields within a single call:
+
+    1) 'children' and 'content' are both saved as sets in one go
+    2) Once loaded from the database, only the newly appended elements are sent
+    3) Elements already stored are not duplicated on either field
+    4) No round trip is made when none of the modified fields has new elements
+    '''
+
+    root_document = models.WebDocuments.objects(is_cover=True).no_dereference().first()
+    children = list(models.WebDocuments.objects(is_cover=False).no_dereference())
+    assert len(children) > 1
+    for use_raw in (False, True):
+
+        # (1)
+        document = models.WebDocuments(site=root_document.site, scan=root_document.scan, url=utils.URL_COVER,
+                                       site_url=root_document.site_url, level=1, num_node=10)
+        document.children.append(children[0])
+        document.content.append(models.WebContent(url=utils.URL_COVER, version='1.0'))
+        doc_id = document.save_with_uniqueness(['children', 'content'], raw=use_raw)
+        ret = models.WebDocuments.objects(id=doc_id).no_dereference().first()
+        assert [child.id for child in ret.children] == [children[0].id]
+        assert len(ret.content) == 1
+
+        # (2)
+        ret.children.append(children[1])
+        ret.content.append(models.WebContent(url=utils.URL_COVER, version='1.1'))
+        updates = ret.updates
+        assert ret._unsaved_values('children', updates['children']) == [children[1].id]
+        assert [content['version'] for content in ret._unsaved_values('content', updates['content'])] == ['1.1']
+
+        # (3)
+        ret.children.append(children[0])
+        ret.save_with_uniqueness(['children', 'content'], raw=use_raw)
+        ret = models.WebDocuments.objects(id=doc_id).no_dereference().first()
+        assert [child.id for child in ret.children] == [children[0].id, children[1].id]
+        assert [content.version for content in ret.content] == ['1.0', '1.1']
+
+        # (4)
+        ret.children.append(children[1])
+        with mock.patch.object(models.WebDocuments, '_raw_update_one') as raw_update_one:
+            assert ret.save_with_uniqueness(['children', 'content'], raw=True) == doc_id
+        assert not raw_update_one.called
+
+
+def test_content_fingerprint():
+    '''Test that content versions are deduplicated by their fingerprint as follows:
+
+    1) The fingerprint of a WebContent is computed on validation and recomputed if its content changes
+    2) A version with a new fingerprint is stored and becomes the latest fingerprint of the document
+    3) A version with the same fingerprint as the latest one is not stored but 'updated' is touched
+    4) Changed and new urls of a site are detected in one pass, pages saved along with their content included
+    '''
+
+    root_document = models.WebDocuments.objects(is_cover=True).no_dereference().first()
+    child_document = models.WebDocuments.objects(parent=root_document).no_dereference().first()
+    num_versions = len(root_document.content)
+
+    # (1)
+    content = models.WebContent(url=root_document.url, version='2.0', content='<html>v2</html>')
+    content.validate()
+    assert content.fingerprint == utils_module.content_fingerprint('<html>v2</html>')
+    content.content = '<html>v3</html>'
+    content.validate()
+    assert content.fingerprint == utils_module.content_fingerprint('<html>v3</html>')
+
+    # (2)
+    assert root_document.add_content_version(content) is True
+    ret = models.WebDocuments.objects(id=root_document.id).no_dereference().first()
+    assert len(ret.content) == num_versions + 1
+    assert ret.fingerprint == content.fingerprint
+    assert not root_document.is_modified()
+
+    # (3)
+    now = datetime.utcnow().replace(microsecond=0)
+    duplicate = models.WebContent(url=root_document.url, version='2.1', content='<html>v3</html>')
+    assert ret.add_content_version(duplicate, now=now) is False
+    ret = models.WebDocuments.objects(id=root_document.id).no_dereference().first()
+    assert len(ret.content) == num_versions + 1
+    assert ret.updated == now
+
+    # (4)
+    new_url = root_document.url + '/new.html'
+    fingerprints = {root_document.url: content.fingerprint,
+                    child_document.url: utils_module.content_fingerprint('<html>child</html>'),
+                    new_url: utils_module.content_fingerprint('<html>new</html>')}
+    assert models.WebDocuments.changed_urls(root_document.site, fingerprints) == [child_document.url, new_url]
+    saved = models.WebDocuments(site=root_document.site, scan=root_document.scan, url=root_document.url + '/saved.html',
+                                site_url=root_document.site_url, level=2, num_node=99)
+    saved.content.append(models.WebContent(url=saved.url, version='1.0', content='<html>saved</html>'))
+    saved.save_with_uniqueness('content')
+    fingerprints[saved.url] = utils_module.content_fingerprint('<html>saved</html>')
+    assert models.WebDocuments.objects(id=saved.id).first().fingerprint == fingerprints[saved.url]
+    assert models.WebDocuments.changed_urls(root_document.site, fingerprints) == [child_document.url, new_url]
+
+
+def test_recrawl_frontier():
+    '''Test the fetch metadata of pages and the frontier of pages to be fetched again as follows:
+
+    1) The first fetch schedules the next one according to the default change rate
+    2) A change observed sooner than expected raises the change rate and brings the next fetch forward
+    3) The frontier returns pages never fetched first, followed by those due the longest, and excludes those not due
+    4) The frontier honours the given limit
+    5) Only the copy of each url stored by the latest scan is considered, as older copies lose their 'next_fetch'
+    6) The frontier is read through the (site, next_fetch) index in 'next_fetch' order, without sorting pages
+    '''
+
+    site = models.Sites.objects()[1]
+    now = datetime.utcnow().replace(microsecond=0)
+    scan_id = bson.ObjectId()
+
+    # (1)
+    page = models.WebDocuments(site=site, scan=scan_id, url=site.url + '/page.html', site_url=site.url, level=1,
+                               num_node=1)
+    page.record_fetch(changed=True, etag='"v1"', now=now - timedelta(hours=12))
+    assert page.change_rate == models.DEFAULT_CHANGE_RATE
+    assert page.next_fetch == now - timedelta(hours=12) + timedelta(days=1)
+
+    # (2)
+    page.record_fetch(changed=True, etag='"v2"', now=now)
+    assert page.change_rate > models.DEFAULT_CHANGE_RATE
+    assert now < page.next_fetch < now + timedelta(days=1)
+    assert page.etag == '"v2"'
+    page.save()
+
+    # (3)
+    next_fetches = [None, now - timedelta(days=2), now - timedelta(days=1), now + timedelta(days=1)]
+    pages = []
+    for num_node, next_fetch in enumerate(next_fetches, start=2):
+        pages.append(models.WebDocuments(site=site, scan=scan_id, url=f"{site.url}/{num_node}.html",
+                                         site_url=site.url, level=1, num_node=num_node, next_fetch=next_fetch))
+        pages[-1].save()
+    frontier = list(models.WebDocuments.recrawl_frontier(site, now=now))
+    assert [page['_id'] for page in frontier] == [page.id for page in pages[:3]]
+    assert set(frontier[0]) == {'_id', 'url', 'next_fetch'}
+    assert frontier[0]['next_fetch'] == models.NEVER_FETCHED
+
+    # (4)
+    frontier = list(models.WebDocuments.recrawl_frontier(site.id, limit=2, now=now))
+    assert [page['_id'] for page in frontier] == [page.id for page in pages[:2]]
+
+    # (5)
+    later_scan_id = bson.ObjectId()
+    rescanned = [models.WebDocuments(site=site, scan=later_scan_id, url=page.url, site_url=site.url, level=1,
+                                     num_node=page.num_node, next_fetch=next_fetch, created=now + timedelta(days=1))
+                 for page, next_fetch in zip(pages[:2], (now + timedelta(days=1), None))]
+    for page in rescanned:
+        page.save()
+    frontier = list(models.WebDocuments.recrawl_frontier(site, now=now))
+    assert [page['_id'] for page in frontier] == [rescanned[1].id, pages[2].id]
+    assert models.WebDocuments.objects(id__in=[page.id for page in pages[:2]], next_fetch__ne=None).count() == 0
+
+    # (6)
+    def stages(plan):
+        plan = plan.get('queryPlan', plan)
+        found = [(plan.get('stage'), plan.get('indexName'))]
+        for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+            if child:
+                found.extend(stages(child))
+        return found
+
+    plan = stages(models.WebDocuments.recrawl_frontier(site, now=now).explain()['queryPlanner']['winningPlan'])
+    assert ('IXSCAN', None if cfg_test.MEMORY else 'site_1_next_fetch_1') in plan
+    assert 'SORT' not in [stage for stage, _ in plan]
+
+
+def test_materialized_path():
+    '''Test the materialized path of the pages hierarchy as follows:
+
+    1) The ancestors of a page are computed from its parent when saved, whether through 'save' or
+    'save_with_uniqueness'
+    2) link_children sets the parent and ancestors of all children and adds them to the parent at once
+    3) Cycles and missing parents are rejected
+    4) Whole subtrees and given levels of them are queried through the ancestors
+    5) Validation never reads the database, whereas bulk_update resolves the ancestors of the batch, including those
+    whose parent is part of the same batch
+    '''
+
+    site = models.Sites.objects()[1]
+    scan_id = bson.ObjectId()
+
+    def new_page(num_node, level, parent=None):
+        return models.WebDocuments(site=site, scan=scan_id, url=f"{site.url}/tree/{num_node}.html", site_url=site.url,
+                                   level=level, num_node=num_node, parent=parent)
+
+    # (1)
+    root = new_page(0, 1)
+    root.save()
+    assert root.ancestors == []
+    child = new_page(1, 2, parent=root)
+    child.save()
+    assert child.ancestors == [root.id]
+    grand_child = new_page(2, 3, parent=child.id)
+    grand_child.content.append(models.WebContent(url=grand_child.url, version='1.0', content='<html></html>'))
+    grand_child.save_with_uniqueness('content')
+    stored = models.WebDocuments.objects(id=grand_child.id).as_pymongo().first()
+    assert stored['ancestors'] == [root.id, child.id]
+
+    # (2)
+    pages = [new_page(num_node, 4) for num_node in range(3, 8)]
+    for page in pages[:3]:
+        page.save()
+    child_ids = [page.id for page in pages[:3]]
+    assert models.WebDocuments.link_children(grand_child, pages[:2] + [child_ids[2]]) == 3
+    stored = list(models.WebDocuments.objects(id__in=child_ids).as_pymongo())
+    assert all(page['parent'] == grand_child.id and page['ancestors'] == [root.id, child.id, grand_child.id]
+               for page in stored)
+    assert pages[0].ancestors == [root.id, child.id, grand_child.id]
+    assert not pages[0].is_modified()
+    assert models.WebDocuments.objects(id=grand_child.id).as_pymongo().first()['children'] == child_ids
+    assert [value.id for value in grand_child.children] == child_ids
+    assert models.WebDocuments.link_children(grand_child, child_ids[:1]) == 0
+    assert models.WebDocuments.objects(id=grand_child.id).as_pymongo().first()['children'] == child_ids
+
+    # (3)
+    with pytest.raises(errors.DbModelOperationError):
+        models.WebDocuments.link_children(grand_child, [root])
+    with pytest.raises(errors.DbModelOperationError):
+        models.WebDocuments.link_children(bson.ObjectId(), child_ids)
+    with pytest.raises(mongoengine.errors.ValidationError):
+        new_page(8, 2, parent=bson.ObjectId()).save()
+
+    # (4)
+    assert {page.id for page in models.WebDocuments.descendants(root)} == {child.id, grand_child.id, *child_ids}
+    assert {page.id for page in models.WebDocuments.descendants(root.id, level=4)} == set(child_ids)
+    assert not models.WebDocuments.descendants(pages[0]).count()
+
+    # (5)
+    orphan = new_page(8, 2, parent=bson.ObjectId())
+    with mock.patch.object(models.WebDocuments, '_get_collection') as get_collection:
+        orphan.validate()
+    get_collection.assert_not_called()
+    for page in pages[3:]:
+        page.save()
+    pages[3].parent, pages[4].parent = child, pages[3]
+    assert models.WebDocuments.bulk_update([pages[4], pages[3]]) == []
+    stored = {page['_id']: page['ancestors'] for page in
+              models.WebDocuments.objects(id__in=[page.id for page in pages[3:]]).as_pymongo()}
+    assert stored == {pages[3].id: [root.id, child.id], pages[4].id: [root.id, child.id, pages[3].id]}
+    pages[3].parent = pages[4]
+    with pytest.raises(errors.DbModelOperationError):
+        models.WebDocuments.bulk_update([pages[3]])
+
+
+def test_iterate():
+    '''Test the chunked iteration over the documents of a model as follows:
+
+    1) All documents matching the filters are yielded in '_id' order whatever the batch size
+    2) Only the given fields are loaded and raw dictionaries are yielded if required
+    3) A checkpoint is given after each batch and the iteration can be resumed from it
+    4) Prefetching the next batch yields the same documents
+    '''
+
+    site = models.Sites.objects()[2]
+    scan_id = bson.ObjectId()
+    pages = [models.WebDocuments(site=site, scan=scan_id, url=f"{site.url}/iterate/{num_node}.html", site_url=site.url,
+                                 level=1, num_node=num_node) for num_node in range(10)]
+    for page in pages:
+        page.save()
+    page_ids = [page.id for page in pages]
+
+    # (1)
+    for batch_size in (1, 3, 10, 20):
+        iterated = list(models.WebDocuments.iterate(batch_size=batch_size, scan=scan_id))
+        assert all(isinstance(document, models.WebDocuments) for document in iterated)
+        assert [document.id for document in iterated] == page_ids
+    assert not list(models.WebDocuments.iterate(scan=bson.ObjectId()))
+
+    # (2)
+    iterated = list(models.WebDocuments.iterate(batch_size=4, fields=['url'], raw=True, scan=scan_id))
+    assert [document['_id'] for document in iterated] == page_ids
+    assert iterated[0]['url'] == pages[0].url
+    assert 'num_node' not in iterated[0]
+    document = next(models.WebDocuments.iterate(fields=['num_node'], scan=scan_id, num_node__gte=5))
+    assert (document.id, document.num_node, document.url) == (page_ids[5], 5, None)
+
+    # (3)
+    checkpoints = []
+    iterator = models.WebDocuments.iterate(batch_size=4, checkpoint=checkpoints.append, scan=scan_id)
+    consumed = [next(iterator).id for _ in range(6)]
+    iterator.close()
+    assert checkpoints == [page_ids[3]]
+    resumed = [document.id for document in models.WebDocuments.iterate(batch_size=4, after=checkpoints[-1],
+                                                                       checkpoint=checkpoints.append, scan=scan_id)]
+    assert consumed[:4] + resumed == page_ids
+    assert checkpoints == [page_ids[3], page_ids[7], page_ids[9]]
+
+    # (4)
+    iterated = models.WebDocuments.iterate(batch_size=3, prefetch=True, raw=True, scan=scan_id)
+    assert [document['_id'] for document in iterated] == page_ids
+
+
+def test_find_raw():
+    '''Test the raw read mode of WebDocuments as follows:
+
+    1) Pages are yielded as read-only views whose fields decode as they would from a Document
+    2) Content versions are views whose bodies are memoryviews over the bytes received
+    3) Only the given fields are fetched and missing fields are None, and filters translate as those of QuerySets do
+    '''
+
+    site = models.Sites.objects()[2]
+    scan_id = bson.ObjectId()
+    page = models.WebDocuments(site=site, scan=scan_id, url=f"{site.url}/raw.html", site_url=site.url, level=1,
+                               num_node=0, children=[bson.ObjectId()])
+    page.save()
+    bodies = ['<html>first</html>', '<html>ñandú ' + 'x' * 10000 + '</html>']
+    for num_version, body in enumerate(bodies):
+        page.add_content_version(models.WebContent(url=page.url, version=f"1.{num_version}", content=body))
+    stored = models.WebDocuments._get_collection().find_one({'_id': page.id})
+
+    # (1)
+    documents = list(models.WebDocuments.find_raw(scan=scan_id))
+    assert len(documents) == 1
+    document = documents[0]
+    assert isinstance(document, raw.RawWebDocument)
+    for field in ('id', 'site', 'url', 'level', 'is_cover', 'children', 'created', 'change_rate', 'fingerprint'):
+        assert getattr(document, field) == stored['_id' if field == 'id' else field]
+    assert document.to_dict() == stored
+    with pytest.raises(AttributeError):
+        document.url = None
+
+    # (2)
+    versions = document.content
+    assert [version.version for version in versions] == ['1.0', '1.1']
+    body = document.latest_content.content
+    assert isinstance(body, memoryview) and body.obj is document._data
+    assert bytes(body).decode('utf-8') == bodies[1] and versions[0].text == bodies[0]
+    assert versions[1].created == stored['content'][1]['created']
+
+    # (3)
+    document = next(models.WebDocuments.find_raw(fields=['url'], scan=scan_id, url=page.url))
+    assert (document.url, document.level, document.content) == (page.url, None, None)
+    assert sorted(document.keys()) == ['_id', 'url']
+    assert not list(models.WebDocuments.find_raw(scan=bson.ObjectId()))
+    for model, filters in ((models.WebDocuments, {'scan': scan_id, 'level__gte': 1}), (models.Scans, {'site': site}),
+                           (models.Statistics, {'id': 'site:1'})):
+        assert models._raw_query(model, **filters) == model.objects(**filters)._query
+
+
 def test_site_instructions():
     '''Create, Insert and Update site instructions as follows
 
@@ -419,4 +814,54 @@ def test_site_instructions():
     site.url = 'http://192.168.1.2'
     site.save(force_insert=True)
     db_ret = models.Sites.objects(id=site.id).first()
-    assert len(db_ret.instructions) == 0
\ No newline at end of file
+    assert len(db_ret.instructions) == 0
+
+
+def test_insert_many_ignore_duplicates():
+    '''Test that peers and sites can be registered in bulk as follows:
+
+    1) Invalid documents are rejected before anything is sent to the database
+    2) New peers are inserted and those whose name already exists, including those repeated within the batch, are
+    reported as duplicates
+    3) Only one instruction per site is left active and sites whose url already exists are reported as duplicates
+    4) Inserted documents get their ids and are no longer flagged as modified
+    '''
+    models.Peers.ensure_indexes()
+    models.Sites.ensure_indexes()
+
+    # (1)
+    with pytest.raises(errors.DbModelOperationError) as ex:
+        models.Peers.insert_many_ignore_duplicates([models.Peers(name='bulk_peer_0', ip_address='not an ip')])
+    assert re.search(r"\bbulk_peer_0\b", str(ex.value))
+    with pytest.raises(errors.DbModelOperationError):
+        models.Peers.insert_many_ignore_duplicates([models.Sites(url='http://www.bulk.com')])
+    assert not models.Peers.objects(name='bulk_peer_0').count()
+
+    # (2)
+    models.Peers(name='bulk_peer_1', ip_address='192.168.1.1').save()
+    peers = [models.Peers(name=f"bulk_peer_{num}", ip_address='192.168.1.1') for num in range(5)]
+    peers.append(models.Peers(name='bulk_peer_4', ip_address='192.168.1.2'))
+    ret = models.Peers.insert_many_ignore_duplicates(peers)
+    assert ret['duplicates'] == ['bulk_peer_1', 'bulk_peer_4']
+    assert ret['inserted_ids'] == [peers[num].id for num in (0, 2, 3, 4)]
+    assert models.Peers.objects(name__startswith='bulk_peer_').count() == 5
+    assert models.Peers.objects(name='bulk_peer_4').first().ip_address == '192.168.1.1'
+
+    # (3)
+    instructions = [models.SiteInstructions(cover_instructions={'cover': num}, article_instructions={'article': num})
+                    for num in range(3)]
+    models.Sites(url='http://www.bulk-1.com').save(force_insert=True)
+    sites = [models.Sites(url='http://www.bulk-0.com', instructions=instructions),
+             models.Sites(url='http://www.bulk-1.com'),
+             models.Sites(url='http://www.bulk-2.com')]
+    ret = models.Sites.insert_many_ignore_duplicates(sites)
+    assert ret['duplicates'] == ['http://www.bulk-1.com']
+    assert ret['inserted_ids'] == [sites[0].id, sites[2].id]
+    db_site = models.Sites.objects(url='http://www.bulk-0.com').first()
+    assert [instruction.is_active for instruction in db_site.instructions] == [True, False, False]
+
+    # (4)
+    assert sites[1].id is None
+    assert not peers[0]._get_changed_fields()
+    assert not sites[0]._get_changed_fields()
+    assert models.Sites.insert_many_ignore_duplicates([]) == {'inserted_ids': [], 'duplicates': []}
@@ -0,0 +1,139 @@
+import os
+import pytest
+
+from datetime import datetime
+from unittest import mock
+from distpickymodel import connection, errors, models, partitions
+from tests import conftest as cfg_test
+from tests import utils
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+def test_partitions():
+    ''' Test that WebDocuments are routed to per-period collections as follows:
+
+    1) Pages are saved into the partition of the start of their scan, which is created with all indexes of the model
+    2) Queries only fan out across the partitions overlapping the time range given
+    3) Documents loaded through the partitions stay bound to them, and bulk_update is routed per partition
+    4) Read helpers of the model fan out over the partitions when given the router, and a new copy of a page retires
+    those stored in older partitions from the recrawl frontier
+    5) Partitions older than a given datetime are dropped whole, their pages are subtracted from the statistics
+    rollups and the seen-url filters of their sites forget them
+    '''
+
+    site = models.Sites.objects.first()
+    peer = models.Peers.objects.first()
+    router = partitions.Partitions(period=partitions.MONTHLY, key=partitions.BY_SCAN)
+    scans = [models.Scans(peer=peer, site=site, started_at=started_at) for started_at in
+             (datetime(2026, 8, 31, 23, 59), datetime(2026, 9, 15), datetime(2026, 10, 1))]
+    for scan in scans:
+        scan.save()
+
+    pages = {}
+
+    def new_page(scan, num_node, parent=None):
+        return models.WebDocuments(site=site, scan=scan, url=f"{site.url}/{len(pages)}/{num_node}.html",
+                                   site_url=site.url, level=2 if parent else 1, num_node=num_node, parent=parent,
+                                   created=datetime(2026, 10, 18))
+
+    # (1)
+    for scan in scans:
+        root = new_page(scan, 0)
+        router.save(root)
+        child = new_page(scan.id, 1, parent=root)  # Started_at looked up by scan id
+        router.save(child)
+        assert child.ancestors == [root.id]
+        pages[scan.id] = [root, child]
+    names = ['web_documents_2026_08', 'web_documents_2026_09', 'web_documents_2026_10']
+    assert router.partitions() == names
+    assert router.partition_of(pages[scans[0].id][1]) == names[0]
+    assert models.WebDocuments.objects.count() == 0
+    indexes = cfg_test.db[cfg_test.DATABASE][names[0]].index_information()
+    assert {'site_1_url_1_created_1_fingerprint_1', 'ancestors_1_level_1'} <= set(indexes)
+    assert router.start_of(names[1]) == datetime(2026, 9, 1)
+    with pytest.raises(errors.DbModelOperationError):
+        router.start_of('web_documents')
+
+    # (2)
+    assert router.partitions(start=datetime(2026, 9, 30), end=datetime(2026, 10, 1)) == [names[1]]
+    assert router.count(start=datetime(2026, 9, 1)) == 4
+    assert router.count() == 6
+    assert [name for name, _ in router.querysets(end=datetime(2026, 9, 1))] == [names[0]]
+    by_created = partitions.Partitions(key=partitions.BY_CREATED)
+    assert by_created.partition_of(new_page(scans[0], 5)) == names[2]
+    assert by_created.count(start=datetime(2026, 10, 1), num_node=1) == 1
+
+    # (3)
+    loaded = sorted(router.objects(num_node=1), key=lambda page: page.scan.started_at)
+    for num_node, page in enumerate(loaded, 10):
+        page.num_node = num_node
+    loaded[0].num_node = 'not a number'
+    with pytest.raises(errors.DbModelOperationError):
+        router.bulk_update(loaded)
+    loaded[0].num_node = 10
+    result = router.bulk_update(loaded, full_result=True)
+    assert (result['nModified'], result['writeErrors']) == (3, [])
+    assert sorted(page.num_node for page in router.objects(level=2)) == [10, 11, 12]
+    loaded[2].record_fetch(changed=True, now=datetime(2026, 10, 18))
+    loaded[2].save()
+    assert next(router.objects(id=loaded[2].id)).last_fetched == datetime(2026, 10, 18)
+
+    # (4)
+    root, child = pages[scans[1].id]
+    descendants = list(models.WebDocuments.descendants(root, partitions=router))
+    assert [(page.id, page._partition) for page in descendants] == [(child.id, names[1])]
+    assert not list(models.WebDocuments.descendants(root))
+    new_url = f"{site.url}/new.html"
+    assert models.WebDocuments.changed_urls(site, {root.url: None, new_url: None}, partitions=router) == [new_url]
+    assert models.WebDocuments.changed_urls(site, {root.url: None, new_url: None}) == [root.url, new_url]
+    frontier = list(models.WebDocuments.recrawl_frontier(site, now=datetime(2026, 10, 18), partitions=router))
+    assert len(frontier) == 5 and loaded[2].id not in [page['_id'] for page in frontier]
+    assert not list(models.WebDocuments.recrawl_frontier(site, now=datetime(2026, 10, 18)))
+    copy = models.WebDocuments(site=site, scan=scans[2], url=root.url, site_url=site.url, level=1, num_node=20,
+                               created=datetime(2026, 10, 18))
+    router.save(copy)
+    frontier = models.WebDocuments.recrawl_frontier(site, limit=10, now=datetime(2026, 10, 18), partitions=router)
+    frontier_ids = [page['_id'] for page in frontier]
+    assert len(frontier_ids) == 5 and copy.id in frontier_ids and root.id not in frontier_ids
+    assert [page['_id'] for page in models.WebDocuments.recrawl_frontier(site, limit=2, now=datetime(2026, 10, 18),
+                                                                         partitions=router)] == frontier_ids[:2]
+
+    # (5)
+    models.SeenUrlFilters.build(site, error_rate=0.0001, collections=[router.collection(name) for name in names])
+    site_pages = models.Statistics.for_site(site).pages
+    assert models.Statistics.for_scan(scans[0]).pages == 2
+    assert router.drop_before(datetime(2026, 9, 15)) == [names[0]]
+    assert router.partitions() == names[1:]
+    assert models.Statistics.for_scan(scans[0]).pages == 0
+    assert models.Statistics.for_site(site).pages == site_pages - 2
+    seen_urls = models.SeenUrlFilters.load(site)
+    assert not any(page.url in seen_urls for page in pages[scans[0].id])
+    assert all(page.url in seen_urls for scan in scans[1:] for page in pages[scan.id])
+    assert router.drop_before(datetime(2026, 10, 1)) == [names[1]]
+    assert router.count() == 3
+
+
+def test_partitions_fork():
+    ''' Test that routers and the documents bound through them drop the collections of the parent process in forked
+    children
+    '''
+
+    router = partitions.Partitions()
+    page = router.bind(models.WebDocuments(created=datetime(2026, 10, 1)))
+    name = page._partition
+    router._collections[name] = parent = mock.Mock()  # Collection reached through the client of the parent
+    assert page._get_collection() is parent
+    connection._owner_pid = -1  # Simulate a fork
+    with mock.patch.object(router, '_ensure_indexes') as ensure_indexes:
+        assert page._get_collection() is not parent
+    assert page._get_collection().name == name
+    ensure_indexes.assert_not_called()
+    assert connection._owner_pid == os.getpid()
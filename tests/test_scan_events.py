@@ -0,0 +1,112 @@
+import threading
+import pytest
+
+from datetime import datetime, timedelta
+from distpickymodel import models, extended_model as e_model
+from tests import conftest as cfg_test
+from tests import utils
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        models.ScanEvents._collection = None  # The collection cached by another module may have been dropped
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+def as_tuple(event):
+    return event.event, event.scan, event.peer, event.site, event.pages, event.cover_pages, event.scan_seconds
+
+
+def test_scan_events():
+    ''' Test that scan state transitions and ingested pages are streamed through ScanEvents as follows:
+
+    1) Starting a scan, ingesting a batch of pages, saving a single page and finishing the scan record one event each,
+    in order and with their counters
+    2) The capped collection is tailed as new events are recorded and consumers resume after the last event seen
+    3) Tailing can be restricted by filters
+    4) Scans closed along with stale peers record a RELEASED event
+    5) Scans activated or finished through 'save' or 'bulk_update' record the same events as those inserted active or
+    finished through 'Scans.finish', and only once
+    '''
+
+    site = models.Sites.objects.first()
+    peer = models.Peers.objects.first()
+    now = datetime.utcnow().replace(microsecond=0)
+    scan = models.Scans(peer=peer, site=site, is_active=True, started_at=now - timedelta(minutes=10))
+    scan.save()
+
+    # (1)
+    cover = models.WebDocuments(site=site, scan=scan, url=site.url, site_url=site.url, level=1, num_node=1,
+                                is_cover=True)
+    cover.content.append(models.WebContent(url=site.url, version='1.0', content='cover'))
+    with models.WebDocuments.batched_bookkeeping():
+        cover.save()
+    models.WebDocuments(site=site, scan=scan, url=f"{site.url}/1.html", site_url=site.url, level=2, num_node=2).save()
+    scan.finish(now=now)
+    events = list(models.ScanEvents.tail(idle_timeout=0, await_time_ms=10))
+    assert [as_tuple(event) for event in events] == \
+           [(models.ScanEvents.STARTED, scan.id, peer.id, site.id, None, None, None),
+            (models.ScanEvents.PAGES, scan.id, None, site.id, 1, 1, None),
+            (models.ScanEvents.PAGES, scan.id, None, site.id, 1, 0, None),
+            (models.ScanEvents.FINISHED, scan.id, peer.id, site.id, None, None, 10 * 60)]
+    assert events[1].content_bytes == len('cover')
+    assert models.ScanEvents._get_collection().options()['capped'] is True
+
+    # (2)
+    def ingest():
+        for num_node in range(2, 4):
+            with models.WebDocuments.batched_bookkeeping():
+                models.WebDocuments(site=site, scan=scan, url=f"{site.url}/{num_node}.html", site_url=site.url,
+                                    level=2, num_node=num_node).save()
+
+    producer = threading.Timer(0.2, ingest)
+    producer.start()
+    tailed = []
+    for event in models.ScanEvents.tail(after=events[-1].id, idle_timeout=1, await_time_ms=50):
+        tailed.append(event)
+    producer.join()
+    assert [(event.event, event.pages, event.cover_pages) for event in tailed] == \
+           [(models.ScanEvents.PAGES, 1, 0), (models.ScanEvents.PAGES, 1, 0)]
+    assert [event.id for event in models.ScanEvents.tail(after=tailed[0].id, idle_timeout=0, await_time_ms=10)] == \
+           [tailed[1].id]
+    assert not list(models.ScanEvents.tail(after=tailed[1].id, idle_timeout=0, await_time_ms=10))
+
+    # (3)
+    finished = models.ScanEvents.tail(idle_timeout=0, await_time_ms=10, event=models.ScanEvents.FINISHED)
+    assert [event.id for event in finished] == [events[3].id]
+    assert len(list(models.ScanEvents.tail(idle_timeout=0, await_time_ms=10, scan=scan.id))) == 6
+
+    # (4)
+    peer.update(set__is_assigned=True, set__updated=now - timedelta(hours=1))
+    scan = models.Scans(peer=peer, site=site, is_active=True, started_at=now - timedelta(minutes=30))
+    scan.save()
+    assert e_model.release_stale_peers(timedelta(minutes=5), now=now)['scans'] == 1
+    events = list(models.ScanEvents.tail(idle_timeout=0, await_time_ms=10, scan=scan.id))
+    assert [as_tuple(event) for event in events] == \
+           [(models.ScanEvents.STARTED, scan.id, peer.id, site.id, None, None, None),
+            (models.ScanEvents.RELEASED, scan.id, peer.id, site.id, None, None, 30 * 60)]
+
+    # (5)
+    scans = [models.Scans(peer=peer, site=site, started_at=now - timedelta(minutes=minutes)) for minutes in (5, 15)]
+    for scan in scans:
+        scan.save()
+        scan.is_active = True
+    scans[0].save()
+    assert models.Scans.bulk_update([scans[1]]) == []
+    scans[0].is_active = False
+    scans[0].finished_at = now
+    assert models.Scans.bulk_update([scans[0]]) == []
+    scans[1].is_active = False
+    scans[1].finished_at = now
+    scans[1].save()
+    scans[1].process_name = 'Process-a'
+    scans[1].save()
+    for scan, minutes in zip(scans, (5, 15)):
+        events = list(models.ScanEvents.tail(idle_timeout=0, await_time_ms=10, scan=scan.id))
+        assert [as_tuple(event) for event in events] == \
+               [(models.ScanEvents.STARTED, scan.id, peer.id, site.id, None, None, None),
+                (models.ScanEvents.FINISHED, scan.id, peer.id, site.id, None, None, minutes * 60)]
@@ -0,0 +1,134 @@
+import mongoengine
+import pytest
+
+from unittest import mock
+from pymongo.errors import BulkWriteError
+from distpickymodel import errors, models, schema, utils as model_utils, extended_model as e_model
+from tests import conftest as cfg_test
+from tests import utils
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        utils.init_db_with_escan_instructions_and_settings()
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+def test_json_schema():
+    ''' Test that the validators generated from the models hold their constraints as follows:
+
+    1) Required fields, choices, bounds and regexes of top-level and list fields
+    2) Embedded documents are translated recursively
+    3) Documents of the subclasses stored in the same collection follow the schema of their '_cls'
+    '''
+
+    # (1)
+    instructions = schema.json_schema(e_model.ServerInstructions)['$jsonSchema']
+    assert instructions['required'] == ['site', 'operation']
+    assert instructions['properties']['operation'] == {'bsonType': 'string', 'enum': e_model.OPERATIONS}
+    assert instructions['properties']['site'] == {'bsonType': 'objectId'}
+    assert instructions['properties']['weekdays']['items']['enum'] == e_model.WEEK_DAYS
+    assert instructions['properties']['times'] == {'bsonType': 'array', 'items': {'bsonType': ['int', 'long'],
+                                                                                  'minimum': 1,
+                                                                                  'maximum': 24 * 3600}}
+    peers = schema.json_schema(models.Peers)['$jsonSchema']
+    assert peers['properties']['ip_address'] == {'bsonType': 'string',
+                                                 'pattern': model_utils.ip_address_regex.pattern}
+    assert set(peers['required']) == {'ip_address', 'name'}
+    assert schema._anchored('[a-z]+') == '^(?:[a-z]+)'
+    assert schema._anchored(models.URL_REGEX_STRING) == models.URL_REGEX_STRING
+
+    # (2)
+    content = schema.json_schema(models.WebDocuments)['$jsonSchema']['properties']['content']['items']
+    assert content['required'] == ['url', 'version']
+    assert content['properties']['version']['pattern'] == model_utils.version_regex.pattern
+
+    # (3)
+    scans = schema.json_schema(models.Scans)['$jsonSchema']['anyOf']
+    assert [branch['properties']['_cls']['enum'] for branch in scans] == [['Scans'], ['Scans.ExtendedScans']]
+    assert 'run_instruction' not in scans[0]['required'] and '_cls' not in scans[0]['required']
+    assert {'_cls', 'run_instruction', 'peer', 'site'} <= set(scans[1]['required'])
+
+
+@pytest.mark.skipif(cfg_test.MEMORY, reason="requires a MongoDB server enforcing $jsonSchema validators")
+def test_trust_server_validation():
+    ''' Test that bulk writes trusting server validation skip client-side validation as follows:
+
+    1) Validators are applied to existing collections and documents already stored satisfy them
+    2) bulk_update writes the valid documents and raises DbModelOperationError for those rejected by the server
+    3) The setting of the class applies unless overridden per call
+    4) insert_many_ignore_duplicates raises DbModelOperationError for the documents rejected by the server
+    '''
+
+    # (1)
+    applied = schema.apply_validators()
+    assert set(applied) == {model.__name__ for model in schema.MODELS}
+    options = models.Peers._get_collection().options()
+    assert options['validator'] == applied['Peers'] and options['validationLevel'] == 'strict'
+    assert not list(models.Peers._get_collection().find({'$nor': [applied['Peers']]}))
+    assert not list(models.Scans._get_collection().find({'$nor': [applied['Scans']]}))
+
+    # (2)
+    instructions = list(e_model.ServerInstructions.objects.order_by('id'))
+    instructions[0].times = [0]
+    instructions[1].running = False
+    with pytest.raises(errors.DbModelOperationError) as ex:
+        e_model.ServerInstructions.bulk_update(instructions[:2], trust_server_validation=True)
+    assert str(instructions[0].id) in str(ex.value)
+    assert e_model.ServerInstructions.objects.get(id=instructions[0].id).times != [0]
+    assert e_model.ServerInstructions.objects.get(id=instructions[1].id).running is False
+
+    # (3)
+    with pytest.raises(errors.DbModelOperationError) as ex:
+        e_model.ServerInstructions.bulk_update(instructions[:1])
+    assert isinstance(ex.value.__cause__, mongoengine.errors.ValidationError)
+    e_model.ServerInstructions.trust_server_validation = True
+    try:
+        with pytest.raises(errors.DbModelOperationError) as ex:
+            e_model.ServerInstructions.bulk_update(instructions[:1])
+        assert ex.value.__cause__ is None
+    finally:
+        e_model.ServerInstructions.trust_server_validation = False
+
+    # (4)
+    peers = [models.Peers(name='Peer-schema-1', ip_address='192.168.1.50'),
+             models.Peers(name='Peer-schema-2', ip_address='not an ip')]
+    with pytest.raises(errors.DbModelOperationError):
+        models.Peers.insert_many_ignore_duplicates(peers, trust_server_validation=True)
+    assert models.Peers.objects(name='Peer-schema-1').count() == 1
+    assert not models.Peers.objects(name='Peer-schema-2').count()
+
+
+def test_server_validation_rejections():
+    ''' Test that documents rejected by the validator of the collection in a bulk insert are reported as follows:
+
+    1) DbModelOperationError names the documents rejected
+    2) The rest of the documents are inserted and flagged as saved, whereas those rejected are left as new
+    '''
+
+    collection = models.Peers._get_collection()
+    insert_many = collection.insert_many
+
+    def reject_second(sons, ordered=True):
+        insert_many([sons[0], sons[2]], ordered=ordered)
+        raise BulkWriteError({'writeErrors': [{'index': 1, 'code': models.DOCUMENT_VALIDATION_FAILURE,
+                                               'errmsg': 'Document failed validation'}], 'nInserted': 2})
+
+    peers = [models.Peers(name=f"Peer-rejected-{num}", ip_address=f"192.168.1.{60 + num}") for num in range(3)]
+
+    # (1)
+    with mock.patch.object(models.Peers, '_get_collection', return_value=mock.Mock(insert_many=reject_second)):
+        with pytest.raises(errors.DbModelOperationError) as ex:
+            models.Peers.insert_many_ignore_duplicates(peers, trust_server_validation=True)
+    assert 'Peer-rejected-1' in str(ex.value) and 'Peer-rejected-0' not in str(ex.value)
+    assert isinstance(ex.value.__cause__, BulkWriteError)
+
+    # (2)
+    assert [peer.id is not None and not peer._created for peer in peers] == [True, False, True]
+    assert peers[1]._created
+    assert sorted(peer.name for peer in models.Peers.objects(name__startswith='Peer-rejected')) == \
+        ['Peer-rejected-0', 'Peer-rejected-2']
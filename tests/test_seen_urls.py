@@ -0,0 +1,184 @@
+import pytest
+
+from unittest import mock
+from datetime import datetime
+from distpickymodel import bloom, errors, models, partitions
+from tests import conftest as cfg_test
+from tests import utils
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+def test_bloom_filter():
+    ''' Test the Bloom filter as follows:
+
+    1) Wrong sizes or error rates are rejected
+    2) Items added are always reported as present and the false positive rate stays close to the one it was sized for
+    3) A filter rebuilt from its bytes behaves as the original one
+    '''
+
+    # (1)
+    with pytest.raises(errors.DbModelOperationError):
+        bloom.BloomFilter.for_capacity(1000, error_rate=1)
+    with pytest.raises(errors.DbModelOperationError):
+        bloom.BloomFilter(0, 1)
+    with pytest.raises(errors.DbModelOperationError):
+        bloom.BloomFilter(64, 1, bits=b'\x00')
+
+    # (2)
+    seen_urls = bloom.BloomFilter.for_capacity(5000, error_rate=0.01)
+    urls = [f"https://www.site.com/{num}.html" for num in range(5000)]
+    seen_urls.update(urls)
+    assert all(url in seen_urls for url in urls)
+    assert len(seen_urls) <= 5000
+    false_positives = sum(f"https://www.other.com/{num}.html" in seen_urls for num in range(10000))
+    assert false_positives < 10000 * 0.02
+    assert seen_urls.estimated_error_rate() < 0.02
+
+    # (3)
+    copy = bloom.BloomFilter(seen_urls.num_bits, seen_urls.num_hashes, seen_urls.to_bytes(), seen_urls.count)
+    assert all(url in copy for url in urls)
+    assert copy.to_bytes() == seen_urls.to_bytes()
+
+
+def test_seen_url_filters():
+    ''' Test the persistent seen-url filters of the sites as follows:
+
+    1) No filter is loaded for a site that has none and inserts do not create one
+    2) A filter built from the pages of a site contains all their urls
+    3) Pages inserted afterwards are recorded as pending and loaded along with the filter
+    4) Pending urls are folded into the bit array once enough of them accumulate, unless the filter changed meanwhile,
+    and the compaction starts over if urls are recorded meanwhile
+    5) url_exists only queries the database when the filter reports a url as possibly seen
+    6) Pages inserted within 'WebDocuments.batched_bookkeeping' are recorded through one update per site
+    '''
+
+    site = models.Sites.objects.first()
+    peer = models.Peers.objects.first()
+    scan = models.Scans(peer=peer, site=site)
+    scan.save()
+
+    def insert_page(num_node):
+        document = models.WebDocuments(site=site, scan=scan, url=f"{site.url}/{num_node}.html", site_url=site.url,
+                                       level=1, num_node=num_node)
+        document.save()
+        return document
+
+    # (1)
+    assert models.SeenUrlFilters.load(site) is None
+    insert_page(0)
+    assert not models.SeenUrlFilters.objects(id=site.id).count()
+
+    # (2)
+    for num_node in range(1, 10):
+        insert_page(num_node)
+    seen_urls = models.SeenUrlFilters.build(site, capacity=1000)
+    assert all(f"{site.url}/{num_node}.html" in seen_urls for num_node in range(10))
+    stored = models.SeenUrlFilters.objects(id=site.id).first()
+    assert (stored.capacity, stored.count, stored.version, stored.pending) == (1000, 10, 1, [])
+    assert models.SeenUrlFilters.load(site.id).to_bytes() == seen_urls.to_bytes()
+
+    # (3)
+    insert_page(10)
+    stored.reload()
+    assert stored.pending == [f"{site.url}/10.html"]
+    assert f"{site.url}/10.html" in models.SeenUrlFilters.load(site)
+
+    # (4)
+    insert_page(11)
+    stored.reload()
+    assert stored.pending == [f"{site.url}/10.html", f"{site.url}/11.html"]
+
+    to_filter = models.SeenUrlFilters._to_filter
+
+    def concurrent_build(son):
+        models.SeenUrlFilters.objects(id=site.id).update(inc__version=1)
+        return to_filter(son)
+
+    with mock.patch.object(models.SeenUrlFilters, '_to_filter', side_effect=concurrent_build):
+        assert not models.SeenUrlFilters.compact(site)
+    stored.reload()
+    assert stored.pending_count == 2
+
+    def concurrent_record(son):
+        if len(son['pending']) == 2:
+            models.SeenUrlFilters.record(site, [f"{site.url}/10.html"])  # Same url recorded again by another page
+        return to_filter(son)
+
+    with mock.patch.object(models.SeenUrlFilters, '_to_filter', side_effect=concurrent_record) as compaction:
+        assert models.SeenUrlFilters.compact(site)
+    assert compaction.call_count == 2
+    stored.reload()
+    assert (stored.pending, stored.pending_count, stored.count) == ([], 0, 12)
+    assert not models.SeenUrlFilters.compact(site)
+    with mock.patch.object(models, 'SEEN_URLS_COMPACT_EVERY', 1):
+        insert_page(12)
+    stored.reload()
+    assert (stored.pending, stored.count) == ([], 13)
+
+    # (5)
+    seen_urls = models.SeenUrlFilters.load(site)
+    assert models.WebDocuments.url_exists(site, f"{site.url}/12.html", seen_urls)
+    assert not models.WebDocuments.url_exists(site, f"{site.url}/13.html")
+    with mock.patch.object(models.WebDocuments, '_get_collection') as get_collection:
+        assert not models.WebDocuments.url_exists(site, f"{site.url}/13.html", bloom.BloomFilter(8, 1))
+    get_collection.assert_not_called()
+
+    # (6)
+    with mock.patch.object(models.SeenUrlFilters, 'record', wraps=models.SeenUrlFilters.record) as record:
+        with models.WebDocuments.batched_bookkeeping():
+            for num_node in range(13, 16):
+                insert_page(num_node)
+    record.assert_called_once_with(site.id, [f"{site.url}/{num_node}.html" for num_node in range(13, 16)])
+    assert all(f"{site.url}/{num_node}.html" in models.SeenUrlFilters.load(site) for num_node in range(13, 16))
+
+
+def test_seen_url_filters_partitions():
+    ''' Test the seen-url filters of sites whose pages are stored in partitions as follows:
+
+    1) Pages inserted for a site without a filter only look it up once
+    2) A filter built over the partitions contains the urls of their pages and urls are recorded again once it exists
+    3) url_exists finds the pages stored in the partitions
+    '''
+
+    site = models.Sites.objects[1]
+    peer = models.Peers.objects.first()
+    scan = models.Scans(peer=peer, site=site, started_at=datetime(2026, 9, 15))
+    scan.save()
+    router = partitions.Partitions(period=partitions.MONTHLY, key=partitions.BY_SCAN)
+
+    def insert_page(num_node):
+        document = models.WebDocuments(site=site, scan=scan, url=f"{site.url}/partitioned/{num_node}.html",
+                                       site_url=site.url, level=1, num_node=num_node)
+        router.save(document)
+        return document
+
+    # (1)
+    get_collection = models.SeenUrlFilters._get_collection
+    with mock.patch.object(models.SeenUrlFilters, '_get_collection', wraps=get_collection) as filters_collection:
+        for num_node in range(3):
+            insert_page(num_node)
+    assert filters_collection.call_count == 1
+    assert not models.SeenUrlFilters.objects(id=site.id).count()
+
+    # (2)
+    seen_urls = models.SeenUrlFilters.build(site, capacity=1000, partitions=router)
+    assert all(f"{site.url}/partitioned/{num_node}.html" in seen_urls for num_node in range(3))
+    assert models.SeenUrlFilters.objects(id=site.id).first().count == 3
+    models.SeenUrlFilters.build(site, headroom=5000, partitions=router)  # Capacity sized from the partitions
+    assert models.SeenUrlFilters.objects(id=site.id).first().capacity == 15000
+    insert_page(3)
+    assert models.SeenUrlFilters.objects(id=site.id).first().pending == [f"{site.url}/partitioned/3.html"]
+
+    # (3)
+    assert models.WebDocuments.objects(site=site).count() == 0
+    assert not models.WebDocuments.url_exists(site, f"{site.url}/partitioned/3.html")
+    assert models.WebDocuments.url_exists(site, f"{site.url}/partitioned/3.html", partitions=router)
+    assert not models.WebDocuments.url_exists(site, f"{site.url}/partitioned/4.html", partitions=router)
@@ -0,0 +1,188 @@
+import pytest
+
+from unittest import mock
+from datetime import datetime, timedelta
+from distpickymodel import models
+from tests import conftest as cfg_test
+from tests import utils
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+def as_dict(rollup):
+    fields = ('pages', 'cover_pages', 'content_bytes', 'scans', 'scan_seconds')
+    return dict({field: getattr(rollup, field) for field in fields},
+                levels={level: pages for level, pages in rollup.levels.items() if pages})
+
+
+def test_statistics_rollups():
+    ''' Test that site and scan rollups are maintained incrementally and can be rebuilt from scratch as follows:
+
+    1) Pages inserted through 'save' and 'save_with_uniqueness' are accounted for in the rollups of their site and scan
+    2) New content versions add up their bytes
+    3) Finishing a scan accounts for its duration only once
+    4) Rebuilding from scratch gives the same rollups and repairs those that drifted
+    '''
+
+    site = models.Sites.objects.first()
+    peer = models.Peers.objects.first()
+    now = datetime.utcnow().replace(microsecond=0)
+    scan = models.Scans(peer=peer, site=site, is_active=True, started_at=now - timedelta(minutes=30))
+    scan.save()
+
+    # (1)
+    cover = models.WebDocuments(site=site, scan=scan, url=site.url, site_url=site.url, level=1, num_node=1,
+                                is_cover=True)
+    cover.content.append(models.WebContent(url=site.url, version='1.0', content='cover'))
+    cover.save()
+    for num_node in range(2, 5):
+        page = models.WebDocuments(site=site, scan=scan, url=f"{site.url}/{num_node}.html", site_url=site.url,
+                                   level=2, num_node=num_node, parent=cover)
+        page.children.append(cover)
+        page.save_with_uniqueness('children')
+    site_stats = models.Statistics.for_site(site)
+    assert site_stats.pages == 4
+    assert site_stats.cover_pages == 1
+    assert site_stats.levels == {'1': 1, '2': 3}
+    assert site_stats.content_bytes == len('cover')
+    assert as_dict(models.Statistics.for_scan(scan)) == as_dict(site_stats)
+
+    # (2)
+    cover.add_content_version(models.WebContent(url=site.url, version='1.1', content='cover v2'))
+    assert models.Statistics.for_site(site).content_bytes == len('cover') + len('cover v2')
+
+    # (3)
+    assert scan.finish(now=now) is True
+    assert scan.finish(now=now) is False
+    scan_stats = models.Statistics.for_scan(scan.id)
+    assert scan_stats.scans == 1
+    assert scan_stats.scan_seconds == 30 * 60
+    assert models.Statistics.for_site(site.id).scan_seconds == 30 * 60
+
+    # (4)
+    expected = {key: as_dict(rollup) for key, rollup in
+                ((models.Statistics.site_key(site), models.Statistics.for_site(site)),
+                 (models.Statistics.scan_key(scan), models.Statistics.for_scan(scan)))}
+    models.Statistics.objects(id=models.Statistics.site_key(site)).update(inc__pages=100)
+    assert models.Statistics.rebuild(site) == 2
+    assert as_dict(models.Statistics.for_site(site)) == expected[models.Statistics.site_key(site)]
+    assert as_dict(models.Statistics.for_scan(scan)) == expected[models.Statistics.scan_key(scan)]
+
+
+def test_batched_bookkeeping():
+    ''' Test that the bookkeeping of pages and scans stays consistent with rebuilding the rollups as follows:
+
+    1) Pages inserted within 'batched_bookkeeping' are accounted for once the outermost block exits, through a single
+    write per collection
+    2) Scans inserted already closed are counted incrementally, whereas those still active are not counted by rebuild
+    '''
+
+    site = models.Sites.objects.first()
+    peer = models.Peers.objects.first()
+    now = datetime.utcnow().replace(microsecond=0)
+    scan = models.Scans(peer=peer, site=site, started_at=now - timedelta(minutes=10), finished_at=now)
+    scan.save()
+
+    # (1)
+    with mock.patch.object(models.Statistics, '_write_increments', wraps=models.Statistics._write_increments) as write:
+        with models.WebDocuments.batched_bookkeeping():
+            for num_node in range(3):
+                with models.WebDocuments.batched_bookkeeping():
+                    models.WebDocuments(site=site, scan=scan, url=f"{site.url}/batch/{num_node}.html",
+                                        site_url=site.url, level=1, num_node=num_node).save()
+            assert models.Statistics.for_scan(scan).pages == 0
+        assert write.call_count == 1
+    assert models.Statistics.for_scan(scan).pages == 3
+    assert models.ScanEvents.objects(scan=scan.id, event=models.ScanEvents.PAGES).count() == 1
+
+    # (2)
+    assert models.Statistics.for_scan(scan).scans == 1
+    assert models.Statistics.for_scan(scan).scan_seconds == 10 * 60
+    models.Scans(peer=peer, site=site, is_active=True, started_at=now, finished_at=now).save()
+    expected = {key: as_dict(rollup) for key, rollup in
+                ((models.Statistics.site_key(site), models.Statistics.for_site(site)),
+                 (models.Statistics.scan_key(scan), models.Statistics.for_scan(scan)))}
+    models.Statistics.rebuild(site)
+    assert as_dict(models.Statistics.for_site(site)) == expected[models.Statistics.site_key(site)]
+    assert as_dict(models.Statistics.for_scan(scan)) == expected[models.Statistics.scan_key(scan)]
+
+
+def test_update_rollups():
+    ''' Test that updates of stored pages and scans keep the rollups equal to those rebuilt from scratch as follows:
+
+    1) Pages whose level, cover flag or content change through 'save', 'save_with_uniqueness' or 'bulk_update'
+    2) Scans closed through 'save' or 'bulk_update', and reopened
+    3) Updates within 'batched_bookkeeping' are written along with the pages inserted, through a single write
+    '''
+
+    site = models.Sites.objects()[1]
+    peer = models.Peers.objects.first()
+    now = datetime.utcnow().replace(microsecond=0)
+    scans = [models.Scans(peer=peer, site=site, is_active=True, started_at=now - timedelta(minutes=minutes))
+             for minutes in (10, 20, 30)]
+    for scan in scans:
+        scan.save()
+    pages = []
+    for num_node in range(4):
+        page = models.WebDocuments(site=site, scan=scans[num_node % 2], url=f"{site.url}/update/{num_node}.html",
+                                   site_url=site.url, level=1, num_node=num_node)
+        page.content.append(models.WebContent(url=page.url, version='1.0', content='page'))
+        page.save()
+        pages.append(page)
+
+    def assert_rebuilt():
+        keys = [models.Statistics.site_key(site)] + [models.Statistics.scan_key(scan) for scan in scans]
+        incremental = {rollup.id: as_dict(rollup) for rollup in models.Statistics.objects(id__in=keys)}
+        models.Statistics.rebuild(site)
+        assert {rollup.id: as_dict(rollup) for rollup in models.Statistics.objects(id__in=keys)} == incremental
+
+    # (1)
+    pages[0].level = 2
+    pages[0].save()
+    page = models.WebDocuments.objects(id=pages[1].id).first()
+    page.content.append(models.WebContent(url=page.url, version='1.1', content='page v2'))
+    page.save_with_uniqueness('content')
+    loaded = list(models.WebDocuments.objects(id__in=[pages[2].id, pages[3].id]).order_by('num_node'))
+    loaded[0].is_cover = True
+    loaded[1].level = 3
+    assert models.WebDocuments.bulk_update(loaded) == []
+    site_stats = models.Statistics.for_site(site)
+    assert (site_stats.pages, site_stats.cover_pages) == (4, 1)
+    assert site_stats.levels == {'1': 2, '2': 1, '3': 1}
+    assert site_stats.content_bytes == 4 * len('page') + len('page v2')
+    assert_rebuilt()
+
+    # (2)
+    scans[0].is_active = False
+    scans[0].finished_at = now
+    scans[0].save()
+    scans[1].is_active = False
+    scans[1].finished_at = now
+    assert models.Scans.bulk_update([scans[1]]) == []
+    assert models.Statistics.for_site(site).scans == 2
+    assert models.Statistics.for_scan(scans[1]).scan_seconds == 20 * 60
+    assert_rebuilt()
+    scans[1].is_active = True
+    scans[1].save()
+    assert models.Statistics.for_scan(scans[1]).scans == 0
+    assert_rebuilt()
+
+    # (3)
+    with mock.patch.object(models.Statistics, '_write_increments', wraps=models.Statistics._write_increments) as write:
+        with models.WebDocuments.batched_bookkeeping():
+            scans[1].is_active = False
+            scans[1].save()
+            pages[0].is_cover = True
+            pages[0].save()
+            models.WebDocuments(site=site, scan=scans[2], url=f"{site.url}/update/4.html", site_url=site.url,
+                                level=1, num_node=4).save()
+        assert write.call_count == 1
+    assert models.Statistics.for_site(site).cover_pages == 2
+    assert_rebuilt()
@@ -0,0 +1,80 @@
+import re
+import sys
+
+from hypothesis import given, settings, strategies as st
+from distpickymodel import models, utils, validators
+
+URL_REGEX = re.compile(validators.URL_PATTERN)
+
+# Fragments that make random strings hit every branch of the regular expressions, including characters that only match
+# their classes because of Unicode or case-insensitive semantics
+URL_TOKENS = ['http://', 'https://', 'HTTPS://', 'HTTPſ://', 'localhost', 'LOCALHOſT', 'www', 'site', 'com', 'a', 'Z',
+              'İ', 'ı', 'K', '0', '1', '25', '255', '256', '٣', '-', '.', '..', ':', '::', '[', ']', '/', '?', '#',
+              ' ', '\t', '\n', ' ', 'a' * 61, 'a' * 62, 'a' * 63]
+IP_TOKENS = ['0', '1', '9', '00', '01', '10', '99', '100', '199', '200', '249', '250', '255', '256', '٣', '.', '\n',
+             ' ', 'a']
+VERSION_TOKENS = ['0', '1', '9', '٣', '٠', '.', '\n', ' ', 'a', '10', '05']
+
+
+def token_strings(tokens, max_size):
+    return st.lists(st.sampled_from(tokens), max_size=max_size).map(''.join)
+
+
+def urls():
+    url = token_strings(URL_TOKENS, 12)
+    return st.one_of(st.builds(str.__add__, st.sampled_from(['http://', 'https://']), url), url,
+                     st.from_regex(utils.url_regex))
+
+
+@settings(max_examples=3000, deadline=None)
+@given(urls())
+def test_url_validator_equivalence(value):
+    '''Test that both the url validator and its parser accept exactly the same urls as the original regex
+    '''
+    expected = URL_REGEX.match(value) is not None
+    assert validators._parse_url(value) is expected
+    assert validators.is_url(value) is expected
+
+
+@settings(max_examples=3000, deadline=None)
+@given(st.one_of(token_strings(IP_TOKENS, 9), st.from_regex(utils.ip_address_regex)))
+def test_ip_address_validator_equivalence(value):
+    '''Test that the ip address validator accepts exactly the same addresses as the original regex
+    '''
+    assert validators.is_ip_address(value) is (utils.ip_address_regex.match(value) is not None)
+
+
+@settings(max_examples=3000, deadline=None)
+@given(st.one_of(token_strings(VERSION_TOKENS, 5), st.from_regex(utils.version_regex), st.text(max_size=6)))
+def test_version_validator_equivalence(value):
+    '''Test that the version validator accepts exactly the same versions as the original regex
+    '''
+    assert validators.is_version(value) is (utils.version_regex.match(value) is not None)
+
+
+def test_validators():
+    ''' Test the dedicated validators as follows:
+
+    1) str.isdecimal, on which the version validator relies, stands for the same characters as '\\d'
+    2) Long urls and adversarial hosts are validated as the original regex does
+    3) StringField relies on the dedicated validators and compiles any other pattern only once
+    '''
+
+    # (1)
+    digit = re.compile(r'\d')
+    assert all(chr(code).isdecimal() is (digit.match(chr(code)) is not None) for code in range(sys.maxunicode + 1))
+
+    # (2)
+    values = ['https://www.site.com/' + 'p' * 5000, 'http://' + 'aa.' * 2000 + ' ', 'http://' + '1.1' * 2000,
+              'http://' + '0:' * 2000 + 'x', 'http://[' + 'a' * 500 + ':a:' + '1' * 500 + ']:80/',
+              'http://' + 'a' * 63 + '.com:8080/?q=1', 'http://' + 'a' * 64 + '.com', 'http://' + 'a.' * 2000 + 'a-']
+    for value in values:
+        assert validators.is_url(value) is (URL_REGEX.match(value) is not None)
+
+    # (3)
+    assert validators.matcher_for(models.URL_REGEX_STRING) is validators.is_url
+    assert validators.matcher_for(utils.version_regex.pattern) is validators.is_version
+    matcher = validators.matcher_for(r'^\d+$')
+    assert validators.matcher_for(r'^\d+$') is matcher
+    field = models.StringField(regex=r'^\d+$')
+    field.validate('123')
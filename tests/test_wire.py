@@ -0,0 +1,111 @@
+import datetime
+import bson
+import pytest
+
+from distpickymodel import errors, extended_model, models, wire
+
+
+def make_assignment():
+    site = models.Sites(id=bson.ObjectId(), url='https://www.site.com')
+    site.instructions = [models.SiteInstructions(cover_instructions={'title': {'css': 'h1'}},
+                                                 article_instructions={'body': ['div.main', 'p']}, is_active=False,
+                                                 created=datetime.datetime(2019, 5, 1)),
+                         models.SiteInstructions(cover_instructions={}, article_instructions={'body': 'article'},
+                                                 created=datetime.datetime(2019, 5, 2, 8, 30, 0, 123456),
+                                                 updated=datetime.datetime(2019, 5, 3))]
+    instructions = extended_model.ServerInstructions(id=bson.ObjectId(), site=site,
+                                                     operation=extended_model.STOP_AND_RUN_OP,
+                                                     stop_at=datetime.datetime(2019, 6, 1, 23, 59, 59, 999999),
+                                                     exclude_dates=[datetime.datetime(2019, 12, 25),
+                                                                    datetime.datetime(1969, 12, 31, 12)],
+                                                     weekdays=[0, 2, 6], times=[1, 3600, 24 * 3600], running=True)
+    scan_ids = [bson.ObjectId(), bson.ObjectId()]
+    settings = models.ScanSettings(id=bson.ObjectId(), site=site.id, num_levels=3, mime_types=['text/html', 'text/xml'],
+                                   scans=[scan_ids[0], bson.DBRef('scans', scan_ids[1])],
+                                   created=datetime.datetime(2019, 5, 1, 0, 0, 0, 1))
+    return site, instructions, settings, scan_ids
+
+
+def test_round_trip():
+    ''' Test the wire codec as follows:
+
+    1) Each kind of document is decoded into a read-only view that gives it back exactly as a model
+    2) Views are re-encoded into the very same bytes and are smaller than Mongoengine's JSON
+    3) Assignments carry the instructions, the settings and only the active instructions of the site
+    4) Weekdays and times that a bitmask or packed integers could not give back as they are are sent as plain lists
+    '''
+
+    site, instructions, settings, scan_ids = make_assignment()
+
+    # (1)
+    for document in (instructions, settings, site.instructions[1]):
+        view = wire.decode(wire.encode(document))
+        with pytest.raises(AttributeError):
+            view.id = None
+        model = wire.to_model(view)
+        assert type(model) is type(document)
+        assert model.to_mongo() == document.to_mongo()
+
+    view = wire.decode(wire.encode(instructions))
+    assert (view.site, view.weekdays, view.times) == (site.id, (0, 2, 6), (1, 3600, 24 * 3600))
+    assert view.stop_at == instructions.stop_at
+    assert wire.decode(wire.encode(settings)).scans == tuple(scan_ids)
+
+    # (2)
+    for document in (instructions, settings, site.instructions[1]):
+        data = wire.encode(document)
+        assert wire.encode(wire.decode(data)) == data
+        assert len(data) < len(document.to_json())
+
+    # (3)
+    views = wire.decode_many(wire.encode_assignment(instructions, settings, site))
+    assert [type(view) for view in views] == [wire.ServerInstructionsView, wire.ScanSettingsView,
+                                              wire.SiteInstructionsView]
+    assert views[2].article_instructions == {'body': 'article'}
+
+    # (4)
+    instructions.weekdays = [3, 1, 1]
+    instructions.times = [-5]
+    view = wire.decode(wire.encode(instructions))
+    assert (view.weekdays, view.times) == ((3, 1, 1), (-5,))
+    assert wire.to_model(view).to_mongo() == instructions.to_mongo()
+
+
+def test_versions():
+    ''' Test that messages are decoded according to the schema version they were encoded with as follows:
+
+    1) Fields missing from the schema of a message are decoded as None
+    2) Unknown versions, kinds of documents and values that do not fit the schema are rejected
+    '''
+
+    site, instructions, _, _ = make_assignment()
+
+    # (1)
+    old_schema = dict(wire.SCHEMAS[1])
+    kind, fields = old_schema['ServerInstructions']
+    old_schema['ServerInstructions'] = (kind, [field for field in fields if field[0] != 'running'])
+    wire.SCHEMAS[0] = old_schema
+    try:
+        view = wire.decode(wire.encode(instructions, version=0))
+        assert view.running is None and view.operation == extended_model.STOP_AND_RUN_OP
+    finally:
+        del wire.SCHEMAS[0]
+
+    # (2)
+    with pytest.raises(errors.DbModelOperationError):
+        wire.encode(instructions, version=99)
+    with pytest.raises(errors.DbModelOperationError):
+        wire.decode(bson.BSON.encode({'v': 99, 'k': 'i'}))
+    with pytest.raises(errors.DbModelOperationError):
+        wire.decode(bson.BSON.encode({'v': 1, 'k': '?'}))
+    with pytest.raises(errors.DbModelOperationError):
+        wire.decode(b'\x00\x01')
+    with pytest.raises(errors.DbModelOperationError):
+        wire.encode(site)
+    instructions.operation = 'PAUSE'
+    with pytest.raises(errors.DbModelOperationError):
+        wire.encode(instructions)
+    instructions.operation = extended_model.RUN_OP
+    instructions.stop_at = datetime.datetime.now(datetime.timezone.utc)
+    with pytest.raises(errors.DbModelOperationError):
+        wire.encode(instructions)
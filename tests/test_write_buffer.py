@@ -0,0 +1,152 @@
+import bson
+import pytest
+
+from unittest import mock
+from pymongo.errors import AutoReconnect
+from distpickymodel import errors, models
+from distpickymodel.write_buffer import WriteBuffer
+from tests import conftest as cfg_test
+from tests import utils
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tear_up_down_db():
+    try:
+        utils.init_db_with_site_peers()
+        yield
+    finally:
+        cfg_test.db.drop_database(cfg_test.DATABASE)
+
+
+@utils.truncate_collections([models.Scans])
+def test_write_buffer_coalesces_updates():
+    ''' Test that the buffer merges successive updates of the same document as follows:
+
+    1) Only UniquenessMixin documents of the given model are accepted
+    2) Nothing is written until the buffer is flushed and all updates of one document are held as a single entry
+    3) '$set' fields follow last-writer-wins while '$addToSet' fields are merged as a union
+    4) The buffer is flushed on its own when 'max_size' is reached
+    '''
+
+    site = models.Sites.objects.first()
+    peer = models.Peers.objects.first()
+    doc_ids = [bson.ObjectId() for _ in range(3)]
+
+    # (1)
+    with pytest.raises(errors.DbModelOperationError):
+        WriteBuffer(models.Sites, flush_at_exit=False)
+    with WriteBuffer(models.Scans, max_age=3600, flush_at_exit=False) as buffer:
+        with pytest.raises(errors.DbModelOperationError):
+            buffer.add(models.Peers(ip_address='192.168.1.10', name='peer'))
+
+        # (2)
+        scan = models.Scans(peer=peer, site=site, process_name='Process-a')
+        scan_id = buffer.add(scan)
+        scan.process_name = 'Process-b'
+        scan.documents = doc_ids[:2]
+        buffer.add(scan, many_unique='documents')
+        scan.is_active = True
+        scan.documents = doc_ids[1:]
+        buffer.add(scan, many_unique='documents')
+        assert len(buffer) == 1
+        assert models.Scans.objects(id=scan_id).first() is None
+
+        # (3)
+        assert buffer.flush() == []
+        db_scan = models.Scans.objects(id=scan_id).no_dereference().first()
+        assert db_scan.process_name == 'Process-b'
+        assert db_scan.is_active is True
+        assert [doc.id for doc in db_scan.documents] == doc_ids
+
+    # (4)
+    buffer = WriteBuffer(models.Scans, max_size=3, max_age=3600, flush_at_exit=False)
+    buffer.update(scan_id, set_fields={'process_name': 'Process-c'})
+    buffer.update(scan_id, add_to_set={'documents': doc_ids[0]})
+    assert len(buffer) == 1
+    buffer.update(scan_id, add_to_set={'documents': [bson.ObjectId()]})
+    assert len(buffer) == 0
+    db_scan = models.Scans.objects(id=scan_id).no_dereference().first()
+    assert db_scan.process_name == 'Process-c'
+    assert len(db_scan.documents) == 4
+    buffer.close()
+
+
+@utils.truncate_collections([models.Scans])
+def test_write_buffer_new_values_and_inserts():
+    ''' Test that the buffer writes only what is new and accounts for the documents it inserts as follows:
+
+    1) Only the values appended to a 'many_unique' field since the document was loaded are sent with '$addToSet'
+    2) Documents inserted by the upserts of a flush go through '_after_insert', as the start of an active scan shows
+    3) Updates of documents already stored do not run the hook again
+    '''
+
+    site = models.Sites.objects.first()
+    peer = models.Peers.objects.first()
+    doc_ids = [bson.ObjectId() for _ in range(3)]
+    scan = models.Scans(peer=peer, site=site, documents=doc_ids[:2])
+    scan.save_with_uniqueness('documents')
+
+    # (1)
+    db_scan = models.Scans.objects(id=scan.id).no_dereference().first()
+    db_scan.documents.append(doc_ids[2])
+    buffer = WriteBuffer(models.Scans, max_age=3600, flush_at_exit=False)
+    buffer.add(db_scan, many_unique='documents')
+    assert buffer._to_update(buffer._pending[scan.id]) == {'$addToSet': {'documents': {'$each': [doc_ids[2]]}}}
+    assert buffer.flush() == []
+    assert [doc.id for doc in models.Scans.objects(id=scan.id).no_dereference().first().documents] == doc_ids
+
+    # (2)
+    active_scan = models.Scans(peer=peer, site=site, is_active=True)
+    buffer.add(active_scan)
+    assert models.ScanEvents.objects(scan=active_scan.id).count() == 0
+    assert buffer.flush() == []
+    assert models.ScanEvents.objects(scan=active_scan.id, event=models.ScanEvents.STARTED).count() == 1
+
+    # (3)
+    active_scan.process_name = 'Process-a'
+    buffer.add(active_scan)
+    assert buffer.flush() == []
+    assert models.ScanEvents.objects(scan=active_scan.id).count() == 1
+    buffer.close()
+
+
+def test_write_buffer_reports_errors():
+    ''' Test that errors of individual documents are reported with their ids while the rest are written
+    '''
+
+    models.Peers.ensure_indexes()  # Indexes may have been dropped along with the database by other test modules
+    peers = list(models.Peers.objects.all())
+    buffer = WriteBuffer(models.Peers, max_age=3600, flush_at_exit=False)
+    duplicated_id = bson.ObjectId()
+    buffer.update(duplicated_id, set_fields={'name': peers[1].name, 'ip_address': '192.168.1.10'})
+    buffer.update(peers[0].id, set_fields={'is_allowed': False})
+    ret = buffer.flush()
+    assert len(ret) == 1
+    assert ret[0]['_id'] == duplicated_id
+    assert buffer.write_errors == ret
+    assert models.Peers.objects(id=peers[0].id).first().is_allowed is False
+    buffer.close()
+
+
+def test_write_buffer_keeps_updates_on_failure():
+    ''' Test that updates stay pending when the bulk write fails for any reason other than the errors of individual
+    documents, and are written by the next flush
+    '''
+
+    peer = models.Peers.objects.first()
+    buffer = WriteBuffer(models.Peers, max_age=3600, flush_at_exit=False)
+    buffer.update(peer.id, set_fields={'is_allowed': False})
+    buffer.update(peer.id, set_fields={'is_assigned': False})
+    collection = models.Peers._get_collection()
+    with mock.patch.object(type(collection), 'bulk_write', side_effect=AutoReconnect('primary stepped down')):
+        with pytest.raises(AutoReconnect):
+            buffer.flush()
+    assert len(buffer) == 1
+    assert buffer._to_update(buffer._pending[peer.id]) == {'$set': {'is_allowed': False, 'is_assigned': False}}
+    assert buffer.is_due() is False and buffer._oldest is not None
+
+    assert buffer.flush() == []
+    assert len(buffer) == 0
+    db_peer = models.Peers.objects(id=peer.id).first()
+    assert (db_peer.is_allowed, db_peer.is_assigned) == (False, False)
+    buffer.close()